@@ -0,0 +1,167 @@
+import numpy as np
+
+# Ways to combine the scores of the members of a group into the group score
+STRATEGIES = ("sum", "least_misery", "average_without_misery", "borda")
+
+# Members scoring a recipe below this are miserable with it, for
+# average_without_misery
+MISERY_THRESHOLD = 0.2
+
+
+def aggregate(strategy, member_scores, misery_threshold=MISERY_THRESHOLD):
+    """
+    Combines the scores of every member into the group score. Every strategy is
+    monotone: raising the score of a member never lowers the group score, which
+    is what lets threshold_top_k stop early.
+
+    Args:
+        strategy (str): One of STRATEGIES. Borda scores are the points of each
+            member, see member_points.
+        member_scores (np.ndarray): A (num_members, num_recipes) matrix.
+        misery_threshold (float): See MISERY_THRESHOLD.
+
+    Returns:
+        np.ndarray: The group score of every recipe.
+    """
+    if strategy in ("sum", "borda"):
+        return member_scores.sum(axis=0)
+    if strategy == "least_misery":
+        return member_scores.min(axis=0)
+    if strategy == "average_without_misery":
+        # Recipes that make a member miserable rank after all the others, by
+        # average. Cosine similarities are within [-1, 1], so 2 is enough.
+        miserable = member_scores.min(axis=0) < misery_threshold
+        return member_scores.mean(axis=0) - 2 * miserable
+    raise ValueError(f"Unknown aggregation strategy {strategy!r}")
+
+
+def member_points(sorted_scores, values):
+    """
+    Gets the Borda points of recipes for one member: n - 1 minus the number of
+    recipes the member scores higher, so the top recipe of n gets n - 1 points
+    and tied recipes get the same points.
+
+    Args:
+        sorted_scores (np.ndarray): The score of every recipe for the member,
+            in ascending order.
+        values (np.ndarray): The scores to get the points of.
+
+    Returns:
+        np.ndarray: The points of each value.
+    """
+    # Searching the values in sorted order is much faster than in any order
+    order = np.argsort(values)
+    points = np.empty(len(values), dtype=np.intp)
+    points[order] = np.searchsorted(sorted_scores, values[order], "right") - 1
+    return points
+
+
+def depths(k, num_recipes, depth=None):
+    """
+    The depths threshold_top_k reads the lists to, round by round: 4 * k, or
+    depth, growing fourfold. Past an eighth of the corpus, reading the rest
+    costs less than another round, so the last depth is the whole corpus.
+    """
+    depth = min(depth or 4 * k, num_recipes)
+    schedule = [depth]
+    while depth < num_recipes:
+        depth = 4 * depth
+        if 8 * depth > num_recipes:
+            depth = num_recipes
+        schedule.append(depth)
+    return schedule
+
+
+def threshold_top_k(
+    member_scores,
+    k,
+    strategy="sum",
+    mask=None,
+    misery_threshold=MISERY_THRESHOLD,
+    depth=None,
+):
+    """
+    Selects the k recipes with the highest group score with the threshold
+    algorithm: it reads the ranked list of every member from the top, scores the
+    recipes seen so far and stops once the k-th of them beats the best score an
+    unseen recipe could have, i.e. the group score of the scores at the current
+    depth of every list.
+
+    The lists are prepared once, before the rounds. Borda points count the
+    recipes a member scores higher, so every list is sorted, and the points come
+    from a binary search of it. For the other strategies one partition of every
+    list at all the depths of the rounds, see depths, gives the score at each
+    depth without sorting the corpus. A round then only compares the scores
+    with those of its depth.
+
+    Ties are broken by corpus order, like algorithm.top_k over the full group
+    scores.
+
+    Args:
+        member_scores (np.ndarray): A (num_members, num_recipes) matrix.
+        k (int): Number of recipes to return.
+        strategy (str): One of STRATEGIES.
+        mask (np.ndarray): Optional boolean array of recipes that may be returned.
+        misery_threshold (float): See MISERY_THRESHOLD.
+        depth (int): Depth of the first round, 4 * k by default.
+
+    Returns:
+        np.ndarray: The indices of the top k recipes, best first.
+    """
+    if strategy not in STRATEGIES:
+        raise ValueError(f"Unknown aggregation strategy {strategy!r}")
+    if mask is not None:
+        candidates = np.flatnonzero(mask)
+        top = threshold_top_k(
+            member_scores[:, candidates], k, strategy, None, misery_threshold, depth
+        )
+        return candidates[top]
+
+    num_members, num_recipes = member_scores.shape
+    k = min(k, num_recipes)
+    if k == 0 or num_members == 0:
+        return np.empty(0, dtype=np.intp)
+
+    schedule = depths(k, num_recipes, depth)
+    # Ascending, so the score at depth d of every list is at num_recipes - d
+    if strategy == "borda":
+        prepared = np.sort(member_scores, axis=1)
+    elif len(schedule) > 1:
+        kth = [num_recipes - d for d in schedule if d < num_recipes]
+        prepared = np.partition(member_scores, kth, axis=1)
+
+    for depth in schedule:
+        # Sorted access: the recipes in the top depth of some member, and the
+        # score at that depth, which no unseen recipe reaches for that member
+        if depth < num_recipes:
+            bounds = prepared[:, num_recipes - depth]
+            seen = np.flatnonzero((member_scores >= bounds[:, None]).any(axis=0))
+        else:
+            bounds = None
+            seen = np.arange(num_recipes)
+
+        # Random access: the exact group score of every recipe seen
+        seen_scores = member_scores[:, seen]
+        if strategy == "borda":
+            if bounds is not None:
+                seen_scores = np.hstack([seen_scores, bounds[:, None]])
+            seen_scores = np.stack(
+                [member_points(p, v) for p, v in zip(prepared, seen_scores)]
+            )
+            if bounds is not None:
+                seen_scores, bounds = seen_scores[:, :-1], seen_scores[:, -1]
+        group_scores = aggregate(strategy, seen_scores, misery_threshold)
+
+        # The best k seen, keeping every recipe tied with the k-th so that ties
+        # are broken by corpus order. seen is sorted, so that is index order.
+        k_seen = min(k, len(seen))
+        kth = -np.partition(-group_scores, k_seen - 1)[k_seen - 1]
+        top = np.flatnonzero(group_scores >= kth)
+        top = top[np.lexsort((top, -group_scores[top]))][:k_seen]
+        if bounds is None:
+            return seen[top]
+        threshold = aggregate(strategy, bounds[:, None], misery_threshold)[0]
+        # Strictly above, since an unseen recipe with the same score could come
+        # first in corpus order
+        if k_seen == k and group_scores[top[-1]] > threshold:
+            return seen[top]
@@ -1,50 +1,163 @@
-from sklearn.metrics.pairwise import cosine_similarity
+import aggregation
+import filters
+import numpy as np
+import restrictions
+import timing
 
 
-def common_recipes(cosine_scores_all):
+def normalize_rows(matrix):
     """
-    Gets the top 10 most common recipes from the cosine similarity scores of
-    all queries.
+    Scales every row of the input matrix to unit euclidean length so that a dot
+    product between two normalized rows is their cosine similarity. Rows with a
+    norm of zero are left as zeros.
 
     Args:
-        cosine_scores_all (list): List of cosine similarity scores for each query.
+        matrix (np.ndarray): A 2D matrix, e.g. the SVD embedding of every recipe.
 
     Returns:
-        top_10_recipes (list): A list of tuples of (recipe_id, score)
+        np.ndarray: The row-normalized matrix, keeping the float precision of the
+            input.
     """
-    # Dictionary to store accumulated ranks of each recipe
-    accumulated_ranks = {}
+    matrix = np.asarray(matrix)
+    if not np.issubdtype(matrix.dtype, np.floating):
+        matrix = matrix.astype(np.float64)
+    norms = np.linalg.norm(matrix, axis=1, keepdims=True)
+    norms[norms == 0] = 1
+    return matrix / norms
 
-    # Accumulate ranks of each recipe
-    for cosine_scores in cosine_scores_all:
-        for recipe_id, score in cosine_scores:
-            if recipe_id in accumulated_ranks:
-                accumulated_ranks[recipe_id] += score
-            else:
-                accumulated_ranks[recipe_id] = score
-    # Sort the accumulated ranks in increasing order
-    top_recipes = sorted(accumulated_ranks.items(), key=lambda x: x[1], reverse=True)
 
-    return top_recipes
+def embed_queries(queries, vectorizer, svd_model, cache=None):
+    """
+    Projects every query into the SVD space in a single batch.
+
+    Args:
+        queries (list): List of input queries.
+        vectorizer (TfidfVectorizer): The fitted TF-IDF vectorizer.
+        svd_model (TruncatedSVD): The fitted SVD model.
+        cache (lru.LRUCache): Optional cache from query text to its embedding.
+            Only the queries missing from it are vectorized.
+
+    Returns:
+        np.ndarray: A (num_queries, n_components) matrix of row-normalized query
+            embeddings.
+    """
+    if cache is None:
+        with timing.stage("vectorize"):
+            query_vecs = vectorizer.transform(queries)
+        with timing.stage("project"):
+            return normalize_rows(svd_model.transform(query_vecs))
+
+    cached = [cache.get(query) for query in queries]
+    missing = list(dict.fromkeys(q for q, e in zip(queries, cached) if e is None))
+    if missing:
+        embedded = embed_queries(missing, vectorizer, svd_model)
+        for query, row in zip(missing, embedded):
+            # A copy, as a row view would keep the whole batch alive while the
+            # cache only counts the row
+            embedding = row.copy()
+            embedding.flags.writeable = False
+            cache.put(query, embedding)
+        new = dict(zip(missing, embedded))
+        cached = [new[q] if e is None else e for q, e in zip(queries, cached)]
+    return np.stack(cached)
 
 
-def get_sim_scores(top_recipes, cosine_scores_all, num_queries):
+def score_queries(query_svds, svd):
     """
-    Modifies the scores dictionary to include a score for every query for each recipe.
-    If a recipe does not have a score for a particular query, it is assumed to be zero.
+    Computes the cosine similarity between every query and every recipe with one
+    matrix product.
+
+    Args:
+        query_svds (np.ndarray): Row-normalized query embeddings.
+        svd (np.ndarray): Row-normalized recipe embeddings.
+
+    Returns:
+        np.ndarray: A (num_queries, num_recipes) matrix of cosine similarity scores.
     """
-    # Get recipe IDs from top recipes
-    top_ids = {recipe_id for recipe_id, _ in top_recipes}
-    # Initialize dictionary to store scores with a list containing zeros initially for each query
-    scores = {recipe_id: [0] * num_queries for recipe_id in top_ids}
+    # Match the precision of svd so it is never upcast into a temporary copy
+    return query_svds.astype(svd.dtype, copy=False) @ svd.T
 
-    for query_index, s in enumerate(cosine_scores_all):
-        for recipe_id, score in s:
-            if recipe_id in top_ids:
-                # Replace the zero at the query index with the actual score
-                scores[recipe_id][query_index] = score
 
-    return scores
+def top_k(scores, k, mask=None):
+    """
+    Selects the indices of the k highest scores in decreasing order of score,
+    without sorting the whole array.
+
+    Args:
+        scores (np.ndarray): 1D array of scores.
+        k (int): Number of indices to return.
+        mask (np.ndarray): Optional boolean array; only indices where the mask
+            is True can be returned.
+
+    Returns:
+        np.ndarray: The indices of the top k scores.
+    """
+    if mask is not None:
+        candidates = np.flatnonzero(mask)
+        return candidates[top_k(scores[candidates], k)]
+
+    k = min(k, len(scores))
+    if k == 0:
+        return np.empty(0, dtype=np.intp)
+    if k < len(scores):
+        # Every index tied with the k-th score is kept, so that the ties at the
+        # cut are broken like the others
+        kth = -np.partition(-scores, k - 1)[k - 1]
+        top = np.flatnonzero(scores >= kth)
+    else:
+        top = np.arange(len(scores))
+    # Ties are broken by corpus order, like a stable sort over the full corpus
+    order = np.lexsort((top, -scores[top]))
+    return top[order[:k]]
+
+
+def common_recipes(cosine_scores_all, k=10, mask=None, strategy="sum"):
+    """
+    Gets the top k most common recipes from the cosine similarity scores of
+    all queries.
+
+    Sum, least misery and average without misery scores are aggregated over
+    the whole corpus in one vectorized pass, which is cheaper than the partition
+    of every member's list that the threshold algorithm starts with. Borda
+    points take a sort of every member's list, so Borda goes through
+    aggregation.threshold_top_k, which sorts each list once and stops once the
+    top k is certain.
+
+    Args:
+        cosine_scores_all (np.ndarray): A (num_queries, num_recipes) matrix of
+            cosine similarity scores.
+        k (int): Number of recipes to return.
+        mask (np.ndarray): Optional boolean array of recipes that may be returned.
+        strategy (str): How the scores of the queries are combined, one of
+            aggregation.STRATEGIES.
+
+    Returns:
+        np.ndarray: The row indices of the top k recipes by group score.
+    """
+    if strategy == "borda":
+        return aggregation.threshold_top_k(cosine_scores_all, k, strategy, mask)
+    return top_k(aggregation.aggregate(strategy, cosine_scores_all), k, mask)
+
+
+def get_sim_scores(top_recipes, cosine_scores_all, recipe_ids, rows=None):
+    """
+    Gets the score of every query for each of the top recipes.
+
+    Args:
+        top_recipes (np.ndarray): Column indices of the top recipes in
+            cosine_scores_all.
+        cosine_scores_all (np.ndarray): A (num_queries, num_recipes) matrix of
+            cosine similarity scores.
+        recipe_ids (list): The recipe ID of every row of the SVD matrix.
+        rows (np.ndarray): The SVD row of every column of cosine_scores_all, if
+            it only holds the scores of a subset of the recipes.
+
+    Returns:
+        dict: Recipe ID to a list with the score of each query.
+    """
+    scores = cosine_scores_all[:, top_recipes].T.tolist()
+    top_rows = top_recipes if rows is None else rows[top_recipes]
+    return {recipe_ids[i]: s for i, s in zip(top_rows.tolist(), scores)}
 
 
 def algorithm(
@@ -54,73 +167,238 @@ def algorithm(
     vectorizer,
     svd_model,
     svd,
+    recipe_ids=None,
+    restriction_index=None,
+    ann_index=None,
+    embedding_cache=None,
+    quantized=None,
+    strategy="sum",
+    filter_columns=None,
+    limits=None,
+    lexical=None,
+    k=10,
 ):
     """
-    Runs cosine similarity for each query and then calculates the most common
-    recipes from the results.
+    Scores every query against every recipe in one batch and then calculates
+    the most common recipes from the results.
 
     Args:
         queries (list): List of input queries to search for.
-        inverted_index (dict): The inverted index of the dataset.
-        idf (dict): The IDF of the dataset.
-        recipe_norms (dict): The euclidean norm of each recipe in the dataset.
+        dietary_restrictions (dict): Restriction name to whether it is requested.
+        id_to_recipe (dict): Recipe ID to recipe, in SVD row order.
+        vectorizer (TfidfVectorizer): The fitted TF-IDF vectorizer.
+        svd_model (TruncatedSVD): The fitted SVD model.
+        svd (np.ndarray): Row-normalized SVD embedding of every recipe, see
+            normalize_rows.
+        recipe_ids (list): The recipe ID of every row of svd. Built from
+            id_to_recipe if not given.
+        restriction_index (np.ndarray): The restriction bitmask of every row of
+            svd, see restrictions.build_restriction_index. Built from id_to_recipe
+            if not given.
+        ann_index (ann.IVFIndex): Optional approximate nearest neighbour index
+            over svd. When given, only the rows in the lists it probes are
+            scored.
+        embedding_cache (lru.LRUCache): Optional cache from query text to its
+            embedding, see embed_queries.
+        quantized (quantize.Int8Embeddings): Optional int8 copy of svd. When
+            given, the group is scored against it and only its best
+            quantized.rerank * k candidates are scored against svd.
+        strategy (str): How the scores of the queries are combined into the
+            group score, one of aggregation.STRATEGIES.
+        filter_columns (dict): The minutes and rating of every row of svd, see
+            filters.build_filter_columns, and the tombstoned rows. Required with
+            limits.
+        limits (dict): Optional time and rating limits, see filters.filter_mask.
+            They are applied together with the dietary restrictions.
+        lexical (lexical.LexicalIndex): Optional postings of the recipe terms.
+            When given, the score of each query is fused with its lexical score,
+            see LexicalIndex.fuse. Ranking the sum of the lexical scores alone
+            skips the SVD scan, see LexicalIndex.top_k. Otherwise, with
+            ann_index or quantized, only the union of their candidates and the
+            lexical top k is scored. Without either, every row is scored, which
+            SearchEngine only allows on small corpora.
+        k (int): Number of recipes to return.
+
+    Returns:
+        tuple: A list of (recipe_id, 0) tuples for the top k recipes in common for
+            all queries, and a dict from each of those recipe IDs to the score of
+            each query.
+    """
+    if not queries:
+        return [], {}
+    if recipe_ids is None:
+        recipe_ids = list(id_to_recipe.keys())
+
+    query_svds = embed_queries(queries, vectorizer, svd_model, embedding_cache)
+
+    with timing.stage("restrictions"):
+        if restriction_index is None:
+            restriction_index = restrictions.build_restriction_index(
+                id_to_recipe, recipe_ids
+            )
+        # Recipes that break a restriction are dropped before ranking
+        mask = restrictions.restriction_mask(restriction_index, dietary_restrictions)
+        if filter_columns is not None:
+            mask = filters.combine_masks(
+                mask, filters.filter_mask(filter_columns, limits or {})
+            )
+
+    if lexical is not None and lexical.weight == 1 and strategy == "sum":
+        # The group score is the lexical score of the merged query terms
+        with timing.stage("lexical"):
+            rows, _ = lexical.top_k(*lexical.group_query(queries), k, mask)
+            cosine_scores = lexical.fuse(
+                queries, np.zeros((len(queries), len(rows)), dtype=np.float32), rows
+            )
+        with timing.stage("top_k"):
+            top_recipes = common_recipes(cosine_scores, k, strategy=strategy)
+    elif (ann_index is None and quantized is None) or strategy != "sum":
+        # Exhaustive: with nothing to find the SVD candidates, every row is
+        # scored, also when fused with the lexical scores. The candidates below
+        # are only complete for sum, the other strategies (and Borda points,
+        # which count every row) are scored over every row too
+        rows = None
+        with timing.stage("score"):
+            if lexical is not None and lexical.weight == 1:
+                cosine_scores = np.zeros((len(queries), len(svd)), dtype=np.float32)
+            else:
+                cosine_scores = score_queries(query_svds, svd)
+        if lexical is not None:
+            with timing.stage("lexical"):
+                cosine_scores = lexical.fuse(queries, cosine_scores)
+        with timing.stage("top_k"):
+            top_recipes = common_recipes(cosine_scores, k, mask, strategy)
+    else:
+        # The group score is a sum of dot products, so the candidates are found
+        # with the sum of the query embeddings
+        if ann_index is not None:
+            with timing.stage("ann_probe"):
+                rows = ann_index.candidates(query_svds.sum(axis=0), k, mask)
+        else:
+            with timing.stage("quantized_scan"):
+                rows = quantized.candidates(
+                    query_svds.sum(axis=0), quantized.rerank * k, mask
+                )
+        if lexical is not None:
+            # Recipes with an exact match may be far from the query in the SVD
+            # space, so the lexical top k are candidates too
+            with timing.stage("lexical"):
+                lexical_rows, _ = lexical.top_k(*lexical.group_query(queries), k, mask)
+                rows = np.union1d(rows, lexical_rows)
+        with timing.stage("score"):
+            cosine_scores = score_queries(query_svds, svd[rows])
+        if lexical is not None:
+            with timing.stage("lexical"):
+                cosine_scores = lexical.fuse(queries, cosine_scores, rows)
+        with timing.stage("top_k"):
+            top_recipes = common_recipes(cosine_scores, k, strategy=strategy)
+
+    with timing.stage("sim_scores"):
+        top_rows = top_recipes if rows is None else rows[top_recipes]
+        return [(recipe_ids[i], 0) for i in top_rows.tolist()], get_sim_scores(
+            top_recipes, cosine_scores, recipe_ids, rows
+        )
+
+
+def algorithm_batch(
+    groups,
+    id_to_recipe,
+    vectorizer,
+    svd_model,
+    svd,
+    recipe_ids=None,
+    restriction_index=None,
+    embedding_cache=None,
+    filter_columns=None,
+    k=10,
+    max_scores=2**26,
+):
+    """
+    Runs algorithm for many groups at once. The distinct queries of every group
+    are embedded in one batch and scored with one matrix product, split into
+    products of at most max_scores scores to bound memory.
+
+    Args:
+        groups (list): (queries, dietary_restrictions, strategy, limits) tuples,
+            see algorithm.
+        id_to_recipe (dict): Recipe ID to recipe, in SVD row order.
+        vectorizer (TfidfVectorizer): The fitted TF-IDF vectorizer.
+        svd_model (TruncatedSVD): The fitted SVD model.
+        svd (np.ndarray): Row-normalized SVD embedding of every recipe.
+        recipe_ids (list): The recipe ID of every row of svd.
+        restriction_index (np.ndarray): The restriction bitmask of every row of
+            svd.
+        embedding_cache (lru.LRUCache): Optional cache from query text to its
+            embedding, see embed_queries.
+        filter_columns (dict): The minutes and rating of every row of svd, and
+            the tombstoned rows. Required if a group has limits.
+        k (int): Number of recipes to return per group.
+        max_scores (int): Maximum size of a single score matrix.
 
     Returns:
-        list: The top 10 recipes in common for all queries.
-    """
-
-    def cos_sim(query):
-        query_vec = vectorizer.transform([query])
-        query_svd = svd_model.transform(query_vec)
-
-        sim_scores = cosine_similarity(query_svd, svd)
-
-        ids = list(id_to_recipe.keys())
-
-        results = [(ids[i], sim_scores[0][i]) for i in range(len(sim_scores[0]))]
-        return results
-
-    # Run cosine similarity for each query
-    cosine_scores = [cos_sim(query) for query in queries]
-
-    top_recipes = common_recipes(cosine_scores)
-    # Filter out recipes based on dietary restrictions
-    top_recipes_filtered = []
-    for recipe_id, _ in top_recipes:
-        recipe = id_to_recipe[str(recipe_id)]
-        # These two lines break the code
-        # if iso_to_min(recipe["total_time"]) > time_limit:
-        #     continue
-        if (
-            dietary_restrictions["vegetarian"]
-            and not recipe["dietary_restrictions"]["vegetarian"]
-        ):
-            continue
-        if (
-            dietary_restrictions["vegan"]
-            and not recipe["dietary_restrictions"]["vegan"]
-        ):
-            continue
-        if (
-            dietary_restrictions["gluten_free"]
-            and not recipe["dietary_restrictions"]["gluten_free"]
-        ):
-            continue
-        if (
-            dietary_restrictions["dairy_free"]
-            and not recipe["dietary_restrictions"]["dairy_free"]
-        ):
-            continue
-        if (
-            dietary_restrictions["nut_free"]
-            and not recipe["dietary_restrictions"]["nut_free"]
-        ):
-            continue
-        top_recipes_filtered.append((recipe_id, 0))
-
-    num_queries = len(queries)
-
-    # Get the top 10 most common recipes from the cosine similarity scores
-    return top_recipes_filtered[:10], get_sim_scores(
-        top_recipes, cosine_scores, num_queries
-    )
+        list: The result of algorithm for each group, in order.
+    """
+    if recipe_ids is None:
+        recipe_ids = list(id_to_recipe.keys())
+    if restriction_index is None:
+        restriction_index = restrictions.build_restriction_index(
+            id_to_recipe, recipe_ids
+        )
+
+    # Query text to its row in the batch, shared by every group that has it
+    rows = {}
+    for queries, *_ in groups:
+        for query in queries:
+            rows.setdefault(query, len(rows))
+    if not rows:
+        return [([], {}) for _ in groups]
+    query_svds = embed_queries(list(rows), vectorizer, svd_model, embedding_cache)
+
+    masks = {}
+    results = []
+    chunk_rows = max(1, max_scores // max(1, len(svd)))
+    start = 0
+    while start < len(groups):
+        # Takes as many groups as fit in one score matrix, and at least one
+        end, chunk = start, {}
+        while end < len(groups):
+            new = [q for q in dict.fromkeys(groups[end][0]) if q not in chunk]
+            if chunk and len(chunk) + len(new) > chunk_rows:
+                break
+            for query in new:
+                chunk[query] = len(chunk)
+            end += 1
+
+        with timing.stage("score"):
+            chunk_scores = score_queries(query_svds[[rows[q] for q in chunk]], svd)
+
+        for queries, dietary_restrictions, strategy, limits in groups[start:end]:
+            if not queries:
+                results.append(([], {}))
+                continue
+            key = (
+                restrictions.restriction_bits(dietary_restrictions),
+                filters.limits_key(limits),
+            )
+            if key not in masks:
+                with timing.stage("restrictions"):
+                    masks[key] = restrictions.restriction_mask(
+                        restriction_index, dietary_restrictions
+                    )
+                    if filter_columns is not None:
+                        masks[key] = filters.combine_masks(
+                            masks[key],
+                            filters.filter_mask(filter_columns, limits or {}),
+                        )
+            cosine_scores = chunk_scores[[chunk[q] for q in queries]]
+            with timing.stage("top_k"):
+                top_recipes = common_recipes(cosine_scores, k, masks[key], strategy)
+            with timing.stage("sim_scores"):
+                results.append(
+                    (
+                        [(recipe_ids[i], 0) for i in top_recipes.tolist()],
+                        get_sim_scores(top_recipes, cosine_scores, recipe_ids),
+                    )
+                )
+        start = end
+    return results
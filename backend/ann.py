@@ -0,0 +1,247 @@
+import argparse
+import json
+import os
+import time
+
+import algorithm
+import artifacts
+import numpy as np
+
+IVF_CENTROIDS_FILE = "ivf_centroids.f32"
+IVF_ORDER_FILE = "ivf_order.i64"
+IVF_OFFSETS_FILE = "ivf_offsets.i64"
+
+
+class IVFIndex(object):
+    """
+    An inverted file index over row-normalized embeddings. Every row is assigned
+    to its closest k-means centroid; a search only scores the rows of the lists
+    whose centroids are closest to the query.
+    """
+
+    def __init__(self, centroids, order, offsets, n_probe=8):
+        """
+        Args:
+            centroids (np.ndarray): A (n_lists, n_components) matrix of unit
+                length centroids.
+            order (np.ndarray): Every row index, grouped by list.
+            offsets (np.ndarray): List i holds order[offsets[i]:offsets[i + 1]].
+            n_probe (int): Default number of lists scanned per query.
+        """
+        self.centroids = centroids
+        self.order = order
+        self.offsets = offsets
+        self.n_probe = n_probe
+
+    @property
+    def n_lists(self):
+        return len(self.centroids)
+
+    def candidates(self, query, k, mask=None, n_probe=None):
+        """
+        Finds the rows to score for a query. More lists are probed if fewer than
+        k rows pass the mask.
+
+        Args:
+            query (np.ndarray): The query embedding. For a group, the sum of the
+                member embeddings, since the group score is a sum of dot products.
+            k (int): Minimum number of candidates wanted.
+            mask (np.ndarray): Optional boolean array of rows that may be returned.
+            n_probe (int): Number of lists to scan, defaults to self.n_probe.
+
+        Returns:
+            np.ndarray: The candidate row indices, in increasing order.
+        """
+        n_probe = min(n_probe or self.n_probe, self.n_lists)
+        ranked_lists = np.argsort(-(self.centroids @ query.astype(np.float32)))
+        while True:
+            lists = ranked_lists[:n_probe]
+            rows = np.concatenate(
+                [self.order[self.offsets[i] : self.offsets[i + 1]] for i in lists]
+            )
+            if mask is not None:
+                rows = rows[mask[rows]]
+            if len(rows) >= k or n_probe == self.n_lists:
+                return np.sort(rows)
+            n_probe = min(2 * n_probe, self.n_lists)
+
+    def add(self, embeddings, first_row):
+        """
+        Assigns new rows to the closest of the existing centroids, without
+        clustering again.
+
+        Args:
+            embeddings (np.ndarray): The row-normalized embeddings of the new rows.
+            first_row (int): The row index of the first of them.
+
+        Returns:
+            IVFIndex: The index over the old and the new rows.
+        """
+        old_lists = np.repeat(np.arange(self.n_lists), np.diff(self.offsets))
+        labels = np.concatenate([old_lists, assign(embeddings, self.centroids)])
+        rows = np.concatenate(
+            [self.order, np.arange(first_row, first_row + len(embeddings))]
+        )
+        offsets = np.zeros(self.n_lists + 1, dtype=np.int64)
+        np.cumsum(np.bincount(labels, minlength=self.n_lists), out=offsets[1:])
+        order = rows[np.argsort(labels, kind="stable")]
+        return IVFIndex(self.centroids, order, offsets, self.n_probe)
+
+    def save(self, path):
+        """
+        Writes the index into a bundle directory.
+        """
+        self.centroids.astype(np.float32).tofile(os.path.join(path, IVF_CENTROIDS_FILE))
+        self.order.astype(np.int64).tofile(os.path.join(path, IVF_ORDER_FILE))
+        self.offsets.astype(np.int64).tofile(os.path.join(path, IVF_OFFSETS_FILE))
+
+    @classmethod
+    def load(cls, path, n_components, n_probe=8):
+        """
+        Loads an index saved into a bundle directory, or returns None if the
+        bundle has no index.
+        """
+        if not os.path.exists(os.path.join(path, IVF_CENTROIDS_FILE)):
+            return None
+        centroids = np.fromfile(os.path.join(path, IVF_CENTROIDS_FILE), np.float32)
+        order = np.memmap(os.path.join(path, IVF_ORDER_FILE), np.int64, mode="r")
+        offsets = np.fromfile(os.path.join(path, IVF_OFFSETS_FILE), np.int64)
+        return cls(centroids.reshape(-1, n_components), order, offsets, n_probe)
+
+
+def assign(embeddings, centroids, batch_size=65536):
+    """
+    Assigns every row to the centroid with the highest dot product, in batches
+    to bound memory.
+    """
+    labels = np.empty(len(embeddings), dtype=np.int64)
+    for start in range(0, len(embeddings), batch_size):
+        batch = embeddings[start : start + batch_size]
+        labels[start : start + batch_size] = np.argmax(batch @ centroids.T, axis=1)
+    return labels
+
+
+def build_ivf(
+    embeddings, n_lists=None, iterations=10, sample_size=None, seed=0, n_probe=8
+):
+    """
+    Clusters row-normalized embeddings with spherical k-means and builds an
+    IVFIndex from the clusters.
+
+    Args:
+        embeddings (np.ndarray): The row-normalized embedding matrix.
+        n_lists (int): Number of lists, defaults to about sqrt(num rows).
+        iterations (int): Number of k-means iterations.
+        sample_size (int): Number of rows k-means is trained on, defaults to
+            256 per list. Every row is then assigned to its closest centroid.
+        seed (int): Seed for the initial centroids and the training sample.
+        n_probe (int): Default number of lists scanned per query.
+
+    Returns:
+        IVFIndex: The index.
+    """
+    rng = np.random.default_rng(seed)
+    num_rows = len(embeddings)
+    if n_lists is None:
+        n_lists = max(1, int(np.sqrt(num_rows)))
+    n_lists = min(n_lists, num_rows)
+    sample_size = min(sample_size or 256 * n_lists, num_rows)
+
+    sample = np.asarray(
+        embeddings[np.sort(rng.choice(num_rows, sample_size, replace=False))],
+        dtype=np.float32,
+    )
+    centroids = sample[rng.choice(sample_size, n_lists, replace=False)]
+    for _ in range(iterations):
+        labels = assign(sample, centroids)
+        sums = np.zeros_like(centroids)
+        np.add.at(sums, labels, sample)
+        # Empty lists are reseeded with random rows
+        empty = np.flatnonzero(np.bincount(labels, minlength=n_lists) == 0)
+        sums[empty] = sample[rng.choice(sample_size, len(empty), replace=False)]
+        norms = np.linalg.norm(sums, axis=1, keepdims=True)
+        norms[norms == 0] = 1
+        centroids = sums / norms
+
+    labels = assign(embeddings, centroids)
+    order = np.argsort(labels, kind="stable")
+    offsets = np.zeros(n_lists + 1, dtype=np.int64)
+    np.cumsum(np.bincount(labels, minlength=n_lists), out=offsets[1:])
+    return IVFIndex(centroids, order, offsets, n_probe)
+
+
+def recall_report(
+    index, embeddings, k=10, probes=(1, 2, 4, 8, 16, 32), n_queries=200, seed=0
+):
+    """
+    Measures recall@k and latency of the index against exact search, for every
+    probe count. Queries are groups of one to six perturbed recipe embeddings.
+
+    Args:
+        index (IVFIndex): The index to evaluate.
+        embeddings (np.ndarray): The row-normalized embedding matrix.
+        k (int): Number of results per query.
+        probes (tuple): The probe counts to evaluate.
+        n_queries (int): Number of queries.
+        seed (int): Seed for the queries.
+
+    Returns:
+        list: A dict with the probe count, mean recall@k, mean latency in
+            milliseconds and mean number of candidates, for every probe count.
+    """
+    rng = np.random.default_rng(seed)
+    queries = []
+    for _ in range(n_queries):
+        members = embeddings[rng.choice(len(embeddings), rng.integers(1, 7))]
+        members = members + rng.normal(0, 0.05, members.shape)
+        queries.append(algorithm.normalize_rows(members).sum(axis=0))
+
+    exact = [
+        set(algorithm.top_k(embeddings @ q.astype(embeddings.dtype), k).tolist())
+        for q in queries
+    ]
+
+    report = []
+    for n_probe in probes:
+        recall, elapsed, candidates = 0, 0, 0
+        for query, expected in zip(queries, exact):
+            start = time.perf_counter()
+            rows = index.candidates(query, k, n_probe=n_probe)
+            scores = embeddings[rows] @ query.astype(embeddings.dtype)
+            found = rows[algorithm.top_k(scores, k)]
+            elapsed += time.perf_counter() - start
+            recall += len(expected.intersection(found.tolist())) / len(expected)
+            candidates += len(rows)
+        report.append(
+            {
+                "n_probe": n_probe,
+                f"recall@{k}": recall / n_queries,
+                "mean_ms": 1000 * elapsed / n_queries,
+                "mean_candidates": candidates / n_queries,
+            }
+        )
+    return report
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Builds an IVF index for a bundle and reports its recall"
+    )
+    parser.add_argument("bundle", help="path to the bundle directory")
+    parser.add_argument("--lists", type=int, default=None)
+    parser.add_argument("--iterations", type=int, default=10)
+    parser.add_argument("--probes", default="1,2,4,8,16,32")
+    parser.add_argument("--k", type=int, default=10)
+    parser.add_argument("--queries", type=int, default=200)
+    parser.add_argument("--save", action="store_true", help="save into the bundle")
+    args = parser.parse_args()
+
+    bundle = artifacts.load_bundle(args.bundle)
+    start = time.perf_counter()
+    index = build_ivf(bundle.svd, args.lists, args.iterations)
+    print(f"built {index.n_lists} lists in {time.perf_counter() - start:.1f}s")
+    probes = [int(p) for p in args.probes.split(",")]
+    for row in recall_report(index, bundle.svd, args.k, probes, args.queries):
+        print(json.dumps(row))
+    if args.save:
+        index.save(args.bundle)
@@ -1,14 +1,32 @@
+import startup  # isort: skip
+
+# The heavy imports, timed one by one for the startup report. The imports below
+# find them loaded.
+startup.import_modules(["numpy", "scipy.sparse", "fuzzywuzzy.fuzz", "flask", "engine"])
+
+import base64
+import binascii
 import json
+import math
 import os
-import pickle
 
-import algorithm
-import pandas as pd
-from flask import Flask, jsonify, render_template, request
+import aggregation
+import filters
+import restrictions
+import suggest
+import timing
+from engine import DETAIL_FIELDS, PAGE_SIZE, ReleaseWatcher, SearchEngine, Warmup
+from flask import (
+    Blueprint,
+    Flask,
+    Response,
+    abort,
+    current_app,
+    jsonify,
+    render_template,
+    request,
+)
 from flask_cors import CORS
-from fuzzywuzzy import fuzz, process
-from sklearn.decomposition import TruncatedSVD
-from sklearn.feature_extraction.text import TfidfVectorizer
 
 # ROOT_PATH for linking with all your files.
 # Feel free to use a config.py or settings.py with a global export variable
@@ -17,110 +35,323 @@ os.environ["ROOT_PATH"] = os.path.abspath(os.path.join("..", os.curdir))
 # Get the directory of the current script
 current_directory = os.path.dirname(os.path.abspath(__file__))
 
-# Specify the path to the JSON file relative to the current script
-json_file_path = os.path.join(current_directory, "data/id_to_recipe.json")
-
-# Assuming your JSON data is stored in a file named 'init.json'
-with open(json_file_path, "r") as file:
-    data = json.load(file)
-recipes_list = list(data.values())
-df = pd.json_normalize(recipes_list)
+routes = Blueprint("routes", __name__)
 
+MAX_BATCH_GROUPS = int(os.environ.get("MAX_BATCH_GROUPS", 1000))
 
-app = Flask(__name__)
-CORS(app)
+# Seconds between checks for a newly published release, off when 0
+RELOAD_INTERVAL = float(os.environ.get("RELOAD_INTERVAL", 0))
 
-id_to_recipe_path = os.path.join(current_directory, "data/id_to_recipe.json")
-inverted_index_path = os.path.join(current_directory, "data/inv_idx.json")
 
+def create_app(data_directory=None):
+    """
+    Creates the app and loads the search artifacts into it. `flask run` calls it
+    on startup, and gunicorn.conf.py calls it once in the gunicorn master so
+    that every worker forks from the loaded artifacts.
 
-with open(id_to_recipe_path, "r") as f:
-    id_to_recipe = json.load(f)
+    Args:
+        data_directory (str): The output directory of build_index.py. Defaults to
+            DATA_DIR, or else backend/data.
 
-with open(inverted_index_path, "r") as f:
-    inverted_index = json.load(f)
+    Returns:
+        Flask: The app.
+    """
+    if data_directory is None:
+        data_directory = os.environ.get(
+            "DATA_DIR", os.path.join(current_directory, "data")
+        )
 
+    app = Flask(__name__)
+    # Lets browser clients read the cursor of the next page
+    CORS(app, expose_headers=["X-Next-Cursor"])
+    app.extensions["search"] = SearchEngine(data_directory)
+    app.extensions["warmup"] = Warmup(app.extensions)
+    if RELOAD_INTERVAL:
+        app.extensions["release_watcher"] = ReleaseWatcher(
+            data_directory, app.extensions, RELOAD_INTERVAL
+        )
+    app.register_blueprint(routes)
+    startup.finish()
+    return app
 
-### SVD PREPROCESSING ###
-with open("data/svd_model.pkl", "rb") as f:
-    svd_model = pickle.load(f)
 
-with open("data/tfidf_vectorizer.pkl", "rb") as f:
-    vectorizer = pickle.load(f)
+def search_engine():
+    """
+    Returns the engine of the current release. A request should only call it
+    once, so that it is served from one release even if a new one is swapped in
+    meanwhile.
+    """
+    return current_app.extensions["search"]
 
-with open("data/svd.pkl", "rb") as f:
-    svd = pickle.load(f)
 
-#######################
+@routes.before_app_request
+def start_timing():
+    # Requests that match no route, e.g. 404s, share one label
+    rule = request.url_rule
+    timing.start_request(rule.rule if rule is not None else "unmatched")
 
 
-def cosine_search(queries, dietary_restrictions):
-    # Preprocess each query to find the closest match in the corpus
-    preprocessed_queries = []
-    for query in queries:
-        tokens = query.split()
-        corrected_tokens = []
-        for token in tokens:
-            if token not in inverted_index:
-                corrected_token = process.extractOne(
-                    token, inverted_index.keys(), scorer=fuzz.ratio
-                )
-                if corrected_token and corrected_token[1] >= 80:
-                    corrected_tokens.append(corrected_token[0])
-            else:
-                corrected_tokens.append(token)
-        preprocessed_queries.append(" ".join(corrected_tokens))
+@routes.before_app_request
+def watch_releases():
+    # Started on the first request rather than in create_app, so that it runs in
+    # every gunicorn worker rather than in the master
+    if "release_watcher" in current_app.extensions:
+        current_app.extensions["release_watcher"].start()
 
-    top_10_recipes, sim_scores = algorithm.algorithm(
-        preprocessed_queries,
-        dietary_restrictions,
-        id_to_recipe,
-        vectorizer,
-        svd_model,
-        svd,
-    )
 
-    top_10_ids = [recipe_id for recipe_id, _ in top_10_recipes]
+@routes.before_app_request
+def warm_up():
+    # Also started by gunicorn.conf.py as soon as a worker forks, so this only
+    # starts it under `flask run`, on the first request
+    current_app.extensions["warmup"].start()
 
-    details = [
-        {
-            "name": id_to_recipe[str(recipe_id)]["name"],
-            "instructions": id_to_recipe[str(recipe_id)]["instructions"],
-            "aggregated_rating": id_to_recipe[str(recipe_id)]["aggregated_rating"],
-            "image": id_to_recipe[str(recipe_id)]["image"],
-            "Url": id_to_recipe[str(recipe_id)]["Url"],
-            "total_time": id_to_recipe[str(recipe_id)].get("total_time", "PT0M"),
-            "similarity_scores": sim_scores[recipe_id],
-        }
-        for recipe_id in top_10_ids
-        if str(recipe_id) in id_to_recipe
-    ]
 
-    return details
+@routes.after_app_request
+def report_timing(response):
+    durations = timing.finish_request()
+    if durations:
+        response.headers["Server-Timing"] = timing.server_timing(durations)
+    return response
 
 
-@app.route("/")
+@routes.route("/")
 def home():
     return render_template("base.html", title="sample html")
 
 
-@app.route("/recipes")
-def recipes_search():
-    texts = [
-        request.args.get(f"title{i}")
-        for i in range(len(request.args))
-        if f"title{i}" in request.args
-    ]
+def parse_group(args, where=""):
+    """
+    Reads the query texts, dietary restrictions, aggregation strategy and
+    limits of a group from the parameters of a request: title0, title1, ...,
+    e.g. vegan=true, aggregation, one of aggregation.STRATEGIES, the time limits
+    in minutes max_time, max_cook_time and max_prep_time, and min_rating.
+
+    Args:
+        args (dict): The query string of a request, or one group of a batch.
+        where (str): Prefix of the error messages, e.g. the index of the group
+            in a batch.
+
+    Returns:
+        tuple: The list of texts, the dict of restrictions, the strategy and
+            the dict of limits that are set.
+    """
+    # The groups of a batch are JSON, so their values can be of any type
+    for name, value in args.items():
+        if not isinstance(value, (str, int, float, bool, type(None))):
+            abort(400, f"{where}{name} must be a string, number or boolean")
+    texts = [args.get(f"title{i}") for i in range(len(args)) if f"title{i}" in args]
+    for i, text in enumerate(texts):
+        if not isinstance(text, str):
+            abort(400, f"{where}title{i} must be a string")
     dietary_restrictions = {
-        "vegetarian": request.args.get("vegetarian") == "true",
-        "vegan": request.args.get("vegan") == "true",
-        "gluten_free": request.args.get("gluten_free") == "true",
-        "dairy_free": request.args.get("dairy_free") == "true",
-        "nut_free": request.args.get("nut_free") == "true",
+        # Not `in (True, "true")`, which also matches 1
+        name: args.get(name) is True or args.get(name) == "true"
+        for name in restrictions.RESTRICTIONS
     }
-    search_results = cosine_search(texts, dietary_restrictions)
-    return jsonify(search_results)
+    strategy = args.get("aggregation") or "sum"
+    if strategy not in aggregation.STRATEGIES:
+        abort(
+            400,
+            f"{where}aggregation must be one of {', '.join(aggregation.STRATEGIES)}",
+        )
+
+    limits = {}
+    parsers = dict(dict.fromkeys(filters.TIME_LIMITS, parse_minutes))
+    parsers["min_rating"] = parse_rating
+    for name, parse in parsers.items():
+        if args.get(name) in (None, ""):
+            continue
+        try:
+            limits[name] = parse(args.get(name))
+        except (TypeError, ValueError, OverflowError):
+            message = (
+                "a whole number of minutes"
+                if name in filters.TIME_LIMITS
+                else "a number"
+            )
+            abort(400, f"{where}{name} must be {message}")
+    return texts, dietary_restrictions, strategy, limits
+
+
+def parse_minutes(value):
+    """
+    Reads a time limit, a whole number of minutes. JSON numbers such as 10.7,
+    Infinity or 1e400 are rejected rather than truncated.
+    """
+    if isinstance(value, bool):
+        raise TypeError(value)
+    if isinstance(value, float):
+        if not value.is_integer():
+            raise ValueError(value)
+        return int(value)
+    return int(value)
+
+
+def parse_rating(value):
+    """
+    Reads a finite rating.
+    """
+    if isinstance(value, bool):
+        raise TypeError(value)
+    rating = float(value)
+    if not math.isfinite(rating):
+        raise ValueError(value)
+    return rating
+
+
+def parse_fields(value):
+    """
+    Reads the fields= parameter, a comma separated subset of DETAIL_FIELDS.
+    Every field is returned when it is missing.
+    """
+    if not value:
+        return DETAIL_FIELDS
+    fields = tuple(dict.fromkeys(field.strip() for field in value.split(",")))
+    unknown = [field for field in fields if field not in DETAIL_FIELDS]
+    if unknown:
+        abort(400, f"Unknown fields: {', '.join(unknown)}")
+    return fields
+
+
+def encode_cursor(offset):
+    return base64.urlsafe_b64encode(str(offset).encode()).decode()
+
+
+def decode_cursor(cursor):
+    try:
+        offset = int(base64.urlsafe_b64decode(cursor.encode()))
+    except (binascii.Error, ValueError):
+        abort(400, "Invalid cursor")
+    if offset < 0:
+        abort(400, "Invalid cursor")
+    return offset
+
+
+@routes.route("/recipes")
+def recipes_search():
+    """
+    Searches for a group. Optional parameters:
+
+        fields: Comma separated fields of each result, e.g. name,image,Url.
+        limit: Number of results, 10 by default.
+        aggregation: How the scores of the members are combined: sum (the
+            default), least_misery, average_without_misery or borda.
+        max_time, max_cook_time, max_prep_time: Time limits in minutes. Recipes
+            without the duration are left out.
+        min_rating: Minimum rating. Unrated recipes are left out.
+        cursor: The X-Next-Cursor header of the previous page. The next page is
+            read from the ranking of the first one, without scoring again.
+        format: ndjson to stream one result per line.
+    """
+    engine = search_engine()
+    fields = parse_fields(request.args.get("fields"))
+    offset = 0
+    if "cursor" in request.args:
+        offset = decode_cursor(request.args["cursor"])
+    try:
+        limit = int(request.args.get("limit", PAGE_SIZE))
+    except ValueError:
+        abort(400, "limit must be an integer")
+    if not 0 < limit <= engine.ranking_depth:
+        abort(400, f"limit must be between 1 and {engine.ranking_depth}")
+
+    page, num_ranked = engine.search(*parse_group(request.args), offset, limit)
+    headers = {}
+    if offset + limit < num_ranked:
+        headers["X-Next-Cursor"] = encode_cursor(offset + limit)
+
+    if (
+        request.args.get("format") == "ndjson"
+        or request.accept_mimetypes.best == "application/x-ndjson"
+    ):
+
+        def stream():
+            for detail in engine.stream_recipe_details(page, fields):
+                yield json.dumps(detail)
+                yield "\n"
+
+        return Response(stream(), mimetype="application/x-ndjson", headers=headers)
+
+    search_results = engine.recipe_details(page, fields)
+    with timing.stage("serialize"):
+        response = jsonify(search_results)
+    response.headers.update(headers)
+    return response
+
+
+@routes.route("/recipes/batch", methods=["POST"])
+def recipes_batch():
+    """
+    Searches for many groups in one call. The body is a JSON object with a list
+    of groups, each in the form of the parameters of /recipes:
+
+        {"groups": [{"title0": "pasta", "title1": "curry", "vegan": true}, ...]}
+
+    The response lists the results of each group, in order.
+    """
+    body = request.get_json(silent=True)
+    groups = body.get("groups") if isinstance(body, dict) else None
+    if not isinstance(groups, list) or not all(isinstance(g, dict) for g in groups):
+        abort(400, "Expected a JSON object with a list of groups")
+    if len(groups) > MAX_BATCH_GROUPS:
+        abort(413, f"A batch holds at most {MAX_BATCH_GROUPS} groups")
+    search_results = search_engine().cosine_search_batch(
+        [parse_group(group, f"groups[{i}]: ") for i, group in enumerate(groups)]
+    )
+    with timing.stage("serialize"):
+        return jsonify(search_results)
+
+
+@routes.route("/suggest")
+def suggest_terms():
+    """
+    Completes the prefix= parameter to ingredient terms and recipe names, most
+    frequent first. limit sets the number of suggestions, 10 by default.
+    """
+    try:
+        limit = int(request.args.get("limit", 10))
+    except ValueError:
+        abort(400, "limit must be an integer")
+    if not 0 < limit <= suggest.MAX_SUGGESTIONS:
+        abort(400, f"limit must be between 1 and {suggest.MAX_SUGGESTIONS}")
+    return jsonify(
+        search_engine().suggester.suggest(request.args.get("prefix", ""), limit)
+    )
+
+
+@routes.route("/restrictions/counts")
+def restriction_counts():
+    engine = search_engine()
+    live = engine.filter_columns["live"]
+    restriction_index = engine.restriction_index
+    if live is not None:
+        restriction_index = restriction_index[live]
+    return jsonify(restrictions.restriction_counts(restriction_index))
+
+
+@routes.route("/ready")
+def ready():
+    """
+    Readiness probe: 200 once the artifacts are loaded and this process has
+    warmed up, 503 until then. The body reports how long each startup stage
+    took.
+    """
+    warmup = current_app.extensions["warmup"]
+    return (
+        jsonify({"ready": warmup.ready, "startup": startup.report()}),
+        200 if warmup.ready else 503,
+    )
+
+
+@routes.route("/cache/stats")
+def cache_stats():
+    return jsonify(search_engine().cache_stats())
+
+
+@routes.route("/metrics")
+def metrics():
+    return Response(timing.render_prometheus(), mimetype="text/plain; version=0.0.4")
 
 
-if "DB_NAME" not in os.environ:
-    app.run(debug=True, host="0.0.0.0", port=5000)
+if __name__ == "__main__":
+    create_app().run(debug=True, host="0.0.0.0", port=5000)
@@ -0,0 +1,336 @@
+import json
+import os
+import re
+import shutil
+import sys
+import time
+
+import algorithm
+import numpy as np
+from scipy import sparse
+
+# Bump whenever the layout of the files below changes
+BUNDLE_VERSION = 1
+
+MANIFEST_FILE = "manifest.json"
+EMBEDDINGS_FILE = "embeddings.f32"
+PROJECTION_FILE = "projection.f32"
+IDF_FILE = "idf.f32"
+VOCAB_FILE = "vocab.bin"
+VOCAB_OFFSETS_FILE = "vocab_offsets.u32"
+RECIPE_IDS_FILE = "recipe_ids.i64"
+TOMBSTONES_FILE = "tombstones.i64"
+
+
+class TfidfWeights(object):
+    """
+    Rebuilds the transform of a fitted word-unigram TfidfVectorizer from its
+    vocabulary and idf weights, so queries can be vectorized without unpickling
+    sklearn objects. Stop words never need to be removed explicitly since they
+    are not part of the fitted vocabulary.
+    """
+
+    def __init__(self, vocabulary, idf, token_pattern, lowercase, norm, sublinear_tf):
+        self.vocabulary_ = vocabulary
+        self.idf_ = idf
+        self.token_pattern = re.compile(token_pattern)
+        self.lowercase = lowercase
+        self.norm = norm
+        self.sublinear_tf = sublinear_tf
+
+    def transform(self, texts):
+        """
+        Vectorizes the input texts like TfidfVectorizer.transform.
+
+        Args:
+            texts (list): The texts to vectorize.
+
+        Returns:
+            sparse.csr_matrix: A (len(texts), vocabulary size) TF-IDF matrix.
+        """
+        indptr, indices, data = [0], [], []
+        for text in texts:
+            if self.lowercase:
+                text = text.lower()
+            counts = {}
+            for token in self.token_pattern.findall(text):
+                column = self.vocabulary_.get(token)
+                if column is not None:
+                    counts[column] = counts.get(column, 0) + 1
+
+            columns = np.array(sorted(counts), dtype=np.int32)
+            weights = np.array([counts[c] for c in columns.tolist()], dtype=np.float64)
+            if self.sublinear_tf:
+                weights = np.log(weights) + 1
+            if self.idf_ is not None:
+                weights *= self.idf_[columns]
+            if self.norm is not None and len(weights):
+                if self.norm == "l1":
+                    weights /= np.abs(weights).sum()
+                else:
+                    weights /= np.sqrt((weights**2).sum())
+
+            indices.append(columns)
+            data.append(weights)
+            indptr.append(indptr[-1] + len(columns))
+
+        return sparse.csr_matrix(
+            (
+                np.concatenate(data) if data else np.empty(0),
+                np.concatenate(indices) if indices else np.empty(0, np.int32),
+                indptr,
+            ),
+            shape=(len(texts), len(self.vocabulary_)),
+        )
+
+
+class Projection(object):
+    """
+    Projects TF-IDF vectors onto the components of a fitted TruncatedSVD, like
+    TruncatedSVD.transform.
+    """
+
+    def __init__(self, components_t):
+        # Stored as (vocabulary size, n_components) so a query only reads the
+        # rows of the terms it contains
+        self.components_t = components_t
+
+    def transform(self, X):
+        return np.asarray(X @ self.components_t)
+
+
+class Bundle(object):
+    """
+    The artifacts needed to serve queries, loaded from a bundle directory.
+    Arrays are memory mapped read-only, so they are paged in lazily and shared
+    between processes that load the same bundle.
+    """
+
+    def __init__(
+        self, path, manifest, svd, recipe_ids, vectorizer, svd_model, tombstones=None
+    ):
+        self.path = path
+        self.manifest = manifest
+        self.svd = svd
+        self.recipe_ids = recipe_ids
+        self.vectorizer = vectorizer
+        self.svd_model = svd_model
+        # Rows of deleted recipes, which are kept until the next full build
+        if tombstones is None:
+            tombstones = np.empty(0, dtype=np.int64)
+        self.tombstones = tombstones
+
+
+def write_bundle(path, vectorizer, svd_model, svd, recipe_ids):
+    """
+    Writes the serving artifacts into a bundle directory.
+
+    Args:
+        path (str): The bundle directory, created if it does not exist.
+        vectorizer (TfidfVectorizer): The fitted TF-IDF vectorizer.
+        svd_model (TruncatedSVD): The fitted SVD model.
+        svd (np.ndarray): The SVD embedding of every recipe. It is stored row
+            normalized.
+        recipe_ids (list): The recipe ID of every row of svd.
+
+    Returns:
+        dict: The manifest of the bundle.
+    """
+    if (
+        vectorizer.analyzer != "word"
+        or tuple(vectorizer.ngram_range) != (1, 1)
+        or vectorizer.preprocessor is not None
+        or vectorizer.tokenizer is not None
+        or vectorizer.strip_accents is not None
+    ):
+        raise ValueError("Only word unigram vectorizers can be bundled")
+    if len(recipe_ids) != len(svd):
+        raise ValueError("recipe_ids must have one ID per row of svd")
+
+    os.makedirs(path, exist_ok=True)
+
+    embeddings = algorithm.normalize_rows(svd).astype(np.float32)
+    embeddings.tofile(os.path.join(path, EMBEDDINGS_FILE))
+    svd_model.components_.T.astype(np.float32).tofile(
+        os.path.join(path, PROJECTION_FILE)
+    )
+    if vectorizer.use_idf:
+        vectorizer.idf_.astype(np.float32).tofile(os.path.join(path, IDF_FILE))
+
+    # Terms in column order, as one UTF-8 blob with the offset of every term
+    terms = sorted(vectorizer.vocabulary_, key=vectorizer.vocabulary_.get)
+    encoded = [term.encode("utf-8") for term in terms]
+    offsets = np.zeros(len(encoded) + 1, dtype=np.uint32)
+    np.cumsum([len(term) for term in encoded], out=offsets[1:])
+    offsets.tofile(os.path.join(path, VOCAB_OFFSETS_FILE))
+    with open(os.path.join(path, VOCAB_FILE), "wb") as f:
+        f.write(b"".join(encoded))
+
+    np.asarray([int(i) for i in recipe_ids], dtype=np.int64).tofile(
+        os.path.join(path, RECIPE_IDS_FILE)
+    )
+
+    manifest = {
+        "version": BUNDLE_VERSION,
+        "created": int(time.time()),
+        "num_recipes": int(embeddings.shape[0]),
+        "n_components": int(embeddings.shape[1]),
+        "vocabulary_size": len(terms),
+        "vectorizer": {
+            "token_pattern": vectorizer.token_pattern,
+            "lowercase": bool(vectorizer.lowercase),
+            "norm": vectorizer.norm,
+            "use_idf": bool(vectorizer.use_idf),
+            "sublinear_tf": bool(vectorizer.sublinear_tf),
+        },
+    }
+    with open(os.path.join(path, MANIFEST_FILE), "w") as f:
+        json.dump(manifest, f, indent=2)
+    return manifest
+
+
+def append_bundle(bundle, path, embeddings, recipe_ids, tombstones):
+    """
+    Writes a bundle with the rows of another bundle followed by new rows, for
+    recipes folded into its fitted vectorizer and SVD. The vocabulary and
+    projection files are hard linked where possible, since they do not change.
+
+    Args:
+        bundle (Bundle): The bundle to add to.
+        path (str): The new bundle directory, created if it does not exist.
+        embeddings (np.ndarray): The SVD embedding of every new recipe. It is
+            stored row normalized.
+        recipe_ids (list): The recipe ID of every new row.
+        tombstones (np.ndarray): The rows of deleted recipes, old or new.
+
+    Returns:
+        dict: The manifest of the new bundle.
+    """
+    if len(recipe_ids) != len(embeddings):
+        raise ValueError("recipe_ids must have one ID per row of embeddings")
+    n_components = bundle.manifest["n_components"]
+    if embeddings.shape[1] != n_components:
+        raise ValueError(f"embeddings must have {n_components} components")
+
+    os.makedirs(path, exist_ok=True)
+    for name in (PROJECTION_FILE, IDF_FILE, VOCAB_FILE, VOCAB_OFFSETS_FILE):
+        source = os.path.join(bundle.path, name)
+        if not os.path.exists(source):
+            continue
+        try:
+            os.link(source, os.path.join(path, name))
+        except OSError:
+            shutil.copyfile(source, os.path.join(path, name))
+
+    # The old rows are copied rather than linked, since the new rows are
+    # appended to the same files
+    new_rows = {
+        EMBEDDINGS_FILE: algorithm.normalize_rows(embeddings).astype(np.float32),
+        RECIPE_IDS_FILE: np.asarray([int(i) for i in recipe_ids], dtype=np.int64),
+    }
+    for name, rows in new_rows.items():
+        shutil.copyfile(os.path.join(bundle.path, name), os.path.join(path, name))
+        with open(os.path.join(path, name), "ab") as f:
+            rows.tofile(f)
+
+    np.unique(np.asarray(tombstones, dtype=np.int64)).tofile(
+        os.path.join(path, TOMBSTONES_FILE)
+    )
+
+    manifest = dict(
+        bundle.manifest,
+        created=int(time.time()),
+        num_recipes=bundle.manifest["num_recipes"] + len(recipe_ids),
+        # Lets a server holding the parent reuse what it built for its rows
+        parent={
+            "created": bundle.manifest["created"],
+            "num_recipes": bundle.manifest["num_recipes"],
+        },
+    )
+    with open(os.path.join(path, MANIFEST_FILE), "w") as f:
+        json.dump(manifest, f, indent=2)
+    return manifest
+
+
+def load_bundle(path):
+    """
+    Loads a bundle directory written by write_bundle.
+
+    Args:
+        path (str): The bundle directory.
+
+    Returns:
+        Bundle: The loaded artifacts.
+    """
+    with open(os.path.join(path, MANIFEST_FILE), "r") as f:
+        manifest = json.load(f)
+    if manifest["version"] != BUNDLE_VERSION:
+        raise ValueError(
+            f"Bundle {path} has version {manifest['version']}, "
+            f"expected {BUNDLE_VERSION}"
+        )
+
+    num_recipes = manifest["num_recipes"]
+    n_components = manifest["n_components"]
+    vocabulary_size = manifest["vocabulary_size"]
+
+    def mmap(name, dtype, shape):
+        return np.memmap(os.path.join(path, name), dtype=dtype, mode="r", shape=shape)
+
+    svd = mmap(EMBEDDINGS_FILE, np.float32, (num_recipes, n_components))
+    components_t = mmap(PROJECTION_FILE, np.float32, (vocabulary_size, n_components))
+
+    settings = manifest["vectorizer"]
+    idf = None
+    if settings["use_idf"]:
+        idf = np.fromfile(os.path.join(path, IDF_FILE), dtype=np.float32)
+
+    offsets = np.fromfile(os.path.join(path, VOCAB_OFFSETS_FILE), np.uint32).tolist()
+    with open(os.path.join(path, VOCAB_FILE), "rb") as f:
+        blob = f.read()
+    vocabulary = {
+        blob[start:end].decode("utf-8"): column
+        for column, (start, end) in enumerate(zip(offsets, offsets[1:]))
+    }
+
+    recipe_ids = np.fromfile(os.path.join(path, RECIPE_IDS_FILE), np.int64).tolist()
+    recipe_ids = [str(i) for i in recipe_ids]
+
+    tombstones = None
+    if os.path.exists(os.path.join(path, TOMBSTONES_FILE)):
+        tombstones = np.fromfile(os.path.join(path, TOMBSTONES_FILE), np.int64)
+
+    vectorizer = TfidfWeights(
+        vocabulary,
+        idf,
+        settings["token_pattern"],
+        settings["lowercase"],
+        settings["norm"],
+        settings["sublinear_tf"],
+    )
+    return Bundle(
+        path,
+        manifest,
+        svd,
+        recipe_ids,
+        vectorizer,
+        Projection(components_t),
+        tombstones,
+    )
+
+
+if __name__ == "__main__":
+    # Converts the pickled artifacts of build_svd.ipynb into a bundle:
+    #   python artifacts.py <data dir> <bundle dir>
+    import pickle
+
+    data_dir, bundle_dir = sys.argv[1:3]
+    with open(os.path.join(data_dir, "tfidf_vectorizer.pkl"), "rb") as f:
+        vectorizer = pickle.load(f)
+    with open(os.path.join(data_dir, "svd_model.pkl"), "rb") as f:
+        svd_model = pickle.load(f)
+    with open(os.path.join(data_dir, "svd.pkl"), "rb") as f:
+        svd = pickle.load(f)
+    with open(os.path.join(data_dir, "id_to_recipe.json"), "r") as f:
+        recipe_ids = list(json.load(f).keys())
+    print(json.dumps(write_bundle(bundle_dir, vectorizer, svd_model, svd, recipe_ids)))
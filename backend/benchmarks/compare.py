@@ -0,0 +1,42 @@
+"""
+Compares two result files written by benchmarks.run:
+
+    python -m benchmarks.compare bench-before.json bench-after.json
+"""
+
+import json
+import sys
+
+
+def compare(before, after, metric="p50_ms"):
+    """
+    Pairs up the benchmarks of two result files.
+
+    Args:
+        before (dict): The baseline results.
+        after (dict): The new results.
+        metric (str): The latency metric to compare.
+
+    Returns:
+        list: (name, before, after, after / before) tuples for every benchmark
+            with the metric in both files.
+    """
+    rows = []
+    for name, result in after["results"].items():
+        baseline = before["results"].get(name, {})
+        if metric in result and metric in baseline:
+            ratio = result[metric] / baseline[metric] if baseline[metric] else None
+            rows.append((name, baseline[metric], result[metric], ratio))
+    return rows
+
+
+if __name__ == "__main__":
+    with open(sys.argv[1]) as f:
+        before = json.load(f)
+    with open(sys.argv[2]) as f:
+        after = json.load(f)
+    metric = sys.argv[3] if len(sys.argv) > 3 else "p50_ms"
+    print(f"{before['commit']} -> {after['commit']} ({metric})")
+    for name, old, new, ratio in compare(before, after, metric):
+        change = f"{ratio:6.2f}x" if ratio is not None else "     -"
+        print(f"{name:32s} {old:10.3f} {new:10.3f} {change}")
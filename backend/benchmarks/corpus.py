@@ -0,0 +1,360 @@
+"""
+Generates synthetic recipes in the schema of the food.com recipes.csv dump,
+with the R-style c("...") vectors, ISO-8601 durations and "NA" values that
+data_processing and recipe_parser expect.
+
+    python -m benchmarks.corpus 100000 data/synthetic_recipes.csv
+"""
+
+import csv
+import random
+import sys
+
+COLUMNS = [
+    "RecipeId",
+    "Name",
+    "AuthorId",
+    "AuthorName",
+    "CookTime",
+    "PrepTime",
+    "TotalTime",
+    "DatePublished",
+    "Description",
+    "Images",
+    "RecipeCategory",
+    "Keywords",
+    "RecipeIngredientQuantities",
+    "RecipeIngredientParts",
+    "AggregatedRating",
+    "ReviewCount",
+    "Calories",
+    "FatContent",
+    "SaturatedFatContent",
+    "CholesterolContent",
+    "SodiumContent",
+    "CarbohydrateContent",
+    "FiberContent",
+    "SugarContent",
+    "ProteinContent",
+    "RecipeServings",
+    "RecipeYield",
+    "RecipeInstructions",
+]
+
+INGREDIENTS = """
+chicken breast
+ground beef
+pork chops
+salmon fillet
+shrimp
+bacon
+ham
+turkey
+sausage
+tofu
+chickpeas
+black beans
+lentils
+eggs
+milk
+butter
+sour cream
+cheddar cheese
+parmesan cheese
+mozzarella cheese
+heavy cream
+yogurt
+honey
+all-purpose flour
+whole wheat flour
+bread crumbs
+spaghetti
+egg noodles
+rice
+quinoa
+oats
+cornmeal
+potatoes
+sweet potatoes
+carrots
+celery
+onion
+garlic
+ginger
+tomatoes
+tomato paste
+bell pepper
+jalapeno
+spinach
+kale
+broccoli
+cauliflower
+zucchini
+mushrooms
+corn
+peas
+green beans
+avocado
+lemon juice
+lime juice
+orange zest
+olive oil
+vegetable oil
+sesame oil
+soy sauce
+fish sauce
+vinegar
+sugar
+brown sugar
+maple syrup
+vanilla extract
+baking powder
+baking soda
+salt
+black pepper
+cumin
+paprika
+chili powder
+cinnamon
+nutmeg
+oregano
+basil
+thyme
+rosemary
+parsley
+cilantro
+almonds
+walnuts
+pecans
+peanut butter
+cashews
+coconut milk
+chocolate chips
+cocoa
+raisins
+apples
+bananas
+blueberries
+strawberries
+tahini
+""".strip().splitlines()
+
+CATEGORIES = """
+Dessert
+Chicken
+Beverages
+Vegetable
+Breads
+Breakfast
+Lunch/Snacks
+One Dish Meal
+Pork
+Meat
+Potato
+Pie
+Sauces
+Chicken Breast
+Quick Breads
+Cheese
+Rice
+Yeast Breads
+""".strip().splitlines()
+
+KEYWORDS = """
+Easy
+< 60 Mins
+< 30 Mins
+< 15 Mins
+< 4 Hours
+Healthy
+Kid Friendly
+Low Cholesterol
+Low Protein
+Vegan
+Weeknight
+Inexpensive
+Oven
+Stove Top
+Beginner Cook
+Winter
+Summer
+European
+Asian
+Mexican
+Christmas
+Free Of...
+Meat
+Poultry
+Fruit
+Vegetable
+Lactose Free
+Egg Free
+""".strip().splitlines()
+
+DISHES = """
+Casserole
+Stir Fry
+Soup
+Stew
+Salad
+Curry
+Bake
+Pie
+Tacos
+Pasta
+Muffins
+Bread
+Cookies
+Cake
+Skillet
+Sandwiches
+Chili
+Risotto
+Pancakes
+Smoothie
+Roast
+""".strip().splitlines()
+
+ADJECTIVES = """
+Easy
+Spicy
+Creamy
+Grandma's
+Quick
+Healthy
+Classic
+Crispy
+Slow Cooker
+Lemony
+Garlic
+Honey
+Smoky
+Best Ever
+""".strip().splitlines()
+
+VERBS = [
+    "Preheat the oven to 350 degrees F.",
+    "Combine {a} and {b} in a large bowl.",
+    "Heat the {a} in a skillet over medium heat.",
+    "Add {b} and cook until tender, about 5 minutes.",
+    "Stir in the {a} and season with salt and pepper.",
+    "Pour into a greased baking dish and bake for 30 minutes.",
+    "Whisk {a} with {b} until smooth.",
+    "Simmer for 20 minutes, stirring occasionally.",
+    "Serve warm, garnished with {b}.",
+    'Top with "extra" {a} if you like.',
+]
+
+
+def r_vector(values):
+    """
+    Formats a list of strings as an R character vector, like the food.com dump.
+    """
+    if not values:
+        return "character(0)"
+    return "c(" + ", ".join('"' + v.replace('"', '\\"') + '"' for v in values) + ")"
+
+
+def duration(minutes):
+    """
+    Formats a number of minutes as an ISO-8601 duration, e.g. PT1H30M.
+    """
+    hours, minutes = divmod(minutes, 60)
+    if hours and minutes:
+        return f"PT{hours}H{minutes}M"
+    if hours:
+        return f"PT{hours}H"
+    return f"PT{minutes}M"
+
+
+def generate_recipes(n, seed=0):
+    """
+    Generates n synthetic recipes. The same seed always gives the same rows.
+
+    Args:
+        n (int): Number of recipes.
+        seed (int): Seed of the generator.
+
+    Yields:
+        dict: A recipe row keyed by the food.com column names.
+    """
+    rng = random.Random(seed)
+    # Ingredient popularity roughly follows a power law, like real recipes
+    weights = [1 / (rank + 1) ** 0.8 for rank in range(len(INGREDIENTS))]
+    for i in range(n):
+        ingredients = list(
+            dict.fromkeys(rng.choices(INGREDIENTS, weights, k=rng.randint(4, 14)))
+        )
+        main = rng.choice(ingredients[:3])
+        name = f"{rng.choice(ADJECTIVES)} {main.title()} {rng.choice(DISHES)}"
+        steps = [
+            rng.choice(VERBS).format(
+                a=rng.choice(ingredients), b=rng.choice(ingredients)
+            )
+            for _ in range(rng.randint(2, 9))
+        ]
+        prep, cook = rng.choice([5, 10, 15, 20, 30, 45]), rng.randint(0, 240)
+        rated = rng.random() < 0.6
+        year, month, day = (
+            rng.randint(1999, 2020),
+            rng.randint(1, 12),
+            rng.randint(1, 28),
+        )
+        published = f"{year}-{month:02d}-{day:02d}"
+        description = f"Make this {name.lower()} with {' and '.join(ingredients[:2])}. "
+        description += " ".join(rng.sample(VERBS, 2)).format(a=main, b=ingredients[-1])
+        images = [
+            f"https://img.sndimg.com/food/image/upload/{i}/{j}.jpg"
+            for j in range(rng.choice([0, 1, 1, 1, 2, 3]))
+        ]
+        yield {
+            "RecipeId": 38 + i,
+            "Name": name,
+            "AuthorId": rng.randint(1, 2_000_000),
+            "AuthorName": f"cook{rng.randint(1, 50_000)}",
+            "CookTime": duration(cook) if cook else "NA",
+            "PrepTime": duration(prep),
+            "TotalTime": duration(prep + cook),
+            "DatePublished": f"{published}T00:00:00Z",
+            "Description": description,
+            "Images": r_vector(images),
+            "RecipeCategory": rng.choice(CATEGORIES),
+            "Keywords": r_vector(rng.sample(KEYWORDS, rng.randint(0, 5))),
+            "RecipeIngredientQuantities": r_vector(
+                [
+                    rng.choice(["1", "2", "1/2", "3/4", "1 1/2", "NA"])
+                    for _ in ingredients
+                ]
+            ),
+            "RecipeIngredientParts": r_vector(ingredients),
+            "AggregatedRating": str(rng.choice([3, 3.5, 4, 4.5, 5])) if rated else "NA",
+            "ReviewCount": str(rng.randint(1, 300)) if rated else "NA",
+            "Calories": f"{rng.uniform(50, 900):.1f}",
+            "FatContent": f"{rng.uniform(0, 60):.1f}",
+            "SaturatedFatContent": f"{rng.uniform(0, 25):.1f}",
+            "CholesterolContent": f"{rng.uniform(0, 250):.1f}",
+            "SodiumContent": f"{rng.uniform(0, 2000):.1f}",
+            "CarbohydrateContent": f"{rng.uniform(0, 120):.1f}",
+            "FiberContent": f"{rng.uniform(0, 15):.1f}",
+            "SugarContent": f"{rng.uniform(0, 80):.1f}",
+            "ProteinContent": f"{rng.uniform(0, 70):.1f}",
+            "RecipeServings": str(rng.choice([1, 2, 4, 6, 8, 12])),
+            "RecipeYield": rng.choice(["NA", "1 loaf", "12 muffins", "4 cups"]),
+            "RecipeInstructions": r_vector(steps),
+        }
+
+
+def write_csv(path, n, seed=0):
+    """
+    Writes n synthetic recipes to a CSV file.
+    """
+    with open(path, "w", newline="") as f:
+        writer = csv.DictWriter(f, COLUMNS)
+        writer.writeheader()
+        writer.writerows(generate_recipes(n, seed))
+
+
+if __name__ == "__main__":
+    write_csv(
+        sys.argv[2], int(sys.argv[1]), int(sys.argv[3]) if len(sys.argv) > 3 else 0
+    )
@@ -0,0 +1,411 @@
+"""
+Times the search path and the index builders on a synthetic corpus and writes
+p50/p95/p99 latencies and peak memory to a JSON file. Run from the backend
+folder and compare two result files with benchmarks.compare:
+
+    python -m benchmarks.run --size 10000 --out bench-10k.json
+"""
+
+import argparse
+import csv
+import json
+import os
+import platform
+import random
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+
+import numpy as np
+
+from benchmarks import corpus
+
+
+def measure(fn, repeat, warmup=1):
+    """
+    Times repeated calls of fn, then measures the peak memory it allocates in
+    one more call with tracemalloc, which is kept off while timing.
+
+    Args:
+        fn (function): The function to time, called without arguments.
+        repeat (int): Number of timed calls.
+        warmup (int): Number of untimed calls first.
+
+    Returns:
+        dict: Latency percentiles in milliseconds and peak memory in megabytes.
+    """
+    for _ in range(warmup):
+        fn()
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        times.append(time.perf_counter() - start)
+
+    tracemalloc.start()
+    fn()
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    times = np.array(times) * 1000
+    return {
+        "runs": repeat,
+        "mean_ms": float(times.mean()),
+        "p50_ms": float(np.percentile(times, 50)),
+        "p95_ms": float(np.percentile(times, 95)),
+        "p99_ms": float(np.percentile(times, 99)),
+        "peak_mb": peak / 2**20,
+    }
+
+
+def cycle(items):
+    """
+    Returns a function that returns the next item on every call, so each timed
+    call gets a different input.
+    """
+    iterator = iter(items)
+
+    def next_item():
+        nonlocal iterator
+        try:
+            return next(iterator)
+        except StopIteration:
+            iterator = iter(items)
+            return next(iterator)
+
+    return next_item
+
+
+def make_groups(n, seed):
+    """
+    Makes n groups of one to six queries from the synthetic vocabulary, with a
+    misspelled word in about one query out of five.
+    """
+    rng = random.Random(seed)
+    groups = []
+    for _ in range(n):
+        group = []
+        for _ in range(rng.randint(1, 6)):
+            words = rng.sample(corpus.INGREDIENTS, rng.randint(1, 3))
+            words += rng.sample(corpus.DISHES, rng.randint(0, 1))
+            query = " ".join(words).lower()
+            if rng.random() < 0.2:
+                i = rng.randrange(len(query))
+                query = query[:i] + query[i + 1 :]
+            group.append(query)
+        groups.append(group)
+    return groups
+
+
+def git_commit():
+    try:
+        return subprocess.check_output(
+            ["git", "rev-parse", "HEAD"], stderr=subprocess.DEVNULL, text=True
+        ).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--size", type=int, default=10000, help="number of recipes")
+    parser.add_argument("--repeat", type=int, default=200)
+    parser.add_argument("--build-repeat", type=int, default=3)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--workers", type=int, default=None)
+    parser.add_argument("--components", type=int, default=150)
+    parser.add_argument("--workdir", default=None, help="keep the corpus here")
+    parser.add_argument("--out", default="bench.json")
+    args = parser.parse_args(argv)
+
+    workdir = args.workdir or tempfile.mkdtemp(prefix="platedate-bench-")
+    os.makedirs(workdir, exist_ok=True)
+    csv_path = os.path.join(workdir, f"recipes-{args.size}-{args.seed}.csv")
+    if not os.path.exists(csv_path):
+        corpus.write_csv(csv_path, args.size, args.seed)
+
+    import aggregation
+    import algorithm
+    import build_index
+    import data_processing
+    import filters
+    import lexical
+    import quantize
+    import recipe_parser
+    import restrictions
+
+    results = {}
+
+    def report(name, result):
+        results[name] = result
+        print(
+            f"{name:32s} p50 {result['p50_ms']:9.3f} ms  "
+            f"p99 {result['p99_ms']:9.3f} ms  peak {result['peak_mb']:7.1f} MB",
+            file=sys.stderr,
+        )
+
+    # Index builders, on the recipes the build keeps
+    with open(csv_path, "r", newline="") as f:
+        recipes = [
+            r
+            for r in csv.DictReader(f)
+            if r["Images"] != "character(0)" and r["AggregatedRating"] != "NA"
+        ]
+    report(
+        "dietary_restrictions_check",
+        measure(
+            lambda recipe=cycle(recipes): recipe_parser.dietary_restrictions_check(
+                recipe()
+            ),
+            args.repeat * 10,
+        ),
+    )
+    report(
+        "parse_recipe",
+        measure(
+            lambda recipe=cycle(recipes): recipe_parser.parse_recipe(recipe()),
+            args.repeat * 10,
+        ),
+    )
+    # Everything the build does per recipe, see build_index.parse_chunk
+    result = measure(lambda: build_index.parse_chunk(recipes), args.build_repeat, 0)
+    result["per_recipe_us"] = result["p50_ms"] * 1000 / len(recipes)
+    report("parse_chunk", result)
+    print(f"parse_chunk {result['per_recipe_us']:.1f} us per recipe", file=sys.stderr)
+    report(
+        "build_inverted_index",
+        measure(
+            lambda: data_processing.build_inverted_index(recipes), args.build_repeat, 0
+        ),
+    )
+    report(
+        "build_id_to_recipe",
+        measure(
+            lambda: data_processing.build_id_to_recipe(recipes), args.build_repeat, 0
+        ),
+    )
+    inverted_index = data_processing.build_inverted_index(recipes)
+    report(
+        "build_idf",
+        measure(
+            lambda: data_processing.build_idf(inverted_index, len(recipes)),
+            args.build_repeat,
+            0,
+        ),
+    )
+    idf = data_processing.build_idf(inverted_index, len(recipes))
+    report(
+        "build_recipe_norms",
+        measure(
+            lambda: data_processing.build_recipe_norms(inverted_index, idf),
+            args.build_repeat,
+            0,
+        ),
+    )
+
+    # The whole offline build, uncached
+    out = os.path.join(workdir, f"out-{args.size}-{args.seed}")
+    build_args = [csv_path, "--out", out, "--no-cache", "--seed", str(args.seed)]
+    build_args += ["--components", str(args.components)]
+    if args.workers:
+        build_args += ["--workers", str(args.workers)]
+    start = time.perf_counter()
+    build_index.main(build_args)
+    results["build_index"] = {"runs": 1, "seconds": time.perf_counter() - start}
+
+    # The search path, served from the build
+    import app
+
+    search = app.create_app(out).extensions["search"]
+
+    groups = make_groups(500, args.seed)
+    corrected = [[search.correct_query(q) for q in group] for group in groups]
+    no_restrictions = {name: False for name in restrictions.RESTRICTIONS}
+    strict = dict(no_restrictions, vegan=True, gluten_free=True, nut_free=True)
+
+    def cosine_search(group=cycle(groups)):
+        search.result_cache.clear()
+        search.embedding_cache.clear()
+        search.cosine_search(group(), no_restrictions)
+
+    report("cosine_search", measure(cosine_search, args.repeat))
+    batch = [(group, no_restrictions, "sum", {}) for group in groups[:100]]
+
+    def cosine_search_batch():
+        search.result_cache.clear()
+        search.embedding_cache.clear()
+        search.cosine_search_batch(batch)
+
+    report("cosine_search_batch_100", measure(cosine_search_batch, args.build_repeat))
+    report(
+        "cosine_search_cached",
+        measure(lambda: search.cosine_search(groups[0], no_restrictions), args.repeat),
+    )
+
+    def run_algorithm(
+        dietary_restrictions,
+        group=cycle(corrected),
+        quantized=None,
+        limits=None,
+        lexical_index=None,
+    ):
+        return algorithm.algorithm(
+            group(),
+            dietary_restrictions,
+            search.id_to_recipe,
+            search.vectorizer,
+            search.svd_model,
+            search.svd,
+            search.recipe_ids,
+            search.restriction_index,
+            quantized=quantized,
+            filter_columns=search.filter_columns,
+            limits=limits,
+            lexical=lexical_index,
+        )
+
+    report("algorithm", measure(lambda: run_algorithm(no_restrictions), args.repeat))
+    report(
+        "algorithm_strict_restrictions",
+        measure(lambda: run_algorithm(strict), args.repeat),
+    )
+    report(
+        "algorithm_max_time",
+        measure(
+            lambda: run_algorithm(no_restrictions, limits={"max_time": 45}),
+            args.repeat,
+        ),
+    )
+    report(
+        "build_filter_columns",
+        measure(
+            lambda: filters.build_filter_columns(
+                search.id_to_recipe, search.recipe_ids
+            ),
+            args.build_repeat,
+            0,
+        ),
+    )
+
+    # The int8 scan with full precision re-ranking, against exact search
+    quantized = quantize.quantize_int8(search.svd)
+    report(
+        "algorithm_int8",
+        measure(
+            lambda: run_algorithm(no_restrictions, quantized=quantized), args.repeat
+        ),
+    )
+    identical, max_error = 0, 0.0
+    for group in corrected:
+        exact = run_algorithm(no_restrictions, lambda: group)
+        approximate = run_algorithm(no_restrictions, lambda: group, quantized)
+        identical += exact[0] == approximate[0]
+        for recipe_id, scores in approximate[1].items():
+            if recipe_id in exact[1]:
+                max_error = max(
+                    max_error,
+                    max(abs(a - b) for a, b in zip(scores, exact[1][recipe_id])),
+                )
+    results["int8"] = {
+        "float32_mb": search.svd.nbytes / 2**20,
+        "int8_mb": quantized.nbytes / 2**20,
+        "rerank": quantized.rerank,
+        "identical_top_10": identical / len(corrected),
+        "max_score_error": max_error,
+        "agreement": quantize.agreement_report(quantized, search.svd),
+    }
+    print(
+        f"int8 embeddings {results['int8']['int8_mb']:.1f} MB "
+        f"(float32 {results['int8']['float32_mb']:.1f} MB), identical top 10 for "
+        f"{100 * results['int8']['identical_top_10']:.1f}% of the groups",
+        file=sys.stderr,
+    )
+
+    # Postings-based scoring, alone with MaxScore and fused with the SVD scores
+    with open(os.path.join(search.data_directory, "inv_idx.json"), "r") as f:
+        inverted_index = json.load(f)
+    report(
+        "build_lexical_index",
+        measure(
+            lambda: lexical.build_lexical_index(inverted_index, search.recipe_ids),
+            args.build_repeat,
+            0,
+        ),
+    )
+    for name, weight in [("algorithm_lexical", 1.0), ("algorithm_fused", 0.3)]:
+        lexical_index = lexical.build_lexical_index(
+            inverted_index, search.recipe_ids, weight=weight
+        )
+        report(
+            name,
+            measure(
+                lambda: run_algorithm(no_restrictions, lexical_index=lexical_index),
+                args.repeat,
+            ),
+        )
+
+    # Completion of the words of the queries as they are typed
+    prefixes = [
+        word[:length]
+        for group in groups
+        for query in group
+        for word in query.split()
+        for length in range(1, len(word) + 1)
+    ]
+    report(
+        "suggest",
+        measure(
+            lambda prefix=cycle(prefixes): search.suggester.suggest(prefix()),
+            args.repeat * 10,
+        ),
+    )
+
+    six = max(corrected, key=len)
+    cosine_scores = algorithm.score_queries(
+        algorithm.embed_queries(six, search.vectorizer, search.svd_model), search.svd
+    )
+    report(
+        "common_recipes",
+        measure(lambda: algorithm.common_recipes(cosine_scores), args.repeat),
+    )
+    for strategy in aggregation.STRATEGIES[1:]:
+        report(
+            f"common_recipes_{strategy}",
+            measure(
+                lambda: algorithm.common_recipes(cosine_scores, strategy=strategy),
+                args.repeat,
+            ),
+        )
+    top_recipes = algorithm.common_recipes(cosine_scores)
+    report(
+        "get_sim_scores",
+        measure(
+            lambda: algorithm.get_sim_scores(
+                top_recipes, cosine_scores, search.recipe_ids
+            ),
+            args.repeat,
+        ),
+    )
+
+    output = {
+        "commit": git_commit(),
+        "created": int(time.time()),
+        "size": args.size,
+        "num_recipes": len(search.recipe_ids),
+        "seed": args.seed,
+        "python": platform.python_version(),
+        "numpy": np.__version__,
+        "cpu_count": os.cpu_count(),
+        "max_rss_mb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+        "results": results,
+    }
+    with open(args.out, "w") as f:
+        json.dump(output, f, indent=2)
+    print(f"wrote {args.out}", file=sys.stderr)
+
+
+if __name__ == "__main__":
+    main()
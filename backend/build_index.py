@@ -0,0 +1,357 @@
+"""
+Builds every artifact the app serves from the food.com recipes CSV, replacing
+build_jsons.ipynb and build_svd.ipynb.
+
+    python build_index.py data/recipes.csv --out data --workers 8
+
+Each stage is cached under <out>/build_cache, keyed on its inputs and
+parameters, so e.g. changing --components only refits the SVD. The result is
+written to <out>/releases/<version> and published by atomically repointing the
+<out>/current symlink, which app.py loads from.
+"""
+
+import argparse
+import csv
+import hashlib
+import itertools
+import json
+import os
+import pickle
+import random
+import shutil
+import sys
+import time
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+
+import ann
+import artifacts
+import data_processing
+import quantize
+import recipe_parser
+from url_webscraping import url_builder
+
+# Bump a stage's version whenever its code changes, to invalidate its cache
+STAGE_VERSIONS = {"parse": 3, "weights": 1, "svd": 1}
+
+
+def log(message):
+    print(f"[{time.strftime('%H:%M:%S')}] {message}", file=sys.stderr)
+
+
+def read_chunks(csv_path, chunk_size, keep):
+    """
+    Streams the recipes CSV in chunks of rows that pass the keep filter.
+
+    Args:
+        csv_path (str): Path to the food.com recipes CSV.
+        chunk_size (int): Number of rows per chunk.
+        keep (function): Returns whether a row should be kept.
+
+    Yields:
+        list: A chunk of recipe rows.
+    """
+    with open(csv_path, "r", newline="") as f:
+        rows = filter(keep, csv.DictReader(f))
+        while True:
+            chunk = list(itertools.islice(rows, chunk_size))
+            if not chunk:
+                return
+            yield chunk
+
+
+def sample_chunks(chunks, sample, seed, chunk_size):
+    """
+    Reservoir samples a fixed number of recipes from a stream of chunks, keeping
+    their original order.
+    """
+    rng = random.Random(seed)
+    reservoir = []
+    for i, recipe in enumerate(itertools.chain.from_iterable(chunks)):
+        if i < sample:
+            reservoir.append((i, recipe))
+        else:
+            j = rng.randint(0, i)
+            if j < sample:
+                reservoir[j] = (i, recipe)
+    reservoir.sort(key=lambda x: x[0])
+    recipes = [recipe for _, recipe in reservoir]
+    for start in range(0, len(recipes), chunk_size):
+        yield recipes[start : start + chunk_size]
+
+
+def row_filter(require_image, require_rating):
+    """
+    Returns the filter of the CSV rows that are kept: by default only recipes
+    with an image and a rating.
+    """
+
+    def keep(recipe):
+        if require_image and recipe["Images"] == "character(0)":
+            return False
+        if require_rating and recipe["AggregatedRating"] == "NA":
+            return False
+        return True
+
+    return keep
+
+
+def parse_chunk(chunk):
+    """
+    Runs the per-recipe parsing of one chunk. Runs in a worker process. The R
+    vector fields of every recipe are decoded once, for both outputs.
+
+    Returns:
+        tuple: The id_to_recipe and inverted index of the chunk.
+    """
+    parsed = recipe_parser.parse_recipe_batch(chunk)
+    id_to_recipe = data_processing.build_id_to_recipe(chunk, parsed)
+    for recipe in chunk:
+        recipe_id = int(recipe["RecipeId"])
+        id_to_recipe[recipe_id]["Url"] = url_builder(recipe_id, recipe["Name"])
+    return id_to_recipe, data_processing.build_inverted_index(chunk, parsed)
+
+
+def ordered_map(executor, fn, iterable, window):
+    """
+    Like executor.map, but only keeps a window of tasks in flight so the input
+    is consumed lazily.
+    """
+    pending = deque()
+    for item in iterable:
+        pending.append(executor.submit(fn, item))
+        if len(pending) >= window:
+            yield pending.popleft().result()
+    while pending:
+        yield pending.popleft().result()
+
+
+class StageCache(object):
+    """
+    Pickles the output of each build stage under a key derived from the stage
+    version, its parameters and the keys of the stages it depends on.
+    """
+
+    def __init__(self, directory, enabled=True):
+        self.directory = directory
+        self.enabled = enabled
+        os.makedirs(directory, exist_ok=True)
+
+    def key(self, stage, params):
+        payload = json.dumps(
+            {"stage": stage, "version": STAGE_VERSIONS[stage], "params": params},
+            sort_keys=True,
+        )
+        return hashlib.sha256(payload.encode("utf-8")).hexdigest()[:16]
+
+    def run(self, stage, params, compute):
+        """
+        Returns the cached output of a stage, computing and caching it on a miss.
+
+        Returns:
+            tuple: The stage key and its output.
+        """
+        key = self.key(stage, params)
+        path = os.path.join(self.directory, f"{stage}-{key}.pkl")
+        if self.enabled and os.path.exists(path):
+            log(f"{stage}: cached ({key})")
+            with open(path, "rb") as f:
+                return key, pickle.load(f)
+
+        start = time.perf_counter()
+        output = compute()
+        log(f"{stage}: built in {time.perf_counter() - start:.1f}s ({key})")
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        with open(tmp_path, "wb") as f:
+            pickle.dump(output, f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp_path, path)
+        return key, output
+
+
+def parse_stage(args):
+    """
+    Streams and parses the CSV across a process pool, merging the per-chunk
+    outputs in input order.
+    """
+    keep = row_filter(args.require_image, args.require_rating)
+    chunks = read_chunks(args.csv, args.chunk_size, keep)
+    if args.sample:
+        chunks = sample_chunks(chunks, args.sample, args.seed, args.chunk_size)
+
+    id_to_recipe = {}
+    inverted_index = {}
+    with ProcessPoolExecutor(max_workers=args.workers) as executor:
+        window = 2 * (args.workers or os.cpu_count())
+        for chunk_recipes, chunk_index in ordered_map(
+            executor, parse_chunk, chunks, window
+        ):
+            id_to_recipe.update(chunk_recipes)
+            for token, postings in chunk_index.items():
+                inverted_index.setdefault(token, []).extend(postings)
+            log(f"parse: {len(id_to_recipe)} recipes")
+    return id_to_recipe, inverted_index
+
+
+def svd_stage(id_to_recipe, components, seed):
+    """
+    Fits the TF-IDF vectorizer and the truncated SVD on the recipe corpus.
+    """
+    from sklearn.decomposition import TruncatedSVD
+    from sklearn.feature_extraction.text import TfidfVectorizer
+
+    vectorizer = TfidfVectorizer(stop_words="english")
+    tfidf_matrix = vectorizer.fit_transform(data_processing.build_corpus(id_to_recipe))
+    svd_model = TruncatedSVD(n_components=components, random_state=seed)
+    svd = svd_model.fit_transform(tfidf_matrix)
+    return vectorizer, svd_model, svd
+
+
+def publish(out, version, write):
+    """
+    Writes a release into a temporary directory, moves it into place and then
+    atomically repoints the current symlink at it. When a release of the same
+    name exists, e.g. after two identical builds in the same second, a counter
+    is appended to the name.
+
+    Args:
+        out (str): The output directory.
+        version (str): The name of the release.
+        write (function): Writes the release files into the directory it is given.
+
+    Returns:
+        str: The path of the release.
+    """
+    releases = os.path.join(out, "releases")
+    tmp_release = os.path.join(releases, f".{version}.{os.getpid()}.tmp")
+    os.makedirs(releases, exist_ok=True)
+    shutil.rmtree(tmp_release, ignore_errors=True)
+    write(tmp_release)
+    name, attempt = version, 1
+    while True:
+        release = os.path.join(releases, name)
+        try:
+            # Fails when a release of that name exists, as releases are never
+            # empty
+            os.rename(tmp_release, release)
+            break
+        except OSError:
+            if not os.path.isdir(release):
+                raise
+            attempt += 1
+            name = f"{version}-{attempt}"
+
+    current = os.path.join(out, "current")
+    tmp_link = f"{current}.tmp"
+    if os.path.lexists(tmp_link):
+        os.remove(tmp_link)
+    os.symlink(os.path.relpath(release, out), tmp_link)
+    os.replace(tmp_link, current)
+    return release
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("csv", help="path to the food.com recipes CSV")
+    parser.add_argument("--out", default="data", help="output directory")
+    parser.add_argument("--workers", type=int, default=None)
+    parser.add_argument("--chunk-size", type=int, default=2000)
+    parser.add_argument(
+        "--sample", type=int, default=None, help="only keep this many recipes"
+    )
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--components", type=int, default=150)
+    parser.add_argument(
+        "--ann-lists",
+        type=int,
+        default=None,
+        help="also build an IVF index with this many lists into the bundle",
+    )
+    parser.add_argument(
+        "--int8",
+        action="store_true",
+        help="also write an int8 copy of the embeddings into the bundle",
+    )
+    parser.add_argument("--keep-imageless", dest="require_image", action="store_false")
+    parser.add_argument("--keep-unrated", dest="require_rating", action="store_false")
+    parser.add_argument("--no-cache", dest="cache", action="store_false")
+    args = parser.parse_args(argv)
+
+    cache = StageCache(os.path.join(args.out, "build_cache"), args.cache)
+    stat = os.stat(args.csv)
+    parse_key, (id_to_recipe, inverted_index) = cache.run(
+        "parse",
+        {
+            "csv": os.path.abspath(args.csv),
+            "size": stat.st_size,
+            "mtime": stat.st_mtime_ns,
+            "sample": args.sample,
+            "seed": args.seed if args.sample else None,
+            "require_image": args.require_image,
+            "require_rating": args.require_rating,
+        },
+        lambda: parse_stage(args),
+    )
+
+    def build_weights():
+        idf = data_processing.build_idf(inverted_index, len(id_to_recipe))
+        return idf, data_processing.build_recipe_norms(inverted_index, idf)
+
+    weights_key, (idf, recipe_norms) = cache.run(
+        "weights", {"parse": parse_key}, build_weights
+    )
+    svd_key, (vectorizer, svd_model, svd) = cache.run(
+        "svd",
+        {"parse": parse_key, "components": args.components, "seed": args.seed},
+        lambda: svd_stage(id_to_recipe, args.components, args.seed),
+    )
+
+    version = time.strftime("%Y%m%d-%H%M%S") + "-" + svd_key[:8]
+
+    def write(directory):
+        os.makedirs(directory)
+        for name, value in [
+            ("id_to_recipe.json", id_to_recipe),
+            ("inv_idx.json", inverted_index),
+            ("idf.json", idf),
+            ("recipe_norms.json", recipe_norms),
+        ]:
+            with open(os.path.join(directory, name), "w") as f:
+                json.dump(value, f)
+        bundle_directory = os.path.join(directory, "bundle")
+        artifacts.write_bundle(
+            bundle_directory,
+            vectorizer,
+            svd_model,
+            svd,
+            list(id_to_recipe.keys()),
+        )
+        if args.ann_lists or args.int8:
+            bundle = artifacts.load_bundle(bundle_directory)
+        if args.ann_lists:
+            ann.build_ivf(bundle.svd, args.ann_lists, seed=args.seed).save(
+                bundle_directory
+            )
+        if args.int8:
+            quantize.quantize_int8(bundle.svd).save(bundle_directory)
+        with open(os.path.join(directory, "build.json"), "w") as f:
+            json.dump(
+                {
+                    "version": version,
+                    "stages": {
+                        "parse": parse_key,
+                        "weights": weights_key,
+                        "svd": svd_key,
+                    },
+                    "num_recipes": len(id_to_recipe),
+                    "args": vars(args),
+                },
+                f,
+                indent=2,
+            )
+
+    release = publish(args.out, version, write)
+    log(f"published {release}")
+
+
+if __name__ == "__main__":
+    main()
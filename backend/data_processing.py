@@ -2,15 +2,17 @@ import recipe_parser as rp
 import re
 import numpy as np
 import recipe_parser
-from fuzzywuzzy import process, fuzz
 
 
-def tokenize(text, inverted_index):
+def tokenize(text, speller):
     """
     Tokenizes the input string into a list of words and removes any punctuation.
+    Words that are not in the vocabulary are spelling corrected.
 
     Args:
         text (str): The input string to tokenize.
+        speller (spelling.SpellingCorrector): The corrector built from the
+            vocabulary of the inverted index.
 
     Returns:
         list: The list of words from the input string with any punctuation removed.
@@ -18,37 +20,34 @@ def tokenize(text, inverted_index):
     tokens = re.findall(r"[a-z]+", text.lower())
     corrected_tokens = []
     for token in tokens:
-        if token not in inverted_index:
-            corrected_token = process.extractOne(
-                token, inverted_index.keys(), scorer=fuzz.ratio)
-            if corrected_token and corrected_token[1] >= 80:
-                corrected_tokens.append(corrected_token[0])
-        else:
-            corrected_tokens.append(token)
+        corrected_token = speller.correct(token)
+        if corrected_token:
+            corrected_tokens.append(corrected_token)
     return corrected_tokens
 
 
-def build_inverted_index(recipes):
+def build_inverted_index(recipes, parsed=None):
     """
     Builds an inverted index from the input list of recipes.
 
     Args:
         recipes (list): The list of recipes to build the inverted index from.
+        parsed (list): The output of recipe_parser.parse_recipe_batch for the
+            recipes, if already parsed.
 
     Returns:
         dict: The inverted index of the input recipes.
     """
     inverted_index = {}
 
-    for recipe in recipes:
+    for i, recipe in enumerate(recipes):
         recipe_id = int(recipe["RecipeId"])
 
-        tokens = set(
-            rp.tokenize(recipe["Name"])
-            + rp.tokenize(recipe["RecipeIngredientParts"][1:])
-            + rp.tokenize(recipe["Keywords"][1:])
-            + rp.tokenize(recipe["RecipeCategory"])
-        )
+        if parsed is not None:
+            tokens = set(parsed[i]["tokens"])
+        else:
+            tokens = set(rp.recipe_tokens(recipe))
+        tokens.discard(rp.PHRASE_BREAK)
 
         for token in tokens:
             if token not in inverted_index:
@@ -59,24 +58,30 @@ def build_inverted_index(recipes):
     return inverted_index
 
 
-def build_id_to_recipe(recipes):
+def build_id_to_recipe(recipes, parsed=None):
     """
     Builds a dictionary from recipe ID to the parts of the recipe we care about.
 
     Args:
         recipes (list): The list of recipes to build the dictionary from.
+        parsed (list): The output of recipe_parser.parse_recipe_batch for the
+            recipes. Parsed here if not given.
 
     Returns:
         dict: The dictionary from recipe ID to the parts of the recipe we care about.
     """
     id_to_recipe = {}
+    if parsed is None:
+        parsed = recipe_parser.parse_recipe_batch(recipes)
 
-    for recipe in recipes:
+    for recipe, fields in zip(recipes, parsed):
         recipe_id = int(recipe["RecipeId"])
         id_to_recipe[recipe_id] = {
             "name": recipe["Name"],
             "description": recipe["Description"],
-            "dietary_restrictions": recipe_parser.dietary_restrictions_check(recipe),
+            "dietary_restrictions": recipe_parser.dietary_restrictions_check(
+                recipe, fields
+            ),
             "cook_time": recipe["CookTime"],  # PT format
             "prep_time": recipe["PrepTime"],  # PT format
             "total_time": recipe["TotalTime"],  # PT format
@@ -89,11 +94,11 @@ def build_id_to_recipe(recipes):
                 if recipe["AggregatedRating"] != "NA"
                 else None
             ),
-            "ingredients": recipe_parser.parse_ingredients(recipe),
-            "instructions": recipe_parser.parse_instructions(recipe),
+            "ingredients": recipe_parser.parse_ingredients(recipe, fields),
+            "instructions": recipe_parser.parse_instructions(recipe, fields),
             "yield": recipe["RecipeYield"],
             "servings": recipe["RecipeServings"],
-            "image": recipe_parser.parse_image(recipe),
+            "image": recipe_parser.parse_image(recipe, fields),
         }
 
     return id_to_recipe
@@ -144,3 +149,23 @@ def build_recipe_norms(inverted_index, idf):
         recipe_norms[recipe_id] = np.sqrt(norm)
 
     return recipe_norms
+
+
+def build_corpus(id_to_recipe):
+    """
+    Builds the text of every recipe that the TF-IDF vectorizer and SVD are fit on.
+
+    Args:
+        id_to_recipe (dict): The output of build_id_to_recipe.
+
+    Returns:
+        list: The text of each recipe, in the order of id_to_recipe.
+    """
+    return [
+        " ".join(recipe["ingredients"])
+        + " "
+        + recipe["description"]
+        + " "
+        + recipe["instructions"]
+        for recipe in id_to_recipe.values()
+    ]
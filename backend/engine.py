@@ -0,0 +1,677 @@
+import json
+import logging
+import os
+import threading
+import time
+
+import algorithm
+import ann
+import artifacts
+import filters
+import lexical
+import lru
+import numpy as np
+import quantize
+import recipe_store
+import restrictions
+import shards
+import spelling
+import startup
+import suggest
+import timing
+
+# The fields of a search result
+DETAIL_FIELDS = (
+    "name",
+    "instructions",
+    "aggregated_rating",
+    "image",
+    "Url",
+    "total_time",
+    "similarity_scores",
+)
+
+# The fields of a search result read from the recipe store
+RECIPE_FIELDS = tuple(field for field in DETAIL_FIELDS if field != "similarity_scores")
+
+# Number of recipes in a page of search results
+PAGE_SIZE = 10
+
+# The group a new engine runs through cosine_search before it serves, one query
+# per member, comma separated
+WARMUP_QUERIES = os.environ.get("WARMUP_QUERIES", "chicken pasta,vegetable soup")
+WARMUP_QUERIES = [query for query in WARMUP_QUERIES.split(",") if query.strip()]
+
+logger = logging.getLogger(__name__)
+
+
+def resolve_data_directory(data_directory):
+    """
+    build_index.py publishes its releases under data/current, so an output
+    directory with a current release resolves to that release. The symlink is
+    resolved, so a release published while loading is not mixed in.
+    """
+    if os.path.isdir(os.path.join(data_directory, "current")):
+        return os.path.realpath(os.path.join(data_directory, "current"))
+    return data_directory
+
+
+def ranking_size(ranking):
+    """
+    Approximates the memory held by a ranking: a tuple, an int and a list of
+    float scores per recipe.
+    """
+    if not ranking:
+        return 0
+    return len(ranking) * (140 + 32 * len(ranking[0][1]))
+
+
+class SearchEngine(object):
+    """
+    The artifacts of one release and the caches in front of them. Loading it is
+    the slow part of starting the app, so a preloading server loads it once in
+    the master process and its workers inherit it: the embeddings and the
+    projection are memory mapped and the restriction index is a numpy buffer,
+    so their pages stay shared after the fork.
+    """
+
+    def __init__(self, data_directory, previous=None):
+        """
+        Args:
+            data_directory (str): An output directory of build_index.py, or one
+                of its releases.
+            previous (SearchEngine): The engine serving before this one. If this
+                release was ingested on top of it, see ingest.py, the columns of
+                its rows and its query embeddings are reused.
+        """
+        self.data_directory = resolve_data_directory(data_directory)
+        bundle_path = os.path.join(self.data_directory, "bundle")
+
+        with startup.stage("load id_to_recipe"), open(
+            os.path.join(self.data_directory, "id_to_recipe.json"), "r"
+        ) as f:
+            self.id_to_recipe = json.load(f)
+
+        # Unless lexical scoring is on, only the vocabulary of the inverted
+        # index is needed, so the postings are not kept around
+        with startup.stage("load inverted index"), open(
+            os.path.join(self.data_directory, "inv_idx.json"), "r"
+        ) as f:
+            inverted_index = json.load(f)
+        with startup.stage("build speller"):
+            self.speller = spelling.SpellingCorrector(inverted_index.keys())
+
+        with startup.stage("load bundle"):
+            self.bundle = artifacts.load_bundle(bundle_path)
+        self.vectorizer = self.bundle.vectorizer
+        self.svd_model = self.bundle.svd_model
+        self.svd = self.bundle.svd
+        self.recipe_ids = self.bundle.recipe_ids
+
+        # Ingestion only appends rows, so only the new rows need columns
+        first_new_row = 0
+        if previous is not None and self.bundle.manifest.get("parent") == {
+            "created": previous.bundle.manifest["created"],
+            "num_recipes": len(previous.recipe_ids),
+        }:
+            first_new_row = len(previous.recipe_ids)
+        new_ids = self.recipe_ids[first_new_row:]
+        with startup.stage("build columns"):
+            self.restriction_index = restrictions.build_restriction_index(
+                self.id_to_recipe, new_ids
+            )
+            # Durations are parsed once here rather than for every request
+            self.filter_columns = filters.build_filter_columns(
+                self.id_to_recipe, new_ids
+            )
+        if first_new_row:
+            self.restriction_index = np.concatenate(
+                [previous.restriction_index, self.restriction_index]
+            )
+            self.filter_columns = {
+                name: np.concatenate([previous.filter_columns[name], column])
+                for name, column in self.filter_columns.items()
+            }
+        self.filter_columns["live"] = filters.live_mask(
+            len(self.recipe_ids), self.bundle.tombstones
+        )
+
+        # Recipes ranked per group. Later pages of a group are served from the
+        # cached ranking instead of scoring the group again.
+        self.ranking_depth = max(
+            PAGE_SIZE, int(os.environ.get("RANKING_DEPTH", 10 * PAGE_SIZE))
+        )
+
+        # Cache entries are keyed on the loaded artifacts, so reloading them
+        # never serves stale results
+        self.artifact_generation = (self.bundle.path, self.bundle.manifest["created"])
+        self.result_cache = lru.LRUCache(
+            max_entries=int(os.environ.get("RESULT_CACHE_ENTRIES", 4096)),
+            max_bytes=int(os.environ.get("RESULT_CACHE_BYTES", 64 * 1024 * 1024)),
+            ttl=float(os.environ.get("RESULT_CACHE_TTL", 600)),
+            sizeof=ranking_size,
+        )
+
+        # Embeddings of recently seen queries, so a group where one member
+        # changed their text only embeds the new query. Ingestion keeps the
+        # vectorizer and the projection, so they stay valid across it.
+        if first_new_row:
+            self.embedding_cache = previous.embedding_cache
+        else:
+            self.embedding_cache = lru.LRUCache(
+                max_entries=int(os.environ.get("EMBEDDING_CACHE_ENTRIES", 65536)),
+                sizeof=lambda embedding: embedding.nbytes,
+            )
+
+        # Approximate search is opt-in per deployment by setting ANN_PROBES, and
+        # needs an index built into the bundle with `python ann.py <bundle> --save`
+        self.ann_index = None
+        if os.environ.get("ANN_PROBES"):
+            with startup.stage("load ANN index"):
+                self.ann_index = ann.IVFIndex.load(
+                    bundle_path,
+                    self.svd.shape[1],
+                    n_probe=int(os.environ["ANN_PROBES"]),
+                )
+
+        # Like ANN_PROBES, scanning an int8 copy of the embeddings is opt-in by
+        # setting QUANTIZED_RERANK, the number of candidates re-scored at full
+        # precision per result. The copy is built into the bundle with
+        # `python quantize.py <bundle> --save`.
+        self.quantized = None
+        if os.environ.get("QUANTIZED_RERANK"):
+            with startup.stage("load int8 embeddings"):
+                self.quantized = quantize.Int8Embeddings.load(
+                    bundle_path,
+                    self.svd.shape[1],
+                    rerank=int(os.environ["QUANTIZED_RERANK"]),
+                )
+
+        # Lexical scoring is opt-in by setting LEXICAL_WEIGHT, the share of the
+        # lexical score in every member score. At 1 recipes are ranked by their
+        # lexical score alone. LEXICAL_SCORER is bm25 or tfidf.
+        self.lexical = None
+        if float(os.environ.get("LEXICAL_WEIGHT", 0)):
+            scorer = os.environ.get("LEXICAL_SCORER", "bm25")
+            idf = recipe_norms = None
+            if scorer == "tfidf":
+                with open(os.path.join(self.data_directory, "idf.json"), "r") as f:
+                    idf = json.load(f)
+                with open(
+                    os.path.join(self.data_directory, "recipe_norms.json"), "r"
+                ) as f:
+                    recipe_norms = json.load(f)
+            with startup.stage("build lexical index"):
+                self.lexical = lexical.build_lexical_index(
+                    inverted_index,
+                    self.recipe_ids,
+                    scorer,
+                    idf,
+                    recipe_norms,
+                    weight=float(os.environ["LEXICAL_WEIGHT"]),
+                )
+            # Without ANN_PROBES or QUANTIZED_RERANK to find the SVD candidates,
+            # fusing scans every row. That is only allowed on small corpora.
+            max_rows = int(os.environ.get("LEXICAL_EXHAUSTIVE_MAX_ROWS", 100000))
+            if (
+                self.lexical.weight < 1
+                and self.ann_index is None
+                and self.quantized is None
+                and len(self.svd) > max_rows
+            ):
+                raise ValueError(
+                    f"Fusing lexical and SVD scores over {len(self.svd)} recipes "
+                    "needs ANN_PROBES or QUANTIZED_RERANK to find the SVD "
+                    "candidates, or LEXICAL_EXHAUSTIVE_MAX_ROWS raised to scan "
+                    "every recipe"
+                )
+
+        # Sharded search is opt-in by setting SHARDS, the number of local shard
+        # processes, or SHARD_ADDRESSES, see shards.py. It is exact, so it does
+        # not combine with the approximate and lexical modes above. Shards
+        # serve every release of the output directory, so a release swapped in
+        # keeps the shards of the one before it.
+        self.release = os.path.basename(self.data_directory)
+        if previous is not None:
+            self.shards = previous.shards
+        else:
+            self.shards = shards.connect(data_directory)
+        if self.shards is not None and (
+            self.ann_index is not None
+            or self.quantized is not None
+            or self.lexical is not None
+        ):
+            if previous is None:
+                self.shards.close()
+            raise ValueError(
+                "Sharded search does not combine with ANN_PROBES, QUANTIZED_RERANK "
+                "or LEXICAL_WEIGHT"
+            )
+
+        # Completions for the search inputs, over the names of the recipes that
+        # can be returned
+        live = self.filter_columns["live"]
+        live_ids = dict.fromkeys(
+            recipe_id
+            for row, recipe_id in enumerate(self.recipe_ids)
+            if live is None or live[row]
+        )
+        with startup.stage("build suggester"):
+            self.suggester = suggest.build_prefix_index(
+                inverted_index, (self.id_to_recipe[i]["name"] for i in live_ids)
+            )
+
+        # Details are only read for the recipes of a page. With a database
+        # store, the recipes are not kept once the columns above are built.
+        self.recipes = recipe_store.build_recipe_store(self.id_to_recipe, RECIPE_FIELDS)
+        if not isinstance(self.recipes, recipe_store.MemoryRecipeStore):
+            self.id_to_recipe = None
+
+    def close(self):
+        """
+        Stops the shard processes started for this engine, see
+        ShardedSearch.close. The engines of releases swapped in after it share
+        them, so close the one serving when shutting down.
+        """
+        if self.shards is not None:
+            self.shards.close()
+
+    def warm_up(self, queries=WARMUP_QUERIES):
+        """
+        Runs a group through cosine_search, so that the first request does not
+        pay for what the first search loads: the pages of the memory mapped
+        embeddings, the BLAS threads and, with a recipe store, its connections.
+        """
+        self.cosine_search(queries, dict.fromkeys(restrictions.RESTRICTIONS, False))
+
+    def correct_query(self, query):
+        """
+        Spelling corrects every token of a query, dropping tokens that have no
+        close match in the corpus.
+        """
+        corrected_tokens = []
+        for token in query.split():
+            corrected_token = self.speller.correct(token)
+            if corrected_token:
+                corrected_tokens.append(corrected_token)
+        return " ".join(corrected_tokens)
+
+    def rank_recipes(
+        self, preprocessed_queries, dietary_restrictions, strategy="sum", limits=None
+    ):
+        """
+        Ranks the recipes for a group, deep enough to serve every page of it.
+
+        Returns:
+            list: (recipe_id, scores) tuples in rank order, where scores holds
+                the score of each query.
+        """
+        if self.shards is not None:
+            top_recipes, sim_scores = self.shards.algorithm(
+                self.release,
+                preprocessed_queries,
+                dietary_restrictions,
+                self.vectorizer,
+                self.svd_model,
+                self.embedding_cache,
+                strategy,
+                limits,
+                k=self.ranking_depth,
+            )
+            return self.ranking(top_recipes, sim_scores)
+        top_recipes, sim_scores = algorithm.algorithm(
+            preprocessed_queries,
+            dietary_restrictions,
+            self.id_to_recipe,
+            self.vectorizer,
+            self.svd_model,
+            self.svd,
+            self.recipe_ids,
+            self.restriction_index,
+            self.ann_index,
+            self.embedding_cache,
+            self.quantized,
+            strategy,
+            self.filter_columns,
+            limits,
+            self.lexical,
+            k=self.ranking_depth,
+        )
+        return self.ranking(top_recipes, sim_scores)
+
+    def ranking(self, top_recipes, sim_scores):
+        """
+        Pairs the recipes returned by algorithm with their scores, dropping the
+        ones without details.
+        """
+        return [
+            (recipe_id, sim_scores[recipe_id])
+            for recipe_id, _ in top_recipes
+            if recipe_id in self.recipes
+        ]
+
+    @staticmethod
+    def recipe_detail(recipe, scores, fields=DETAIL_FIELDS):
+        """
+        Picks the details of a ranked recipe.
+
+        Args:
+            recipe (dict): The recipe, from the recipe store.
+            scores (list): The score of each query.
+            fields (tuple): The fields to return, out of DETAIL_FIELDS.
+
+        Returns:
+            dict: The requested fields.
+        """
+        detail = {}
+        for field in fields:
+            if field == "similarity_scores":
+                detail[field] = scores
+            elif field == "total_time":
+                detail[field] = recipe.get("total_time", "PT0M")
+            else:
+                detail[field] = recipe[field]
+        return detail
+
+    def recipe_details(self, ranking, fields=DETAIL_FIELDS):
+        """
+        Looks up the details of ranked recipes in one batch, leaving out the
+        ones the recipe store does not have.
+        """
+        return self.page_details([ranking], fields)[0]
+
+    def stream_recipe_details(self, ranking, fields=DETAIL_FIELDS):
+        """
+        Like recipe_details, but looks up one recipe at a time, so that the
+        first one can be sent before the rest are read from the recipe store.
+        """
+        for recipe_id, scores in ranking:
+            recipes = self.recipes.get_many([recipe_id], fields)
+            if recipe_id in recipes:
+                yield self.recipe_detail(recipes[recipe_id], scores, fields)
+
+    def page_details(self, pages, fields=DETAIL_FIELDS):
+        """
+        Like recipe_details for many pages, with one lookup for all of them.
+        """
+        with timing.stage("details"):
+            recipes = self.recipes.get_many(
+                list(
+                    dict.fromkeys(recipe_id for page in pages for recipe_id, _ in page)
+                ),
+                fields,
+            )
+            return [
+                [
+                    self.recipe_detail(recipes[recipe_id], scores, fields)
+                    for recipe_id, scores in page
+                    if recipe_id in recipes
+                ]
+                for page in pages
+            ]
+
+    def canonical_group(
+        self, queries, dietary_restrictions, strategy="sum", limits=None
+    ):
+        """
+        Spelling corrects a group and puts it in canonical order. The group
+        score does not depend on the order of its members, so queries are ranked
+        in sorted order and permutations of a group share a cache entry.
+
+        Returns:
+            tuple: The corrected queries in sorted order, the index in queries
+                of each of them, and the result cache key of the group.
+        """
+        # Preprocess each query to find the closest match in the corpus
+        with timing.stage("correct"):
+            preprocessed_queries = [self.correct_query(query) for query in queries]
+
+        order = sorted(range(len(queries)), key=preprocessed_queries.__getitem__)
+        sorted_queries = [preprocessed_queries[i] for i in order]
+        key = (
+            self.artifact_generation,
+            tuple(sorted_queries),
+            restrictions.restriction_bits(dietary_restrictions),
+            strategy,
+            filters.limits_key(limits),
+        )
+        return sorted_queries, order, key
+
+    @staticmethod
+    def request_order(ranking, order):
+        """
+        Puts the scores of a ranking back in the order of the request, see
+        canonical_group.
+        """
+        position = {query_index: i for i, query_index in enumerate(order)}
+        return [
+            (recipe_id, [scores[position[i]] for i in range(len(order))])
+            for recipe_id, scores in ranking
+        ]
+
+    def search(
+        self,
+        queries,
+        dietary_restrictions,
+        strategy="sum",
+        limits=None,
+        offset=0,
+        limit=PAGE_SIZE,
+    ):
+        """
+        Ranks the recipes for a group, or reads its ranking from the result
+        cache, and returns a page of it. Every page of a group is served from
+        the same ranking.
+
+        Args:
+            queries (list): The query of each member of the group.
+            dietary_restrictions (dict): Restriction name to whether it is
+                requested.
+            strategy (str): How the scores of the members are combined, one of
+                aggregation.STRATEGIES.
+            limits (dict): Optional time and rating limits, see
+                filters.filter_mask.
+            offset (int): Rank of the first recipe of the page.
+            limit (int): Maximum number of recipes in the page.
+
+        Returns:
+            tuple: The (recipe_id, scores) tuples of the page, with the scores in
+                the order of queries, and the number of recipes in the ranking.
+        """
+        sorted_queries, order, key = self.canonical_group(
+            queries, dietary_restrictions, strategy, limits
+        )
+        with timing.stage("result_cache"):
+            ranking = self.result_cache.get(key)
+        if ranking is None:
+            ranking = self.rank_recipes(
+                sorted_queries, dietary_restrictions, strategy, limits
+            )
+            self.result_cache.put(key, ranking)
+        return self.request_order(ranking[offset : offset + limit], order), len(ranking)
+
+    def cosine_search(
+        self,
+        queries,
+        dietary_restrictions,
+        strategy="sum",
+        limits=None,
+        offset=0,
+        limit=PAGE_SIZE,
+        fields=DETAIL_FIELDS,
+    ):
+        page, _ = self.search(
+            queries, dietary_restrictions, strategy, limits, offset, limit
+        )
+        return self.recipe_details(page, fields)
+
+    def cosine_search_batch(self, groups, fields=DETAIL_FIELDS):
+        """
+        Runs cosine_search for many groups. The groups that miss the result
+        cache are ranked together, see algorithm.algorithm_batch, and identical
+        groups are only ranked once.
+
+        Args:
+            groups (list): (queries, dietary_restrictions, strategy, limits)
+                tuples.
+            fields (tuple): The fields to return, out of DETAIL_FIELDS.
+
+        Returns:
+            list: The result of cosine_search for each group, in order.
+        """
+        canonical = [self.canonical_group(*group) for group in groups]
+
+        # Cache key to the ranking of the group, or to None until it is ranked
+        rankings = {}
+        missing = []
+        with timing.stage("result_cache"):
+            for (sorted_queries, _, key), (_, *options) in zip(canonical, groups):
+                if key not in rankings:
+                    rankings[key] = self.result_cache.get(key)
+                    if rankings[key] is None:
+                        missing.append((key, sorted_queries, *options))
+
+        if missing and (
+            self.ann_index is not None
+            or self.quantized is not None
+            or self.lexical is not None
+            or self.shards is not None
+        ):
+            # Approximate and lexical search score different rows for every
+            # group, and shards rank one group at a time
+            for key, *group in missing:
+                rankings[key] = self.rank_recipes(*group)
+                self.result_cache.put(key, rankings[key])
+        elif missing:
+            results = algorithm.algorithm_batch(
+                [group for _, *group in missing],
+                self.id_to_recipe,
+                self.vectorizer,
+                self.svd_model,
+                self.svd,
+                self.recipe_ids,
+                self.restriction_index,
+                self.embedding_cache,
+                self.filter_columns,
+                k=self.ranking_depth,
+            )
+            for (key, *_), (top_recipes, sim_scores) in zip(missing, results):
+                rankings[key] = self.ranking(top_recipes, sim_scores)
+                self.result_cache.put(key, rankings[key])
+
+        return self.page_details(
+            [
+                self.request_order(rankings[key][:PAGE_SIZE], order)
+                for _, order, key in canonical
+            ],
+            fields,
+        )
+
+    def cache_stats(self):
+        return {
+            "results": self.result_cache.stats(),
+            "embeddings": self.embedding_cache.stats(),
+            "recipes": self.recipes.stats(),
+        }
+
+
+class ReleaseWatcher(object):
+    """
+    Polls the current release of an output directory and swaps a newly
+    published one in. The new engine is loaded next to the old one and replaces
+    it in a single assignment, so requests that already hold the old engine
+    finish on it, and its caches go with it.
+    """
+
+    def __init__(self, data_directory, extensions, interval):
+        """
+        Args:
+            data_directory (str): The output directory of build_index.py.
+            extensions (dict): The app.extensions holding the engine as "search".
+            interval (float): Seconds between polls.
+        """
+        self.data_directory = data_directory
+        self.extensions = extensions
+        self.interval = interval
+        self.pid = None
+        self.lock = threading.Lock()
+
+    def start(self):
+        """
+        Starts polling in a daemon thread, unless this process already does.
+        Threads do not survive a fork, so every worker starts its own.
+        """
+        with self.lock:
+            if self.pid == os.getpid():
+                return
+            self.pid = os.getpid()
+        threading.Thread(target=self.run, daemon=True).start()
+
+    def run(self):
+        while True:
+            time.sleep(self.interval)
+            try:
+                self.reload()
+            except Exception:
+                # Keep serving the old release
+                logger.exception("Could not load the current release")
+
+    def reload(self):
+        """
+        Loads the current release if it is not the one being served.
+
+        Returns:
+            bool: Whether a new release was swapped in.
+        """
+        engine = self.extensions["search"]
+        if resolve_data_directory(self.data_directory) == engine.data_directory:
+            return False
+        start = time.perf_counter()
+        new_engine = SearchEngine(self.data_directory, previous=engine)
+        new_engine.warm_up()
+        self.extensions["search"] = new_engine
+        logger.warning(
+            "Swapped in %s in %.1fs",
+            self.extensions["search"].data_directory,
+            time.perf_counter() - start,
+        )
+        return True
+
+
+class Warmup(object):
+    """
+    Warms the engine up in a background thread, see SearchEngine.warm_up, and
+    tells whether it is done. Like ReleaseWatcher, it runs in every process
+    that serves, since a thread does not survive a fork.
+    """
+
+    def __init__(self, extensions):
+        """
+        Args:
+            extensions (dict): The app.extensions holding the engine as "search".
+        """
+        self.extensions = extensions
+        self.ready = False
+        self.pid = None
+        self.lock = threading.Lock()
+
+    def start(self):
+        """
+        Starts warming up in a daemon thread, unless this process already does.
+        """
+        with self.lock:
+            if self.pid == os.getpid():
+                return
+            self.pid = os.getpid()
+            self.ready = False
+        threading.Thread(target=self.run, daemon=True).start()
+
+    def run(self):
+        start = time.perf_counter()
+        try:
+            self.extensions["search"].warm_up()
+        except Exception:
+            # The artifacts are loaded, so serve cold rather than not at all
+            logger.exception("Could not warm up")
+        self.ready = True
+        logger.warning("Warmed up in %.2fs", time.perf_counter() - start)
@@ -0,0 +1,114 @@
+import numpy as np
+import recipe_parser
+
+# The duration fields of a recipe, parsed into minute columns
+TIME_FIELDS = ("total_time", "cook_time", "prep_time")
+
+# Request parameter to the column it limits
+TIME_LIMITS = {
+    "max_time": "total_time",
+    "max_cook_time": "cook_time",
+    "max_prep_time": "prep_time",
+}
+
+# Minutes of a recipe whose duration is missing. It is above every max_time, so
+# those recipes are dropped whenever a time limit is set.
+UNKNOWN_MINUTES = np.iinfo(np.int32).max
+
+
+def build_filter_columns(id_to_recipe, recipe_ids=None):
+    """
+    Parses the durations and the rating of every recipe once, into arrays
+    aligned with the rows of the SVD matrix.
+
+    Args:
+        id_to_recipe (dict): Recipe ID to recipe.
+        recipe_ids (list): The recipe ID of every row of the SVD matrix. Defaults
+            to the order of id_to_recipe.
+
+    Returns:
+        dict: An int32 array of minutes for each of TIME_FIELDS, and a float32
+            "aggregated_rating" array, NaN for unrated recipes.
+    """
+    if recipe_ids is None:
+        recipe_ids = list(id_to_recipe.keys())
+    recipes = [id_to_recipe[recipe_id] for recipe_id in recipe_ids]
+
+    columns = {}
+    for field in TIME_FIELDS:
+        minutes = (recipe_parser.parse_minutes(r.get(field)) for r in recipes)
+        columns[field] = np.fromiter(
+            (UNKNOWN_MINUTES if m is None else m for m in minutes),
+            dtype=np.int32,
+            count=len(recipes),
+        )
+    columns["aggregated_rating"] = np.fromiter(
+        (
+            np.nan if r.get("aggregated_rating") is None else r["aggregated_rating"]
+            for r in recipes
+        ),
+        dtype=np.float32,
+        count=len(recipes),
+    )
+    return columns
+
+
+def live_mask(num_rows, tombstones):
+    """
+    Builds a boolean array marking the rows that are not tombstoned, or None if
+    no row is.
+
+    Args:
+        num_rows (int): Number of rows of the SVD matrix.
+        tombstones (np.ndarray): The rows of deleted recipes.
+
+    Returns:
+        np.ndarray: The mask.
+    """
+    if not len(tombstones):
+        return None
+    mask = np.ones(num_rows, dtype=bool)
+    mask[tombstones] = False
+    return mask
+
+
+def filter_mask(columns, limits):
+    """
+    Builds a boolean array marking the recipes within the requested limits.
+    Tombstoned rows are always left out.
+
+    Args:
+        columns (dict): The output of build_filter_columns, with the output of
+            live_mask as "live" if any row is tombstoned.
+        limits (dict): Optional time limits in minutes, see TIME_LIMITS, and
+            "min_rating".
+
+    Returns:
+        np.ndarray: The mask, or None if every recipe passes.
+    """
+    mask = columns.get("live")
+    for name, field in TIME_LIMITS.items():
+        if limits.get(name) is not None:
+            mask = combine_masks(mask, columns[field] <= limits[name])
+    if limits.get("min_rating") is not None:
+        # NaN compares False, so unrated recipes are dropped
+        mask = combine_masks(mask, columns["aggregated_rating"] >= limits["min_rating"])
+    return mask
+
+
+def limits_key(limits):
+    """
+    Turns the requested limits into a hashable key, ignoring unset limits.
+    """
+    return tuple(sorted((n, v) for n, v in (limits or {}).items() if v is not None))
+
+
+def combine_masks(mask, other):
+    """
+    Intersects two optional masks, where None allows every recipe.
+    """
+    if mask is None:
+        return other
+    if other is None:
+        return mask
+    return mask & other
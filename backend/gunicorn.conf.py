@@ -0,0 +1,34 @@
+"""
+Production server configuration:
+
+    gunicorn -c gunicorn.conf.py
+
+The app is created once in the master (preload_app) and the workers are forked
+from it, so they share the memory mapped embeddings and projection and, until
+they write to them, the pages of every other loaded object.
+"""
+
+import gc
+import multiprocessing
+import os
+
+wsgi_app = "app:create_app()"
+bind = os.environ.get("BIND", "0.0.0.0:5000")
+workers = int(os.environ.get("WEB_CONCURRENCY", multiprocessing.cpu_count()))
+threads = int(os.environ.get("GUNICORN_THREADS", 1))
+preload_app = True
+# Loading the artifacts of a large release takes a while
+timeout = int(os.environ.get("GUNICORN_TIMEOUT", 120))
+
+
+def pre_fork(server, worker):
+    # Moves everything the master loaded out of the garbage collector's reach.
+    # Otherwise the first collection in each worker writes to the header of every
+    # loaded object and copies the pages holding id_to_recipe into the worker.
+    gc.freeze()
+
+
+def post_fork(server, worker):
+    # Warms the worker up right away rather than on its first request, so it
+    # passes /ready without traffic. preload_app loaded the app in the master.
+    server.app.wsgi().extensions["warmup"].start()
@@ -1,47 +1,295 @@
+import contextlib
+import itertools
+import json
 import os
+
 import sqlalchemy as db
 
+# The recipe details, one row per recipe. JSON encoded lists are stored as text
+# so that the table works on MySQL and on a local SQLite stand-in.
+metadata = db.MetaData()
+RECIPES_TABLE = db.Table(
+    "recipes",
+    metadata,
+    db.Column("id", db.BigInteger, primary_key=True, autoincrement=False),
+    db.Column("name", db.Text),
+    db.Column("description", db.Text),
+    db.Column("instructions", db.Text),
+    db.Column("ingredients", db.Text),
+    db.Column("dietary_restrictions", db.Text),
+    db.Column("image", db.Text),
+    db.Column("url", db.Text),
+    db.Column("aggregated_rating", db.Float),
+    db.Column("review_count", db.Integer),
+    db.Column("cook_time", db.String(32)),
+    db.Column("prep_time", db.String(32)),
+    db.Column("total_time", db.String(32)),
+    db.Column("yield", db.Text),
+    db.Column("servings", db.Text),
+)
+
+# Fields of id_to_recipe stored as JSON text
+JSON_FIELDS = ("ingredients", "dietary_restrictions")
+
+
 class MySQLDatabaseHandler(object):
-    
-    IS_DOCKER = True if 'DB_NAME' in os.environ else False
 
-    def __init__(self,MYSQL_USER,MYSQL_USER_PASSWORD,MYSQL_PORT,MYSQL_DATABASE,MYSQL_HOST = "localhost"):
-        
-        self.MYSQL_HOST = os.environ['DB_NAME'] if MySQLDatabaseHandler.IS_DOCKER else MYSQL_HOST
+    IS_DOCKER = True if "DB_NAME" in os.environ else False
+
+    def __init__(
+        self,
+        MYSQL_USER,
+        MYSQL_USER_PASSWORD,
+        MYSQL_PORT,
+        MYSQL_DATABASE,
+        MYSQL_HOST="localhost",
+        url=None,
+    ):
+        """
+        Args:
+            url (str): Optional database URL used instead of the MySQL settings,
+                e.g. sqlite:///recipes.db for a local stand-in.
+
+        The connection pool is configured with DB_POOL_SIZE connections kept
+        open, DB_MAX_OVERFLOW more opened under load, DB_POOL_TIMEOUT seconds
+        to wait for a connection before failing and DB_POOL_RECYCLE seconds
+        after which a connection is reopened, before MySQL drops it.
+        """
+        self.MYSQL_HOST = (
+            os.environ["DB_NAME"] if MySQLDatabaseHandler.IS_DOCKER else MYSQL_HOST
+        )
         self.MYSQL_USER = "admin" if MySQLDatabaseHandler.IS_DOCKER else MYSQL_USER
-        self.MYSQL_USER_PASSWORD = "admin" if MySQLDatabaseHandler.IS_DOCKER else MYSQL_USER_PASSWORD
+        self.MYSQL_USER_PASSWORD = (
+            "admin" if MySQLDatabaseHandler.IS_DOCKER else MYSQL_USER_PASSWORD
+        )
         self.MYSQL_PORT = 3306 if MySQLDatabaseHandler.IS_DOCKER else MYSQL_PORT
-        self.MYSQL_DATABASE = "kardashiandb" if MySQLDatabaseHandler.IS_DOCKER else MYSQL_DATABASE
+        self.MYSQL_DATABASE = (
+            "kardashiandb" if MySQLDatabaseHandler.IS_DOCKER else MYSQL_DATABASE
+        )
+        self.url = url or (
+            f"mysql+pymysql://{self.MYSQL_USER}:{self.MYSQL_USER_PASSWORD}"
+            f"@{self.MYSQL_HOST}:{self.MYSQL_PORT}/{self.MYSQL_DATABASE}"
+        )
         self.engine = self.validate_connection()
 
     def validate_connection(self):
-        print(f"mysql+pymysql://{self.MYSQL_USER}:{self.MYSQL_USER_PASSWORD}@{self.MYSQL_HOST}:{self.MYSQL_PORT}/{self.MYSQL_DATABASE}")
-        return db.create_engine(f"mysql+pymysql://{self.MYSQL_USER}:{self.MYSQL_USER_PASSWORD}@{self.MYSQL_HOST}:{self.MYSQL_PORT}/{self.MYSQL_DATABASE}")
+        connect_args = {}
+        if self.url.startswith("sqlite"):
+            # Pooled connections move between threads
+            connect_args["check_same_thread"] = False
+        engine = db.create_engine(
+            self.url,
+            poolclass=db.pool.QueuePool,
+            pool_size=int(os.environ.get("DB_POOL_SIZE", 5)),
+            max_overflow=int(os.environ.get("DB_MAX_OVERFLOW", 10)),
+            pool_timeout=float(os.environ.get("DB_POOL_TIMEOUT", 30)),
+            pool_recycle=int(os.environ.get("DB_POOL_RECYCLE", 3600)),
+            pool_pre_ping=True,
+            connect_args=connect_args,
+        )
+        print(engine.url.render_as_string(hide_password=True))
+        return engine
 
+    @contextlib.contextmanager
     def lease_connection(self):
-        return self.engine.connect()
-    
-    def query_executor(self,query):
-        conn = self.lease_connection()
-        if type(query) == list:
-            for i in query:
-                conn.execute(i)
-        else:
-            conn.execute(query)
-        
+        """
+        Checks a connection out of the pool and returns it when the block exits.
+
+            with handler.lease_connection() as conn:
+                ...
+
+        Raises:
+            sqlalchemy.exc.TimeoutError: If no connection frees up within the
+                pool timeout.
+        """
+        with self.engine.connect() as conn:
+            yield conn
+
+    @contextlib.contextmanager
+    def transaction(self):
+        """
+        Like lease_connection, but in a transaction that is committed when the
+        block exits and rolled back if it raises.
+        """
+        with self.engine.begin() as conn:
+            yield conn
+
+    def query_executor(self, query, params=None):
+        """
+        Executes a statement, or a list of statements, in one transaction.
+        """
+        with self.transaction() as conn:
+            for statement in query if type(query) == list else [query]:
+                conn.execute(as_statement(statement), params or {})
+
+    def query_selector(self, query, params=None):
+        """
+        Runs a select and returns all of its rows. The connection is back in
+        the pool when this returns, so use stream_selector for large results.
+        """
+        with self.lease_connection() as conn:
+            return conn.execute(as_statement(query), params or {}).fetchall()
+
+    def stream_selector(self, query, params=None, batch_size=1000):
+        """
+        Runs a select with a server-side cursor and yields its rows as they
+        arrive, holding at most batch_size of them in memory. The connection is
+        checked out until the generator is exhausted or closed.
+        """
+        with self.lease_connection() as conn:
+            result = conn.execution_options(
+                stream_results=True, max_row_buffer=batch_size
+            ).execute(as_statement(query), params or {})
+            for rows in result.partitions(batch_size):
+                yield from rows
+
+    def bulk_insert(self, table, rows, batch_size=5000):
+        """
+        Inserts rows in batches, each sent as one executemany, in a single
+        transaction.
+
+        Args:
+            table (sqlalchemy.Table): The table.
+            rows (iterable): A dict of column values per row. It is consumed
+                lazily, one batch at a time.
+            batch_size (int): Number of rows per executemany.
+
+        Returns:
+            int: The number of rows inserted.
+        """
+        with self.transaction() as conn:
+            return insert_batches(conn, table, rows, batch_size)
+
+    def load_recipes(self, id_to_recipe, batch_size=5000):
+        """
+        Replaces the recipes table with the recipes of a release.
+
+        Args:
+            id_to_recipe (dict): Recipe ID to recipe, as in id_to_recipe.json.
+            batch_size (int): Number of rows per executemany.
 
-    def query_selector(self,query):
-        conn = self.lease_connection()
-        data = conn.execute(query)
-        return data
+        Returns:
+            int: The number of recipes loaded.
+        """
+        RECIPES_TABLE.drop(self.engine, checkfirst=True)
+        RECIPES_TABLE.create(self.engine)
+        return self.bulk_insert(
+            RECIPES_TABLE,
+            (recipe_row(i, recipe) for i, recipe in id_to_recipe.items()),
+            batch_size,
+        )
 
-    def load_file_into_db(self,file_path  = None):
+    def upsert_recipes(self, id_to_recipe, batch_size=5000):
+        """
+        Inserts recipes into the recipes table, replacing the ones with the
+        same IDs, in one transaction.
+
+        Returns:
+            int: The number of recipes written.
+        """
+        ids = [int(i) for i in id_to_recipe]
+        with self.transaction() as conn:
+            for start in range(0, len(ids), batch_size):
+                conn.execute(
+                    RECIPES_TABLE.delete().where(
+                        RECIPES_TABLE.c.id.in_(ids[start : start + batch_size])
+                    )
+                )
+            return insert_batches(
+                conn,
+                RECIPES_TABLE,
+                (recipe_row(i, recipe) for i, recipe in id_to_recipe.items()),
+                batch_size,
+            )
+
+    def select_recipes(self, recipe_ids, fields=None):
+        """
+        Looks up recipes by ID with one IN (...) query.
+
+        Args:
+            recipe_ids (list): The recipe IDs.
+            fields (iterable): The fields to read, as in id_to_recipe. All of
+                them if not given.
+
+        Returns:
+            dict: Recipe ID, as an int, to the recipe, for the IDs found.
+        """
+        columns = [RECIPES_TABLE.c.id]
+        if fields is None:
+            columns = list(RECIPES_TABLE.columns)
+        else:
+            columns += [RECIPES_TABLE.c[column_name(field)] for field in fields]
+        query = db.select(*columns).where(
+            RECIPES_TABLE.c.id.in_([int(i) for i in recipe_ids])
+        )
+        return {row.id: recipe_from_row(row) for row in self.query_selector(query)}
+
+    def load_file_into_db(self, file_path=None):
         if MySQLDatabaseHandler.IS_DOCKER:
             return
         if file_path is None:
-            file_path = os.path.join(os.environ['ROOT_PATH'],'init.sql')
-        sql_file = open(file_path,"r")
-        sql_file_data = list(filter(lambda x:x != '',sql_file.read().split(";\n")))
+            file_path = os.path.join(os.environ["ROOT_PATH"], "init.sql")
+        sql_file = open(file_path, "r")
+        sql_file_data = list(filter(lambda x: x != "", sql_file.read().split(";\n")))
         self.query_executor(sql_file_data)
         sql_file.close()
 
+
+def as_statement(query):
+    return db.text(query) if isinstance(query, str) else query
+
+
+def insert_batches(conn, table, rows, batch_size):
+    rows = iter(rows)
+    inserted = 0
+    while True:
+        batch = list(itertools.islice(rows, batch_size))
+        if not batch:
+            return inserted
+        conn.execute(table.insert(), batch)
+        inserted += len(batch)
+
+
+def column_name(field):
+    """
+    The column of RECIPES_TABLE holding a field of id_to_recipe.
+    """
+    return "url" if field == "Url" else field
+
+
+def recipe_row(recipe_id, recipe):
+    """
+    Converts a recipe of id_to_recipe into a row of RECIPES_TABLE.
+    """
+    row = {"id": int(recipe_id)}
+    for column in RECIPES_TABLE.columns.keys()[1:]:
+        value = recipe.get("Url" if column == "url" else column)
+        row[column] = json.dumps(value) if column in JSON_FIELDS else value
+    return row
+
+
+def recipe_from_row(row):
+    """
+    Converts a row of RECIPES_TABLE, or some of its columns, back into a recipe
+    of id_to_recipe, without the ID.
+    """
+    recipe = {}
+    for column, value in row._mapping.items():
+        if column == "id":
+            continue
+        if column in JSON_FIELDS and value is not None:
+            value = json.loads(value)
+        recipe["Url" if column == "url" else column] = value
+    return recipe
+
+
+if __name__ == "__main__":
+    # Loads the recipes of a release into the database, e.g. a local stand-in:
+    #   python helpers/MySQLDatabaseHandler.py data/current sqlite:///recipes.db
+    import sys
+
+    release, url = sys.argv[1:3]
+    with open(os.path.join(release, "id_to_recipe.json"), "r") as f:
+        id_to_recipe = json.load(f)
+    handler = MySQLDatabaseHandler(None, None, None, None, url=url)
+    print(f"loaded {handler.load_recipes(id_to_recipe)} recipes")
@@ -0,0 +1,221 @@
+"""
+Adds recipes to and deletes recipes from the current release without refitting
+the TF-IDF vectorizer and the SVD, and publishes the result as a new release.
+
+    python ingest.py data --add new_recipes.csv --delete 38,4012
+
+New recipes are folded into the fitted space: they are vectorized with the
+fitted vocabulary and idf weights and projected onto the fitted components, so
+their words outside the vocabulary are ignored until the next full build.
+Deleted recipes are tombstoned: their rows stay in the embedding matrix and are
+masked out of every search. Adding a recipe ID that already exists replaces it.
+
+A server with RELOAD_INTERVAL set swaps the new release in while it serves, see
+engine.ReleaseWatcher. Ingestions are not merged, so run one at a time, and run
+build_index.py periodically on a CSV with the same changes to refit the space
+and drop the tombstoned rows.
+
+With --store, the added recipes are also written to the recipes table of the
+database the servers read details from, see recipe_store.py, before the release
+is published. Deleted recipes stay in the table, but are never ranked.
+"""
+
+import argparse
+import hashlib
+import json
+import os
+import time
+
+import algorithm
+import ann
+import artifacts
+import build_index
+import data_processing
+import numpy as np
+import quantize
+from engine import resolve_data_directory
+from helpers.MySQLDatabaseHandler import MySQLDatabaseHandler
+
+
+def fold_in(id_to_recipe, vectorizer, svd_model):
+    """
+    Embeds recipes into a fitted SVD space, the same way as the recipes it was
+    fit on.
+
+    Args:
+        id_to_recipe (dict): The recipes, as built by build_id_to_recipe.
+        vectorizer (TfidfWeights): The fitted TF-IDF vectorizer of the bundle.
+        svd_model (Projection): The fitted SVD projection of the bundle.
+
+    Returns:
+        np.ndarray: The row-normalized float32 embedding of every recipe, in the
+            order of id_to_recipe.
+    """
+    tfidf_matrix = vectorizer.transform(data_processing.build_corpus(id_to_recipe))
+    return algorithm.normalize_rows(svd_model.transform(tfidf_matrix)).astype(
+        np.float32
+    )
+
+
+def read_recipes(csv_path, require_image=True, require_rating=True, chunk_size=2000):
+    """
+    Parses the recipes of a CSV like build_index.py does.
+
+    Returns:
+        tuple: The id_to_recipe, keyed by string IDs like the published one, and
+            the inverted index of the recipes.
+    """
+    keep = build_index.row_filter(require_image, require_rating)
+    id_to_recipe = {}
+    inverted_index = {}
+    for chunk in build_index.read_chunks(csv_path, chunk_size, keep):
+        chunk_recipes, chunk_index = build_index.parse_chunk(chunk)
+        id_to_recipe.update((str(i), recipe) for i, recipe in chunk_recipes.items())
+        for token, postings in chunk_index.items():
+            inverted_index.setdefault(token, []).extend(postings)
+    return id_to_recipe, inverted_index
+
+
+def ingest(out, added=None, added_index=None, deleted_ids=(), store_url=None):
+    """
+    Publishes a new release with recipes added to and deleted from the current
+    release of an output directory.
+
+    Args:
+        out (str): The output directory of build_index.py.
+        added (dict): The new recipes, keyed by string ID, see read_recipes.
+        added_index (dict): The inverted index of the new recipes.
+        deleted_ids (list): The IDs of the recipes to delete.
+        store_url (str): Optional SQLAlchemy URL of a recipe store to write the
+            added recipes to.
+
+    Returns:
+        str: The path of the new release.
+    """
+    if not os.path.isdir(os.path.join(out, "current")):
+        raise ValueError(f"{out} has no current release to ingest into")
+    parent = resolve_data_directory(out)
+    bundle = artifacts.load_bundle(os.path.join(parent, "bundle"))
+    with open(os.path.join(parent, "id_to_recipe.json"), "r") as f:
+        id_to_recipe = json.load(f)
+    with open(os.path.join(parent, "inv_idx.json"), "r") as f:
+        inverted_index = json.load(f)
+
+    added = dict(added or {})
+    deleted_ids = {str(i) for i in deleted_ids}
+    unknown = deleted_ids.difference(id_to_recipe, added)
+    if unknown:
+        build_index.log(f"ingest: no recipes with IDs {', '.join(sorted(unknown))}")
+    for recipe_id in deleted_ids:
+        added.pop(recipe_id, None)
+
+    # Replaced recipes are tombstoned too. Their details are kept until the
+    # next full build, since every row has a restriction and time column.
+    removed = (deleted_ids | set(added)).intersection(id_to_recipe)
+    rows = [row for row, i in enumerate(bundle.recipe_ids) if i in removed]
+    tombstones = np.union1d(bundle.tombstones, np.asarray(rows, dtype=np.int64))
+
+    if removed:
+        removed_postings = {int(i) for i in removed}
+        pruned = {}
+        for token, postings in inverted_index.items():
+            postings = [p for p in postings if p not in removed_postings]
+            if postings:
+                pruned[token] = postings
+        inverted_index = pruned
+    for token, postings in (added_index or {}).items():
+        postings = [p for p in postings if str(p) in added]
+        if postings:
+            inverted_index.setdefault(token, []).extend(postings)
+    id_to_recipe.update(added)
+
+    embeddings = fold_in(added, bundle.vectorizer, bundle.svd_model)
+    num_live = len(bundle.recipe_ids) + len(added) - len(tombstones)
+    idf = data_processing.build_idf(inverted_index, num_live)
+    recipe_norms = data_processing.build_recipe_norms(inverted_index, idf)
+
+    changes = {
+        "parent": os.path.basename(parent),
+        "added": sorted(added),
+        "deleted": sorted(deleted_ids),
+    }
+    digest = hashlib.sha256(json.dumps(changes).encode("utf-8")).hexdigest()
+    version = time.strftime("%Y%m%d-%H%M%S") + "-" + digest[:8]
+
+    def write(directory):
+        os.makedirs(directory)
+        for name, value in [
+            ("id_to_recipe.json", id_to_recipe),
+            ("inv_idx.json", inverted_index),
+            ("idf.json", idf),
+            ("recipe_norms.json", recipe_norms),
+        ]:
+            with open(os.path.join(directory, name), "w") as f:
+                json.dump(value, f)
+
+        bundle_directory = os.path.join(directory, "bundle")
+        artifacts.append_bundle(
+            bundle, bundle_directory, embeddings, list(added), tombstones
+        )
+        n_components = bundle.manifest["n_components"]
+        index = ann.IVFIndex.load(bundle.path, n_components)
+        if index is not None:
+            index.add(embeddings, len(bundle.recipe_ids)).save(bundle_directory)
+        quantized = quantize.Int8Embeddings.load(bundle.path, n_components)
+        if quantized is not None:
+            quantized.add(embeddings).save(bundle_directory)
+
+        with open(os.path.join(directory, "build.json"), "w") as f:
+            json.dump(
+                {
+                    "version": version,
+                    "parent": changes["parent"],
+                    "added": len(added),
+                    "tombstoned": len(tombstones) - len(bundle.tombstones),
+                    "num_recipes": num_live,
+                },
+                f,
+                indent=2,
+            )
+
+    if store_url and added:
+        MySQLDatabaseHandler(None, None, None, None, url=store_url).upsert_recipes(
+            added
+        )
+    return build_index.publish(out, version, write)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("out", help="output directory of build_index.py")
+    parser.add_argument("--add", help="CSV of recipes to add, like the build input")
+    parser.add_argument(
+        "--delete", default="", help="comma separated IDs of recipes to delete"
+    )
+    parser.add_argument(
+        "--store", help="SQLAlchemy URL of the recipe store, see RECIPE_STORE_URL"
+    )
+    parser.add_argument("--chunk-size", type=int, default=2000)
+    parser.add_argument("--keep-imageless", dest="require_image", action="store_false")
+    parser.add_argument("--keep-unrated", dest="require_rating", action="store_false")
+    args = parser.parse_args(argv)
+
+    deleted_ids = [i.strip() for i in args.delete.split(",") if i.strip()]
+    if not args.add and not deleted_ids:
+        parser.error("nothing to ingest, pass --add or --delete")
+
+    start = time.perf_counter()
+    added, added_index = {}, {}
+    if args.add:
+        added, added_index = read_recipes(
+            args.add, args.require_image, args.require_rating, args.chunk_size
+        )
+    release = ingest(args.out, added, added_index, deleted_ids, args.store)
+    build_index.log(
+        f"published {release} with {len(added)} recipes added and "
+        f"{len(deleted_ids)} deleted in {time.perf_counter() - start:.1f}s"
+    )
+
+
+if __name__ == "__main__":
+    main()
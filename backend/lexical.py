@@ -0,0 +1,307 @@
+import itertools
+
+import algorithm
+import numpy as np
+import recipe_parser
+
+# The lexical scorers: BM25, or the cosine between the TF-IDF vectors of the
+# query and the recipe with the idf and norms of data_processing
+SCORERS = ("bm25", "tfidf")
+
+BM25_K1 = 1.2
+BM25_B = 0.75
+
+
+class LexicalIndex(object):
+    """
+    The inverted index as flat arrays: the postings of every term are sorted
+    SVD row indices, next to the precomputed impact of the term on each of
+    those recipes, so the score of a recipe for a query is the sum of the
+    impacts of the query terms times their query weights. Exact ingredient
+    matches, e.g. "tahini", count even when the SVD space blurs them.
+    """
+
+    def __init__(self, terms, offsets, postings, impacts, term_weights, weight=1.0):
+        """
+        Args:
+            terms (dict): Term to term index.
+            offsets (np.ndarray): Term i has postings[offsets[i]:offsets[i + 1]].
+            postings (np.ndarray): The int32 rows of every term, sorted per term.
+            impacts (np.ndarray): The float32 impact of every posting.
+            term_weights (np.ndarray): The query weight of every term.
+            weight (float): The share of the lexical score in the member scores,
+                see fuse. 1 ranks by the lexical score alone.
+        """
+        self.terms = terms
+        self.offsets = offsets
+        self.postings = postings
+        self.impacts = impacts
+        self.term_weights = term_weights
+        self.weight = weight
+        # The highest impact of every term, the most it adds to any recipe
+        self.max_impacts = np.zeros(len(terms), dtype=np.float32)
+        nonempty = np.flatnonzero(np.diff(offsets))
+        if len(nonempty):
+            self.max_impacts[nonempty] = np.maximum.reduceat(impacts, offsets[nonempty])
+
+    @property
+    def nbytes(self):
+        return self.postings.nbytes + self.impacts.nbytes + self.offsets.nbytes
+
+    def term_postings(self, term):
+        start, end = self.offsets[term], self.offsets[term + 1]
+        return self.postings[start:end], self.impacts[start:end]
+
+    def term_impacts(self, term, rows):
+        """
+        Searches the postings of a term for sorted rows, returning the impact
+        of the term on each of them, or 0 where it does not occur.
+        """
+        postings, impacts = self.term_postings(term)
+        found = np.zeros(len(rows), dtype=np.float32)
+        if not len(postings):
+            return found
+        positions = np.searchsorted(postings, rows)
+        positions[positions == len(postings)] = 0
+        hits = postings[positions] == rows
+        found[hits] = impacts[positions[hits]]
+        return found
+
+    def query(self, text):
+        """
+        Finds the terms of a query and their weights, scaled so that a recipe
+        with the highest impact of every term scores 1.
+
+        Args:
+            text (str): The query.
+
+        Returns:
+            tuple: The term indices and the float64 weight of each.
+        """
+        counts = {}
+        for token in recipe_parser.tokenize(text):
+            term = self.terms.get(token)
+            if term is not None:
+                counts[term] = counts.get(term, 0) + 1
+        terms = np.fromiter(counts, dtype=np.intp, count=len(counts))
+        weights = np.fromiter(counts.values(), dtype=np.float64, count=len(counts))
+        weights *= self.term_weights[terms]
+        bound = (weights * self.max_impacts[terms]).sum()
+        if bound > 0:
+            weights /= bound
+        return terms, weights
+
+    def group_query(self, queries):
+        """
+        Merges the terms of every query, so that the score of a recipe is the
+        sum of its scores for each query.
+        """
+        merged = {}
+        for terms, weights in map(self.query, queries):
+            for term, weight in zip(terms.tolist(), weights.tolist()):
+                merged[term] = merged.get(term, 0) + weight
+        terms = np.fromiter(merged, dtype=np.intp, count=len(merged))
+        weights = np.fromiter(merged.values(), dtype=np.float64, count=len(merged))
+        return terms, weights
+
+    def top_k(self, terms, weights, k, mask=None):
+        """
+        Selects the k recipes with the highest score for a query with MaxScore.
+        Terms are read from the highest bound down, one posting list at a time.
+        Once the bounds of the terms left sum to less than the k-th score so
+        far, no recipe without a match yet can make the top k: the remaining
+        lists are only searched for the candidates, which are dropped as soon
+        as their bound falls below the k-th score. The long lists of common
+        terms have the lowest bounds, so they are usually only searched.
+
+        Ties are broken by corpus order, like algorithm.top_k.
+
+        Args:
+            terms (np.ndarray): The term indices of the query, see query.
+            weights (np.ndarray): The weight of each term.
+            k (int): Number of recipes to return.
+            mask (np.ndarray): Optional boolean array of rows that may be returned.
+
+        Returns:
+            tuple: The rows of the top k recipes with a match, best first, and
+                their scores.
+        """
+        bounds = weights * self.max_impacts[terms]
+        order = np.argsort(-bounds, kind="stable")
+        terms, weights, bounds = terms[order], weights[order], bounds[order]
+        # rest[i] is the most the terms from i on can add to a recipe
+        rest = np.append(np.cumsum(bounds[::-1])[::-1], 0)
+
+        rows = np.empty(0, dtype=np.int32)
+        scores = np.empty(0, dtype=np.float64)
+        threshold = 0.0
+        for i, (term, weight) in enumerate(zip(terms.tolist(), weights.tolist())):
+            postings, impacts = self.term_postings(term)
+            if rest[i] >= threshold:
+                # A recipe without a match yet can still reach the top k
+                if mask is not None:
+                    keep = mask[postings]
+                    postings, impacts = postings[keep], impacts[keep]
+                rows, inverse = np.unique(
+                    np.concatenate([rows, postings]), return_inverse=True
+                )
+                scores = np.bincount(
+                    inverse,
+                    np.concatenate([scores, weight * impacts]),
+                    minlength=len(rows),
+                )
+            else:
+                scores += weight * self.term_impacts(term, rows)
+
+            if len(rows) >= k > 0:
+                threshold = -np.partition(-scores, k - 1)[k - 1]
+                if rest[i + 1] < threshold:
+                    keep = scores + rest[i + 1] >= threshold
+                    rows, scores = rows[keep], scores[keep]
+
+        top = algorithm.top_k(scores, k)
+        return rows[top], scores[top]
+
+    def accumulate(self, terms, weights, out, scale=1.0):
+        """
+        Adds scale times the score of every recipe for a query to out, reading
+        only the postings of the query terms.
+        """
+        for term, weight in zip(terms.tolist(), weights.tolist()):
+            postings, impacts = self.term_postings(term)
+            # A recipe is at most once in a list, so this adds every impact
+            out[postings] += scale * weight * impacts
+
+    def lookup(self, terms, weights, rows):
+        """
+        Scores the recipes at the given sorted rows for a query, searching the
+        postings of the query terms for them.
+        """
+        scores = np.zeros(len(rows), dtype=np.float64)
+        for term, weight in zip(terms.tolist(), weights.tolist()):
+            scores += weight * self.term_impacts(term, rows)
+        return scores
+
+    def fuse(self, queries, svd_scores, rows=None):
+        """
+        Combines the SVD scores of every query with its lexical scores,
+        weighted by self.weight.
+
+        Args:
+            queries (list): The queries.
+            svd_scores (np.ndarray): A (num_queries, num_rows) matrix of SVD
+                scores, see algorithm.score_queries. It is updated in place.
+            rows (np.ndarray): The sorted rows scored in svd_scores, or None for
+                every row.
+
+        Returns:
+            np.ndarray: The fused scores.
+        """
+        svd_scores *= 1 - self.weight
+        for query, member_scores in zip(queries, svd_scores):
+            terms, weights = self.query(query)
+            if rows is None:
+                self.accumulate(terms, weights, member_scores, self.weight)
+            else:
+                member_scores += self.weight * self.lookup(terms, weights, rows)
+        return svd_scores
+
+
+def build_lexical_index(
+    inverted_index,
+    recipe_ids,
+    scorer="bm25",
+    idf=None,
+    recipe_norms=None,
+    weight=1.0,
+):
+    """
+    Builds a LexicalIndex from the outputs of data_processing. Recipes are in
+    a posting list at most once, so a term occurs once in a recipe.
+
+    Args:
+        inverted_index (dict): Term to the IDs of the recipes that contain it.
+        recipe_ids (list): The recipe ID of every row of the SVD matrix. A
+            recipe ID with several rows, see ingest.py, maps to the last one.
+        scorer (str): One of SCORERS.
+        idf (dict): Term to idf, see data_processing.build_idf. Required for
+            tfidf.
+        recipe_norms (dict): Recipe ID to norm, see
+            data_processing.build_recipe_norms. Required for tfidf.
+        weight (float): See LexicalIndex.
+
+    Returns:
+        LexicalIndex: The index.
+    """
+    if scorer not in SCORERS:
+        raise ValueError(f"Unknown lexical scorer {scorer!r}")
+
+    terms = {term: i for i, term in enumerate(inverted_index)}
+    lengths = np.fromiter(
+        (len(postings) for postings in inverted_index.values()),
+        dtype=np.int64,
+        count=len(terms),
+    )
+    ids = np.fromiter(
+        itertools.chain.from_iterable(inverted_index.values()),
+        dtype=np.int64,
+        count=int(lengths.sum()),
+    )
+    term_of = np.repeat(np.arange(len(terms)), lengths)
+
+    # Recipe ID to row through a table indexed by ID, since recipe IDs are
+    # small integers
+    row_ids = np.asarray([int(i) for i in recipe_ids], dtype=np.int64)
+    id_to_row = np.full(
+        max(row_ids.max(initial=0), ids.max(initial=0)) + 1, -1, dtype=np.int64
+    )
+    np.maximum.at(id_to_row, row_ids, np.arange(len(row_ids)))
+    rows = id_to_row[ids]
+    found = rows >= 0
+    rows, term_of = rows[found], term_of[found]
+
+    # Postings are grouped by term already and usually in row order, which the
+    # stable sort is fastest on
+    order = np.argsort(term_of * len(row_ids) + rows, kind="stable")
+    rows, term_of = rows[order], term_of[order]
+    offsets = np.zeros(len(terms) + 1, dtype=np.int64)
+    np.cumsum(np.bincount(term_of, minlength=len(terms)), out=offsets[1:])
+    df = np.diff(offsets)
+
+    if scorer == "bm25":
+        # The length of a recipe is its number of distinct terms
+        doc_lengths = np.bincount(rows, minlength=len(row_ids)).astype(np.float64)
+        num_recipes = max(np.count_nonzero(doc_lengths), 1)
+        avg_length = doc_lengths[doc_lengths > 0].mean() if len(rows) else 1.0
+        term_idf = np.log(1 + (num_recipes - df + 0.5) / (df + 0.5))
+        impacts = term_idf[term_of] * (
+            (BM25_K1 + 1)
+            / (1 + BM25_K1 * (1 - BM25_B + BM25_B * doc_lengths[rows] / avg_length))
+        )
+        term_weights = np.ones(len(terms))
+    else:
+        if idf is None or recipe_norms is None:
+            raise ValueError("The tfidf scorer needs idf and recipe_norms")
+        # Terms in nearly every recipe have a negative idf, which would break
+        # the bounds of MaxScore. They carry no signal, so they count for 0.
+        term_idf = np.maximum(
+            np.fromiter((idf[term] for term in terms), np.float64, len(terms)), 0
+        )
+        # JSON keys are strings
+        norms = {str(i): norm for i, norm in recipe_norms.items()}
+        doc_norms = np.fromiter(
+            (norms.get(str(i), 0) for i in recipe_ids), np.float64, len(recipe_ids)
+        )[rows]
+        impacts = np.divide(
+            term_idf[term_of], doc_norms, out=np.zeros(len(rows)), where=doc_norms > 0
+        )
+        term_weights = term_idf
+
+    return LexicalIndex(
+        terms,
+        offsets,
+        rows.astype(np.int32),
+        impacts.astype(np.float32),
+        term_weights,
+        weight,
+    )
@@ -0,0 +1,212 @@
+import argparse
+import json
+import os
+import time
+
+import algorithm
+import artifacts
+import numpy as np
+
+INT8_CODES_FILE = "embeddings.i8"
+INT8_SCALES_FILE = "embedding_scales.f32"
+
+
+class Int8Embeddings(object):
+    """
+    Row-normalized embeddings quantized to int8 with one float32 scale per row,
+    a quarter of the size of the float32 matrix. Scores against it are
+    approximate, so they only pick the candidates that are then scored against
+    the full precision matrix.
+    """
+
+    def __init__(self, codes, scales, rerank=4, block_size=2048):
+        """
+        Args:
+            codes (np.ndarray): A (num_recipes, n_components) int8 matrix.
+            scales (np.ndarray): Row i is approximately codes[i] * scales[i].
+            rerank (int): Default number of candidates re-scored at full
+                precision per result.
+            block_size (int): Number of rows converted to float32 at a time
+                while scoring, small enough to stay in cache.
+        """
+        self.codes = codes
+        self.scales = scales
+        self.rerank = rerank
+        self.block_size = block_size
+
+    def __len__(self):
+        return len(self.codes)
+
+    @property
+    def nbytes(self):
+        return self.codes.nbytes + self.scales.nbytes
+
+    def scores(self, query):
+        """
+        Approximates the dot product of a query with every row.
+
+        Args:
+            query (np.ndarray): The query embedding. For a group, the sum of the
+                member embeddings, since the group score is a sum of dot products.
+
+        Returns:
+            np.ndarray: The approximate score of every row.
+        """
+        query = query.astype(np.float32)
+        scores = np.empty(len(self.codes), dtype=np.float32)
+        for start in range(0, len(self.codes), self.block_size):
+            block = self.codes[start : start + self.block_size]
+            np.matmul(
+                block.astype(np.float32), query, out=scores[start : start + len(block)]
+            )
+        scores *= self.scales
+        return scores
+
+    def candidates(self, query, n, mask=None):
+        """
+        Finds the rows with the n highest approximate scores.
+
+        Args:
+            query (np.ndarray): The query embedding, see scores.
+            n (int): Number of candidates.
+            mask (np.ndarray): Optional boolean array of rows that may be returned.
+
+        Returns:
+            np.ndarray: The candidate row indices, in increasing order.
+        """
+        return np.sort(algorithm.top_k(self.scores(query), n, mask))
+
+    def add(self, embeddings):
+        """
+        Quantizes new rows and returns the quantized embeddings of the old and
+        the new rows.
+        """
+        added = quantize_int8(embeddings)
+        return Int8Embeddings(
+            np.concatenate([self.codes, added.codes]),
+            np.concatenate([self.scales, added.scales]),
+            self.rerank,
+            self.block_size,
+        )
+
+    def save(self, path):
+        """
+        Writes the quantized embeddings into a bundle directory.
+        """
+        self.codes.astype(np.int8).tofile(os.path.join(path, INT8_CODES_FILE))
+        self.scales.astype(np.float32).tofile(os.path.join(path, INT8_SCALES_FILE))
+
+    @classmethod
+    def load(cls, path, n_components, rerank=4):
+        """
+        Loads quantized embeddings saved into a bundle directory, or returns
+        None if the bundle has none.
+        """
+        if not os.path.exists(os.path.join(path, INT8_CODES_FILE)):
+            return None
+        codes = np.memmap(os.path.join(path, INT8_CODES_FILE), np.int8, mode="r")
+        scales = np.fromfile(os.path.join(path, INT8_SCALES_FILE), np.float32)
+        return cls(codes.reshape(-1, n_components), scales, rerank)
+
+
+def quantize_int8(embeddings, batch_size=65536):
+    """
+    Quantizes every row symmetrically, scaling its largest absolute value to
+    127.
+
+    Args:
+        embeddings (np.ndarray): The row-normalized embedding matrix.
+        batch_size (int): Number of rows quantized at a time, to bound memory.
+
+    Returns:
+        Int8Embeddings: The quantized embeddings.
+    """
+    codes = np.empty(embeddings.shape, dtype=np.int8)
+    scales = np.empty(len(embeddings), dtype=np.float32)
+    for start in range(0, len(embeddings), batch_size):
+        batch = np.asarray(embeddings[start : start + batch_size], dtype=np.float32)
+        batch_scales = np.abs(batch).max(axis=1) / 127
+        batch_scales[batch_scales == 0] = 1
+        codes[start : start + len(batch)] = np.rint(batch / batch_scales[:, None])
+        scales[start : start + len(batch)] = batch_scales
+    return Int8Embeddings(codes, scales)
+
+
+def agreement_report(
+    quantized, embeddings, k=10, depths=(10, 20, 40, 80), n_queries=200, seed=0
+):
+    """
+    Compares the top k of quantized search, re-ranked at full precision, with
+    the top k of exact search, for every number of re-ranked candidates. Queries
+    are groups of one to six perturbed recipe embeddings.
+
+    Args:
+        quantized (Int8Embeddings): The quantized embeddings.
+        embeddings (np.ndarray): The row-normalized embedding matrix.
+        k (int): Number of results per query.
+        depths (tuple): The numbers of candidates re-ranked per query.
+        n_queries (int): Number of queries.
+        seed (int): Seed for the queries.
+
+    Returns:
+        list: A dict with the number of candidates, mean recall@k, the share of
+            queries with the exact top k in the exact order and the mean latency
+            in milliseconds, for every depth.
+    """
+    rng = np.random.default_rng(seed)
+    queries = []
+    for _ in range(n_queries):
+        members = embeddings[rng.choice(len(embeddings), rng.integers(1, 7))]
+        members = members + rng.normal(0, 0.05, members.shape)
+        queries.append(algorithm.normalize_rows(members).sum(axis=0))
+
+    exact = [
+        algorithm.top_k(embeddings @ q.astype(embeddings.dtype), k).tolist()
+        for q in queries
+    ]
+
+    report = []
+    for depth in depths:
+        recall, identical, elapsed = 0, 0, 0
+        for query, expected in zip(queries, exact):
+            start = time.perf_counter()
+            rows = quantized.candidates(query, depth)
+            scores = embeddings[rows] @ query.astype(embeddings.dtype)
+            found = rows[algorithm.top_k(scores, k)].tolist()
+            elapsed += time.perf_counter() - start
+            recall += len(set(expected).intersection(found)) / len(expected)
+            identical += found == expected
+        report.append(
+            {
+                "candidates": depth,
+                f"recall@{k}": recall / n_queries,
+                "identical": identical / n_queries,
+                "mean_ms": 1000 * elapsed / n_queries,
+            }
+        )
+    return report
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Quantizes the embeddings of a bundle to int8 and reports the "
+        "agreement of quantized search with exact search"
+    )
+    parser.add_argument("bundle", help="path to the bundle directory")
+    parser.add_argument("--depths", default="10,20,40,80")
+    parser.add_argument("--k", type=int, default=10)
+    parser.add_argument("--queries", type=int, default=200)
+    parser.add_argument("--save", action="store_true", help="save into the bundle")
+    args = parser.parse_args()
+
+    bundle = artifacts.load_bundle(args.bundle)
+    quantized = quantize_int8(bundle.svd)
+    print(
+        f"float32 {bundle.svd.nbytes / 2**20:.1f} MB, "
+        f"int8 {quantized.nbytes / 2**20:.1f} MB"
+    )
+    depths = [int(d) for d in args.depths.split(",")]
+    for row in agreement_report(quantized, bundle.svd, args.k, depths, args.queries):
+        print(json.dumps(row))
+    if args.save:
+        quantized.save(args.bundle)
@@ -1,4 +1,5 @@
 import re
+import unicodedata
 
 
 def tokenize(text):
@@ -14,7 +15,500 @@ def tokenize(text):
     return re.findall(r"[a-z]+", text.lower())
 
 
-def dietary_restrictions_check(recipe):
+def normalize(text):
+    """
+    Strips accents so that e.g. "pâté" is tokenized as "pate".
+    """
+    if text.isascii():
+        return text
+    decomposed = unicodedata.normalize("NFKD", text)
+    return "".join(c for c in decomposed if not unicodedata.combining(c))
+
+
+# A double quoted string of an R character vector, with backslash escapes
+R_STRING = re.compile(r'"([^"\\]*(?:\\.[^"\\]*)*)"')
+R_ESCAPE = re.compile(r"\\(.)")
+R_ESCAPES = {"n": "\n", "t": "\t", "r": "\r"}
+
+
+def unescape(match):
+    return R_ESCAPES.get(match.group(1), match.group(1))
+
+
+def parse_vector(field):
+    """
+    Decodes an R character vector as found in the food.com dump, e.g.
+    c("6\\" tortillas", "salsa"), in one pass over the string. Escaped quotes
+    stay inside their element, character(0) and NA are empty, unquoted NA
+    elements are skipped and a single quoted string is a vector of one.
+
+    Args:
+        field (str): The raw field.
+
+    Returns:
+        list: The strings of the vector.
+    """
+    if '"' not in field:
+        return []
+    if "\\" not in field:
+        return R_STRING.findall(field)
+    return [
+        R_ESCAPE.sub(unescape, value) if "\\" in value else value
+        for value in R_STRING.findall(field)
+    ]
+
+
+# Separates the phrases of recipe_tokens. It is not a word, so no term matches
+# across it.
+PHRASE_BREAK = "|"
+PHRASE_TOKEN = re.compile(r"[a-z]+|\|")
+
+
+def recipe_tokens(recipe, ingredients=None, keywords=None):
+    """
+    Tokenizes the text a recipe is classified and indexed by: its name, every
+    ingredient, every keyword and its category, with PHRASE_BREAK between them
+    so that a multi-word term only matches within one of them. The text is
+    joined and tokenized in one go.
+
+    Args:
+        recipe (dict): The raw recipe.
+        ingredients (list): The parsed ingredients, if already parsed.
+        keywords (list): The parsed keywords, if already parsed.
+
+    Returns:
+        list: The tokens.
+    """
+    if ingredients is None:
+        ingredients = parse_vector(recipe["RecipeIngredientParts"])
+    if keywords is None:
+        keywords = parse_vector(recipe["Keywords"])
+    # A phrase break in the text itself only splits a phrase further
+    text = " | ".join(
+        (recipe["Name"], *ingredients, *keywords, recipe["RecipeCategory"])
+    )
+    return PHRASE_TOKEN.findall(normalize(text).lower())
+
+
+def parse_recipe(recipe):
+    """
+    Decodes the R vector fields of a raw recipe once, for parse_ingredients,
+    parse_image, parse_instructions, the dietary classifier and the inverted
+    index to share.
+
+    Args:
+        recipe (dict): The raw recipe, a row of the CSV.
+
+    Returns:
+        dict: The ingredients, keywords, images and instruction steps as lists
+            of strings, and the tokens of recipe_tokens.
+    """
+    ingredients = parse_vector(recipe["RecipeIngredientParts"])
+    keywords = parse_vector(recipe["Keywords"])
+    return {
+        "ingredients": ingredients,
+        "keywords": keywords,
+        "images": parse_vector(recipe["Images"]),
+        "instructions": parse_vector(recipe["RecipeInstructions"]),
+        "tokens": recipe_tokens(recipe, ingredients, keywords),
+    }
+
+
+def parse_recipe_batch(recipes):
+    """
+    Runs parse_recipe on many recipes at once.
+
+    Args:
+        recipes (iterable): The raw recipes.
+
+    Returns:
+        list: The parsed fields of every recipe.
+    """
+    return [parse_recipe(recipe) for recipe in recipes]
+
+
+# Sets of terms that indicate the recipe is not vegan, vegetarian, gluten free,
+# dairy free, or nut free
+VEGETARIAN_TERMS = {
+    "beef",
+    "pork",
+    "chicken",
+    "fish",
+    "seafood",
+    "clam",
+    "clams",
+    "shrimp",
+    "mussel",
+    "mussels",
+    "oyster",
+    "oysters",
+    "meat",
+    "bacon",
+    "pancetta",
+    "prosciutto",
+    "lamb",
+    "turkey",
+    "duck",
+    "goose",
+    "rabbit",
+    "venison",
+    "veal",
+    "ham",
+    "salmon",
+    "tuna",
+    "sardines",
+    "sardine",
+    "anchovies",
+    "trout",
+    "mackerel",
+    "herring",
+    "sausage",
+    "sausages",
+    "pepperoni",
+    "salami",
+    "bologna",
+    "pastrami",
+    "spam",
+    "steak",
+    "squid",
+    "octopus",
+    "crab",
+    "lobster",
+    "pâté",
+    "bratwurst",
+    "chorizo",
+    "capicola",
+    "corned beef",
+    "rib",
+    "ribs",
+    "brisket",
+    "grouper",
+    "swordfish",
+    "snail",
+    "escargot",
+    "caviar",
+    "roe",
+    "quail",
+    "pheasant",
+    "partridge",
+    "frog",
+    "buffalo",
+    "bison",
+    "elk",
+    "gyro",
+    "kebab",
+    "cod",
+    "flounder",
+    "halibut",
+    "catfish",
+    "monkfish",
+    "perch",
+    "scallop",
+    "scallops",
+}
+
+VEGAN_TERMS = {
+    "milk",
+    "cheese",
+    "butter",
+    "cream",
+    "yogurt",
+    "gelatin",
+    "honey",
+    "eggs",
+    "egg",
+    "lard",
+    "casein",
+    "whey",
+    "ghee",
+    "kefir",
+    "rennet",
+    "beeswax",
+    "carmine",
+    "shellac",
+    "lanolin",
+    "suet",
+    "tallow",
+    "bone char",
+    "isenglass",
+    "vitamin D3 from animal sources",
+    "albumen",
+    "cod liver oil",
+    "fish oil",
+    "collagen",
+    "elastin",
+    "keratin",
+    "cheesy",
+}
+
+GLUTEN_FREE_TERMS = {
+    "wheat",
+    "barley",
+    "rye",
+    "malt",
+    "yeast",
+    "triticale",
+    "bread",
+    "pasta",
+    "cereal",
+    "flour",
+    "breadcrumbs",
+    "croutons",
+    "couscous",
+    "farina",
+    "semolina",
+    "spelt",
+    "bulgur",
+    "durum",
+    "noodle",
+    "noodles",
+    "spaghetti",
+    "seitan",
+    "matzo",
+    "pita",
+    "bagel",
+    "bagels",
+    "biscuit",
+    "biscuits",
+    "cake",
+    "cakes",
+    "pastry",
+    "pastries",
+    "doughnut",
+    "doughnuts",
+    "pretzel",
+    "pretzels",
+    "pie",
+    "pies",
+    "beer",
+    "graham",
+    "pancake",
+    "pancakes",
+    "waffle",
+    "waffles",
+    "rye bread",
+    "sourdough",
+    "ciabatta",
+    "focaccia",
+    "brewer's yeast",
+    "vital wheat gluten",
+    "hydrolyzed wheat protein",
+}
+
+DAIRY_FREE_TERMS = {
+    "milk",
+    "cheese",
+    "butter",
+    "cream",
+    "yogurt",
+    "lactose",
+    "whey",
+    "casein",
+    "ghee",
+    "curds",
+    "custard",
+    "sour cream",
+    "ice cream",
+    "kefir",
+    "buttermilk",
+    "paneer",
+    "ricotta",
+    "brie",
+    "camembert",
+    "cheddar",
+    "mozzarella",
+    "parmesan",
+    "feta",
+    "mascarpone",
+    "provolone",
+    "gorgonzola",
+    "colby",
+    "monterey jack",
+    "lactalbumin",
+    "lactoglobulin",
+    "lactoferrin",
+    "caseinate",
+    "condensed milk",
+    "evaporated milk",
+    "dulce de leche",
+    "milkfat",
+    "cheesy",
+}
+
+NUT_FREE_TERMS = {
+    "almond",
+    "hazelnut",
+    "walnut",
+    "cashew",
+    "pecan",
+    "pistachio",
+    "macadamia",
+    "nut",
+    "nutty",
+    "peanut",
+    "peanuts",
+    "chestnut",
+    "beechnut",
+    "pinenut",
+    "tigernut",
+    "marzipan",
+    "praline",
+    "gianduja",
+    "nougat",
+    "frangipane",
+    "nutella",
+}
+
+
+class DietaryClassifier(object):
+    """
+    Tags the dietary restrictions a recipe breaks in a single pass over its
+    tokens. The term lists are compiled once into a dictionary from each term's
+    first word to the restrictions it breaks, plus the remaining words of the
+    multi-word terms starting with that word, so terms like "sour cream" match
+    as a phrase while single-word terms behave like a set lookup.
+
+    A negation like "gluten free" keeps the rest of its phrase from breaking
+    that restriction, so "gluten-free flour" or a "Lactose Free" keyword do not
+    count against gluten_free or dairy_free. The other restrictions of the
+    phrase still apply, e.g. "dairy-free cheese" is not taken to be vegan.
+    """
+
+    RESTRICTIONS = ("vegan", "vegetarian", "gluten_free", "dairy_free", "nut_free")
+
+    def __init__(self, terms, implies, negations=None):
+        """
+        Args:
+            terms (dict): Restriction name to the set of terms that break it.
+            implies (dict): Restriction name to the other restrictions that are
+                broken along with it, e.g. a non-vegetarian recipe is not vegan.
+            negations (dict): Word to the restriction that "<word> free" keeps
+                the rest of its phrase from breaking.
+        """
+        self.all_bits = (1 << len(self.RESTRICTIONS)) - 1
+        self.negations = {
+            word: self.bits(name) for word, name in (negations or {}).items()
+        }
+
+        phrases = {}
+        for name, restriction_terms in terms.items():
+            bits = self.bits(name)
+            for other in implies.get(name, ()):
+                bits |= self.bits(other)
+            for term in restriction_terms:
+                phrase = tuple(tokenize(normalize(term)))
+                phrases[phrase] = phrases.get(phrase, 0) | bits
+
+        # A phrase also breaks everything its own sub-phrases break, so a match
+        # of "fish oil" keeps the restrictions broken by "fish"
+        for phrase in phrases:
+            for start in range(len(phrase)):
+                for end in range(start + 1, len(phrase) + 1):
+                    phrases[phrase] |= phrases.get(phrase[start:end], 0)
+
+        self.single = {}
+        self.multi = {}
+        for phrase, bits in phrases.items():
+            if len(phrase) == 1:
+                self.single[phrase[0]] = bits
+            elif phrase:
+                self.multi.setdefault(phrase[0], []).append((phrase[1:], bits))
+
+    def bits(self, name):
+        return 1 << self.RESTRICTIONS.index(name)
+
+    def classify_bits(self, recipe, parsed=None):
+        """
+        Args:
+            recipe (dict): The raw recipe.
+            parsed (dict): The output of parse_recipe for it, if already parsed.
+
+        Returns:
+            int: A bitmask, in the order of RESTRICTIONS, of the restrictions the
+                recipe breaks.
+        """
+        tokens = parsed["tokens"] if parsed else recipe_tokens(recipe)
+        if self.negations and "free" in tokens:
+            return self.negated_bits(tokens)
+        broken = 0
+        for i, token in enumerate(tokens):
+            broken |= self.single.get(token, 0)
+            for rest, bits in self.multi.get(token, ()):
+                if tuple(tokens[i + 1 : i + 1 + len(rest)]) == rest:
+                    broken |= bits
+        return broken
+
+    def negated_bits(self, tokens):
+        """
+        classify_bits one phrase at a time, leaving out the restrictions negated
+        within each phrase.
+        """
+        broken = phrase_broken = negated = 0
+        for i, token in enumerate(tokens):
+            if token == PHRASE_BREAK:
+                broken |= phrase_broken & ~negated
+                phrase_broken = negated = 0
+                continue
+            if token in self.negations and tokens[i + 1 : i + 2] == ["free"]:
+                # The negated word is not an ingredient itself
+                negated |= self.negations[token]
+                continue
+            phrase_broken |= self.single.get(token, 0)
+            for rest, bits in self.multi.get(token, ()):
+                if tuple(tokens[i + 1 : i + 1 + len(rest)]) == rest:
+                    phrase_broken |= bits
+        return broken | (phrase_broken & ~negated)
+
+    def classify(self, recipe, parsed=None):
+        """
+        Returns:
+            dict: Restriction name to whether the recipe satisfies it.
+        """
+        broken = self.classify_bits(recipe, parsed)
+        return {
+            name: not broken & (1 << bit) for bit, name in enumerate(self.RESTRICTIONS)
+        }
+
+    def classify_batch(self, recipes, parsed=None):
+        """
+        Classifies many recipes at once.
+
+        Args:
+            recipes (list): The recipe dictionaries.
+            parsed (list): The output of parse_recipe_batch for them, if already
+                parsed.
+
+        Returns:
+            list: The output of classify for every recipe.
+        """
+        if parsed is None:
+            return [self.classify(recipe) for recipe in recipes]
+        return [self.classify(recipe, p) for recipe, p in zip(recipes, parsed)]
+
+
+DIETARY_CLASSIFIER = DietaryClassifier(
+    {
+        "vegetarian": VEGETARIAN_TERMS,
+        "vegan": VEGAN_TERMS,
+        "gluten_free": GLUTEN_FREE_TERMS,
+        "dairy_free": DAIRY_FREE_TERMS,
+        "nut_free": NUT_FREE_TERMS,
+    },
+    # If it's not vegetarian or not dairy free, it's not vegan
+    {"vegetarian": ("vegan",), "dairy_free": ("vegan",)},
+    {
+        "gluten": "gluten_free",
+        "wheat": "gluten_free",
+        "dairy": "dairy_free",
+        "lactose": "dairy_free",
+        "milk": "dairy_free",
+        "nut": "nut_free",
+        "peanut": "nut_free",
+    },
+)
+
+
+def dietary_restrictions_check(recipe, parsed=None):
     """
     Returns a dictionary of dietary restrictions and a boolean value for each restriction.
     We initially assume that the recipe is vegan, vegetarian, gluten free, dairy free, and nut free,
@@ -22,6 +516,7 @@ def dietary_restrictions_check(recipe):
 
     Args:
         recipe (dict): The recipe dictionary.
+        parsed (dict): The output of parse_recipe for it, if already parsed.
 
     Returns:
         dict: A dictionary of dietary restrictions and a boolean value for each restriction.
@@ -34,306 +529,77 @@ def dietary_restrictions_check(recipe):
             "nut_free" : bool,
             }
     """
-    # Sets of terms that indicate the recipe is not vegan, vegetarian, gluten free,
-    # dairy free, or nut free
-    vegetarian_terms = {
-        "beef",
-        "pork",
-        "chicken",
-        "fish",
-        "seafood",
-        "clam",
-        "clams",
-        "shrimp",
-        "mussel",
-        "mussels",
-        "oyster",
-        "oysters",
-        "meat",
-        "bacon",
-        "pancetta",
-        "prosciutto",
-        "lamb",
-        "turkey",
-        "duck",
-        "goose",
-        "rabbit",
-        "venison",
-        "veal",
-        "ham",
-        "salmon",
-        "tuna",
-        "sardines",
-        "sardine",
-        "anchovies",
-        "trout",
-        "mackerel",
-        "herring",
-        "sausage",
-        "sausages",
-        "pepperoni",
-        "salami",
-        "bologna",
-        "pastrami",
-        "spam",
-        "steak",
-        "squid",
-        "octopus",
-        "crab",
-        "lobster",
-        "pâté",
-        "bratwurst",
-        "chorizo",
-        "capicola",
-        "corned beef",
-        "rib",
-        "ribs",
-        "brisket",
-        "grouper",
-        "swordfish",
-        "snail",
-        "escargot",
-        "caviar",
-        "roe",
-        "quail",
-        "pheasant",
-        "partridge",
-        "frog",
-        "buffalo",
-        "bison",
-        "elk",
-        "gyro",
-        "kebab",
-        "cod",
-        "flounder",
-        "halibut",
-        "catfish",
-        "monkfish",
-        "perch",
-        "scallop",
-        "scallops",
-    }
-    vegan_terms = {
-        "milk",
-        "cheese",
-        "butter",
-        "cream",
-        "yogurt",
-        "gelatin",
-        "honey",
-        "eggs",
-        "egg",
-        "lard",
-        "casein",
-        "whey",
-        "ghee",
-        "kefir",
-        "rennet",
-        "beeswax",
-        "carmine",
-        "shellac",
-        "lanolin",
-        "suet",
-        "tallow",
-        "bone char",
-        "isenglass",
-        "vitamin D3 from animal sources",
-        "albumen",
-        "cod liver oil",
-        "fish oil",
-        "collagen",
-        "elastin",
-        "keratin",
-        "cheesy",
-    }
-    gluten_free_terms = {
-        "wheat",
-        "barley",
-        "rye",
-        "malt",
-        "yeast",
-        "triticale",
-        "bread",
-        "pasta",
-        "cereal",
-        "flour",
-        "breadcrumbs",
-        "croutons",
-        "couscous",
-        "farina",
-        "semolina",
-        "spelt",
-        "bulgur",
-        "durum",
-        "noodle",
-        "noodles",
-        "spaghetti",
-        "seitan",
-        "matzo",
-        "pita",
-        "bagel",
-        "bagels",
-        "biscuit",
-        "biscuits",
-        "cake",
-        "cakes",
-        "pastry",
-        "pastries",
-        "doughnut",
-        "doughnuts",
-        "pretzel",
-        "pretzels",
-        "pie",
-        "pies",
-        "beer",
-        "graham",
-        "pancake",
-        "pancakes",
-        "waffle",
-        "waffles",
-        "rye bread",
-        "sourdough",
-        "ciabatta",
-        "focaccia",
-        "brewer's yeast",
-        "vital wheat gluten",
-        "hydrolyzed wheat protein"
-    }
-    dairy_free_terms = {
-        "milk",
-        "cheese",
-        "butter",
-        "cream",
-        "yogurt",
-        "lactose",
-        "whey",
-        "casein",
-        "ghee",
-        "curds",
-        "custard",
-        "sour cream",
-        "ice cream",
-        "kefir",
-        "buttermilk",
-        "paneer",
-        "ricotta",
-        "brie",
-        "camembert",
-        "cheddar",
-        "mozzarella",
-        "parmesan",
-        "feta",
-        "mascarpone",
-        "provolone",
-        "gorgonzola",
-        "colby",
-        "monterey jack",
-        "lactalbumin",
-        "lactoglobulin",
-        "lactoferrin",
-        "caseinate",
-        "condensed milk",
-        "evaporated milk",
-        "dulce de leche",
-        "milkfat",
-        "cheesy",
-    }
-    nut_free_terms = {
-        "almond",
-        "hazelnut",
-        "walnut",
-        "cashew",
-        "pecan",
-        "pistachio",
-        "macadamia",
-        "nut",
-        "nutty",
-        "peanut",
-        "peanuts",
-        "chestnut",
-        "beechnut",
-        "pinenut",
-        "tigernut",
-        "marzipan",
-        "praline",
-        "gianduja",
-        "nougat",
-        "frangipane",
-        "nutella",
-    }
+    return DIETARY_CLASSIFIER.classify(recipe, parsed)
 
-    # Initialize all dietary restrictions to True
-    vegetarian = True
-    vegan = True
-    gluten_free = True
-    dairy_free = True
-    nut_free = True
-
-    # Tokenize the relevant fields of the recipe
-    tokens = set(
-        tokenize(recipe["Name"])
-        + tokenize(recipe["RecipeIngredientParts"][1:])
-        + tokenize(recipe["Keywords"][1:])
-        + tokenize(recipe["RecipeCategory"])
-    )
 
-    # Check if any of the dietary restriction terms are in the tokens
-    for term in tokens:
-        # If it's not vegetarian, it's not vegan
-        if term in vegetarian_terms:
-            vegetarian = False
-            vegan = False
-        if term in dairy_free_terms:
-            dairy_free = False
-            vegan = False
-        if term in vegan_terms:
-            vegan = False
-        if term in gluten_free_terms:
-            gluten_free = False
-        if term in nut_free_terms:
-            nut_free = False
+def dietary_restrictions_check_batch(recipes, parsed=None):
+    """
+    Runs dietary_restrictions_check on many recipes at once.
 
-    return {
-        "vegan": vegan,
-        "vegetarian": vegetarian,
-        "gluten_free": gluten_free,
-        "dairy_free": dairy_free,
-        "nut_free": nut_free,
-    }
+    Args:
+        recipes (list): The recipe dictionaries.
+        parsed (list): The output of parse_recipe_batch for them, if already
+            parsed.
 
+    Returns:
+        list: The dietary restrictions of every recipe.
+    """
+    return DIETARY_CLASSIFIER.classify_batch(recipes, parsed)
 
-def parse_ingredients(recipe):
+
+def parse_ingredients(recipe, parsed=None):
     """
     Takes in the recipe and returns a list of the ingredients.
     """
-    ingredients = recipe["RecipeIngredientParts"]
-    ingredients = re.findall(r'"(.*?)"', ingredients)
-    return ingredients
+    if parsed is not None:
+        return parsed["ingredients"]
+    return parse_vector(recipe["RecipeIngredientParts"])
 
 
-def parse_image(recipe):
+def parse_image(recipe, parsed=None):
     """
     Image url is stored in a R format of c(<list of urls>). This function extracts
     the first url from the list.
 
     Args:
         recipe (dict): The recipe dictionary.
+        parsed (dict): The output of parse_recipe for it, if already parsed.
 
     Returns:
         str: The url of the image.
     """
-    image = recipe["Images"]
-    image = re.findall(r'"(.*?)"', image)
-    return image[0] if image else None
+    images = parsed["images"] if parsed is not None else parse_vector(recipe["Images"])
+    return images[0] if images else None
 
 
-def parse_instructions(recipe):
+def parse_instructions(recipe, parsed=None):
     """
     Takes in the recipe and returns a string of the instruction steps with a space after each period.
     """
-    instructions = recipe["RecipeInstructions"]
-    steps = re.findall(r'"(.*?)"', instructions)
-    i = ""
-    for step in steps:
-        i += step + " "
-    return i
+    if parsed is not None:
+        steps = parsed["instructions"]
+    else:
+        steps = parse_vector(recipe["RecipeInstructions"])
+    return "".join(step + " " for step in steps)
+
+
+ISO_DURATION = re.compile(r"^P(?:(\d+)D)?(?:T(?:(\d+)H)?(?:(\d+)M)?(?:(\d+)S)?)?$")
+
+
+def parse_minutes(duration):
+    """
+    Converts an ISO-8601 duration as found in the dataset, e.g. PT1H30M, into
+    minutes.
+
+    Args:
+        duration (str): The duration, or "NA".
+
+    Returns:
+        int: The duration in whole minutes, or None if it is missing or does not
+            parse.
+    """
+    match = ISO_DURATION.match(duration or "")
+    if match is None or not any(match.groups()):
+        return None
+    days, hours, minutes, seconds = (int(part or 0) for part in match.groups())
+    return days * 24 * 60 + hours * 60 + minutes + seconds // 60
@@ -0,0 +1,139 @@
+import os
+import threading
+
+import lru
+
+
+class MemoryRecipeStore(object):
+    """
+    Serves recipe details from the id_to_recipe of the release, held in memory.
+    """
+
+    def __init__(self, id_to_recipe):
+        self.id_to_recipe = id_to_recipe
+
+    def __contains__(self, recipe_id):
+        return str(recipe_id) in self.id_to_recipe
+
+    def get_many(self, recipe_ids, fields=None):
+        """
+        Looks up recipes by ID.
+
+        Args:
+            recipe_ids (list): The recipe IDs.
+            fields (iterable): Unused, every field is in memory.
+
+        Returns:
+            dict: Recipe ID to recipe, for the IDs found.
+        """
+        return {
+            recipe_id: self.id_to_recipe[str(recipe_id)]
+            for recipe_id in recipe_ids
+            if str(recipe_id) in self.id_to_recipe
+        }
+
+    def stats(self):
+        return None
+
+
+class DatabaseRecipeStore(object):
+    """
+    Serves recipe details from the recipes table of a database, see
+    MySQLDatabaseHandler.load_recipes, so that a worker only holds the columns
+    needed to rank and filter. The details of a page of results are read with
+    one IN (...) query, and recently shown recipes come from an LRU cache.
+
+    The table is not tied to a release: load it with the release, and ingest.py
+    --store upserts the recipes it adds before publishing them.
+    """
+
+    def __init__(self, url, fields, cache_entries=10000):
+        """
+        Args:
+            url (str): SQLAlchemy URL of the database.
+            fields (tuple): The fields read and cached for every recipe.
+            cache_entries (int): Number of recipes to cache.
+        """
+        self.url = url
+        self.fields = fields
+        self.cache = lru.LRUCache(max_entries=cache_entries)
+        self.handler = None
+        self.pid = None
+        self.lock = threading.Lock()
+
+    def __contains__(self, recipe_id):
+        # Whether a recipe has details is only known once it is looked up, and
+        # get_many drops the ones that do not
+        return True
+
+    def connection(self):
+        """
+        Returns the handler of this process. Pooled connections must not be
+        shared with forked workers, so each process opens its own pool.
+        """
+        # SQLAlchemy is only imported by servers with a database store
+        from helpers.MySQLDatabaseHandler import MySQLDatabaseHandler
+
+        with self.lock:
+            if self.pid != os.getpid():
+                self.handler = MySQLDatabaseHandler(
+                    None, None, None, None, url=self.url
+                )
+                self.pid = os.getpid()
+            return self.handler
+
+    def get_many(self, recipe_ids, fields=None):
+        """
+        Looks up recipes by ID, reading the ones that are not cached with one
+        query.
+
+        Args:
+            recipe_ids (list): The recipe IDs.
+            fields (iterable): The fields needed, out of self.fields. Recipes are
+                always read and cached with all of self.fields.
+
+        Returns:
+            dict: Recipe ID to recipe, for the IDs found.
+        """
+        recipes = {}
+        missing = []
+        for recipe_id in recipe_ids:
+            recipe = self.cache.get(int(recipe_id))
+            if recipe is None:
+                missing.append(int(recipe_id))
+            else:
+                recipes[recipe_id] = recipe
+        if missing:
+            found = self.connection().select_recipes(missing, self.fields)
+            for recipe_id, recipe in found.items():
+                self.cache.put(recipe_id, recipe)
+            for recipe_id in recipe_ids:
+                if int(recipe_id) in found:
+                    recipes[recipe_id] = found[int(recipe_id)]
+        return recipes
+
+    def stats(self):
+        return self.cache.stats()
+
+
+def build_recipe_store(id_to_recipe, fields):
+    """
+    Creates the recipe store of the engine. Details are served from memory
+    unless RECIPE_STORE_URL names a database holding the recipes table, in
+    which case RECIPE_CACHE_ENTRIES recipes are cached.
+
+    Args:
+        id_to_recipe (dict): The id_to_recipe of the release.
+        fields (tuple): The fields of a search result.
+
+    Returns:
+        The store, with get_many(recipe_ids, fields) and stats().
+    """
+    url = os.environ.get("RECIPE_STORE_URL")
+    if not url:
+        return MemoryRecipeStore(id_to_recipe)
+    return DatabaseRecipeStore(
+        url,
+        fields,
+        cache_entries=int(os.environ.get("RECIPE_CACHE_ENTRIES", 10000)),
+    )
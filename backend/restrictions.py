@@ -0,0 +1,85 @@
+import numpy as np
+
+# Every restriction gets one bit, in this order
+RESTRICTIONS = ("vegetarian", "vegan", "gluten_free", "dairy_free", "nut_free")
+
+
+def restriction_bits(dietary_restrictions):
+    """
+    Packs a dictionary of dietary restrictions into a bitmask.
+
+    Args:
+        dietary_restrictions (dict): Restriction name to a boolean value.
+
+    Returns:
+        int: The bitmask with a bit set for every restriction that is True.
+    """
+    bits = 0
+    for bit, name in enumerate(RESTRICTIONS):
+        if dietary_restrictions.get(name):
+            bits |= 1 << bit
+    return bits
+
+
+def build_restriction_index(id_to_recipe, recipe_ids=None):
+    """
+    Builds a packed bitmask of the restrictions each recipe satisfies, aligned
+    with the rows of the SVD matrix.
+
+    Args:
+        id_to_recipe (dict): Recipe ID to recipe.
+        recipe_ids (list): The recipe ID of every row of the SVD matrix. Defaults
+            to the order of id_to_recipe.
+
+    Returns:
+        np.ndarray: A uint8 array with the restriction bitmask of every recipe.
+    """
+    if recipe_ids is None:
+        recipe_ids = list(id_to_recipe.keys())
+    return np.fromiter(
+        (
+            restriction_bits(id_to_recipe[recipe_id]["dietary_restrictions"])
+            for recipe_id in recipe_ids
+        ),
+        dtype=np.uint8,
+        count=len(recipe_ids),
+    )
+
+
+def restriction_mask(restriction_index, dietary_restrictions):
+    """
+    Builds a boolean array marking the recipes that satisfy every requested
+    dietary restriction.
+
+    Args:
+        restriction_index (np.ndarray): The output of build_restriction_index.
+        dietary_restrictions (dict): Restriction name to whether it is requested.
+
+    Returns:
+        np.ndarray: The mask, or None if no restriction is requested.
+    """
+    required = restriction_bits(dietary_restrictions)
+    if not required:
+        return None
+    return (restriction_index & required) == required
+
+
+def restriction_counts(restriction_index):
+    """
+    Counts how many recipes satisfy each combination of restrictions.
+
+    Args:
+        restriction_index (np.ndarray): The output of build_restriction_index.
+
+    Returns:
+        dict: A "+"-joined combination of restriction names (or "none") to the
+            number of recipes satisfying all of them.
+    """
+    # Number of recipes with exactly each bitmask
+    exact = np.bincount(restriction_index, minlength=1 << len(RESTRICTIONS))
+    counts = {}
+    for required in range(1 << len(RESTRICTIONS)):
+        names = [n for bit, n in enumerate(RESTRICTIONS) if required & (1 << bit)]
+        supersets = [bits for bits in range(len(exact)) if bits & required == required]
+        counts["+".join(names) or "none"] = int(exact[supersets].sum())
+    return counts
@@ -0,0 +1,552 @@
+"""
+Sharded exact search: the embedding matrix, the restriction and filter columns
+and the recipe IDs of a release are split into contiguous row ranges, each
+served by a shard process, and a coordinator merges their answers into the
+exact top k. A shard only touches its own rows, so N shards scan a group on N
+cores, and the matrix only has to fit in the memory of all of them.
+
+Shards are servers on multiprocessing connections. The app starts SHARDS of
+them on this host, or connects to the SHARD_ADDRESSES of shards started on
+other hosts with the same output directory:
+
+    SHARD_AUTHKEY=secret python shards.py data --shard 0 --shards 4 --bind 0.0.0.0:7000
+
+Every call names the release of the coordinator, so a shard serving a release
+that was swapped in loads it on its first call, and keeps the last two.
+"""
+
+import argparse
+import atexit
+import json
+import os
+import queue
+import subprocess
+import sys
+import threading
+import traceback
+from multiprocessing.connection import Client, Listener
+
+import aggregation
+import algorithm
+import artifacts
+import filters
+import lru
+import numpy as np
+import restrictions
+import timing
+
+
+def shard_range(num_rows, shard, num_shards):
+    """
+    Returns the start and end row of a shard. Rows are split into contiguous
+    ranges, so corpus order is shard order, then row order within a shard.
+    """
+    return num_rows * shard // num_shards, num_rows * (shard + 1) // num_shards
+
+
+class Shard(object):
+    """
+    The rows of one shard of a release, and the scoring the coordinator asks
+    of them. Rows passed in and out are global rows of the release.
+    """
+
+    def __init__(self, data_directory, shard, num_shards):
+        """
+        Args:
+            data_directory (str): A release, see build_index.py.
+            shard (int): The index of this shard.
+            num_shards (int): The number of shards.
+        """
+        bundle = artifacts.load_bundle(os.path.join(data_directory, "bundle"))
+        self.start, self.end = shard_range(len(bundle.recipe_ids), shard, num_shards)
+        # A view of the memory mapped matrix, so only this shard's pages are read
+        self.svd = bundle.svd[self.start : self.end]
+        self.recipe_ids = bundle.recipe_ids[self.start : self.end]
+
+        with open(os.path.join(data_directory, "id_to_recipe.json"), "r") as f:
+            id_to_recipe = json.load(f)
+        self.restriction_index = restrictions.build_restriction_index(
+            id_to_recipe, self.recipe_ids
+        )
+        self.filter_columns = filters.build_filter_columns(
+            id_to_recipe, self.recipe_ids
+        )
+        tombstones = bundle.tombstones
+        tombstones = tombstones[(tombstones >= self.start) & (tombstones < self.end)]
+        self.filter_columns["live"] = filters.live_mask(
+            len(self.recipe_ids), tombstones - self.start
+        )
+
+        # The scores of the last few groups, since a Borda search asks for the
+        # same group several times
+        self.scores = lru.LRUCache(max_entries=8)
+
+    def mask(self, dietary_restrictions, limits):
+        return filters.combine_masks(
+            restrictions.restriction_mask(self.restriction_index, dietary_restrictions),
+            filters.filter_mask(self.filter_columns, limits or {}),
+        )
+
+    def results(self, rows, member_scores):
+        """
+        Returns the global rows, the recipe IDs and the member scores of local
+        rows.
+        """
+        return (
+            self.start + rows,
+            [self.recipe_ids[i] for i in rows.tolist()],
+            member_scores,
+        )
+
+    def top(self, query_svds, dietary_restrictions, limits, strategy, k):
+        """
+        Selects the top k rows of the shard by group score, for every strategy
+        but Borda, whose points depend on the other shards.
+
+        Returns:
+            tuple: The rows, their recipe IDs, and a (num_queries, k) matrix of
+                their member scores.
+        """
+        mask = self.mask(dietary_restrictions, limits)
+        member_scores = algorithm.score_queries(query_svds, self.svd)
+        rows = algorithm.common_recipes(member_scores, k, mask, strategy)
+        return self.results(rows, member_scores[:, rows])
+
+    def candidates(self, query_svds, dietary_restrictions, limits):
+        """
+        Returns the rows within the restrictions and limits, and their member
+        scores, sorted for every member.
+        """
+        key = (
+            query_svds.tobytes(),
+            restrictions.restriction_bits(dietary_restrictions),
+            filters.limits_key(limits),
+        )
+        cached = self.scores.get(key)
+        if cached is None:
+            mask = self.mask(dietary_restrictions, limits)
+            rows = np.arange(len(self.svd)) if mask is None else np.flatnonzero(mask)
+            member_scores = algorithm.score_queries(query_svds, self.svd[rows])
+            cached = (rows, member_scores, np.sort(member_scores, axis=1))
+            self.scores.put(key, cached)
+        return cached
+
+    def member_tops(self, query_svds, dietary_restrictions, limits, depth):
+        """
+        Sorted access for the threshold algorithm, see
+        aggregation.threshold_top_k: the top depth rows of every member.
+
+        Returns:
+            tuple: The rows seen, their recipe IDs and member scores, the score
+                at that depth for every member, which no unseen row of the shard
+                exceeds, or None if every row was seen, and the number of rows
+                within the restrictions and limits.
+        """
+        rows, member_scores, _ = self.candidates(
+            query_svds, dietary_restrictions, limits
+        )
+        if depth < len(rows):
+            tops = np.argpartition(-member_scores, depth - 1, axis=1)[:, :depth]
+            bounds = member_scores[np.arange(len(member_scores))[:, None], tops]
+            bounds = bounds.min(axis=1)
+            seen = np.unique(tops)
+        else:
+            bounds = None
+            seen = np.arange(len(rows))
+        return (*self.results(rows[seen], member_scores[:, seen]), bounds, len(rows))
+
+    def count_at_most(self, query_svds, dietary_restrictions, limits, values):
+        """
+        Counts the rows within the restrictions and limits that every member
+        scores at most each of its values, which sum to the Borda points over
+        all shards, see aggregation.member_points.
+
+        Args:
+            values (np.ndarray): A (num_queries, num_values) matrix.
+
+        Returns:
+            np.ndarray: The (num_queries, num_values) counts.
+        """
+        _, _, sorted_scores = self.candidates(query_svds, dietary_restrictions, limits)
+        return np.stack(
+            [
+                np.searchsorted(scores, member_values, "right")
+                for scores, member_values in zip(sorted_scores, values)
+            ]
+        )
+
+
+# The calls a shard answers
+METHODS = ("top", "member_tops", "count_at_most")
+
+
+class ShardServer(object):
+    """
+    Serves a shard of every release of an output directory that is asked for.
+    """
+
+    def __init__(self, data_directory, shard, num_shards):
+        self.data_directory = data_directory
+        self.shard = shard
+        self.num_shards = num_shards
+        self.releases = lru.LRUCache(max_entries=2)
+        self.lock = threading.Lock()
+
+    def release(self, name):
+        """
+        Returns the shard of a release, loading it on first use.
+        """
+        with self.lock:
+            shard = self.releases.get(name)
+            if shard is None:
+                # engine imports this module
+                from engine import resolve_data_directory
+
+                path = resolve_data_directory(self.data_directory)
+                if os.path.basename(path) != name:
+                    path = os.path.join(self.data_directory, "releases", name)
+                if not os.path.isdir(path):
+                    raise ValueError(f"No release {name} in {self.data_directory}")
+                shard = Shard(path, self.shard, self.num_shards)
+                self.releases.put(name, shard)
+            return shard
+
+    def handle(self, conn):
+        """
+        Answers the calls of one coordinator connection until it closes.
+        """
+        with conn:
+            while True:
+                try:
+                    method, release, args = conn.recv()
+                except (EOFError, OSError):
+                    return
+                try:
+                    if method not in METHODS:
+                        raise ValueError(f"Unknown method {method!r}")
+                    result = getattr(self.release(release), method)(*args)
+                    conn.send(("ok", result))
+                except Exception:
+                    conn.send(("error", traceback.format_exc()))
+
+    def serve(self, listener):
+        while True:
+            try:
+                conn = listener.accept()
+            except Exception:
+                # A client that failed authentication
+                continue
+            threading.Thread(target=self.handle, args=(conn,), daemon=True).start()
+
+
+def parse_address(address):
+    host, port = address.rsplit(":", 1)
+    return host, int(port)
+
+
+class ShardedSearch(object):
+    """
+    The coordinator: embeds a group once, sends it to every shard and merges
+    the answers into the result of algorithm.algorithm over the whole release.
+    Connections are pooled per shard and opened by each process, so it can be
+    created before a server forks its workers. Every call names its release,
+    so the engines of later releases share the coordinator.
+    """
+
+    def __init__(self, addresses, authkey, processes=()):
+        """
+        Args:
+            addresses (list): The (host, port) of every shard, in shard order.
+            authkey (str): The SHARD_AUTHKEY the shards were started with.
+            processes (list): The local shard processes, see
+                start_local_shards, which close stops.
+        """
+        self.addresses = addresses
+        self.authkey = authkey.encode("utf-8")
+        self.processes = list(processes)
+        self.owner = os.getpid()
+        self.pid = None
+        self.pools = None
+        self.lock = threading.Lock()
+        if self.processes:
+            # In case the coordinator is never closed
+            atexit.register(self.close)
+
+    def connections(self):
+        with self.lock:
+            if self.pid != os.getpid():
+                self.pools = [queue.LifoQueue() for _ in self.addresses]
+                self.pid = os.getpid()
+            return self.pools
+
+    def close(self):
+        """
+        Closes the pooled connections of this process, and stops the local
+        shard processes if this process started them. Forked workers inherit
+        the coordinator, but only close their own connections.
+        """
+        with self.lock:
+            if self.pid == os.getpid():
+                for pool in self.pools:
+                    while not pool.empty():
+                        pool.get_nowait().close()
+            self.pid = self.pools = None
+        if os.getpid() == self.owner:
+            stop_local_shards(self.processes)
+            self.processes = []
+
+    def scatter(self, method, release, *args):
+        """
+        Calls a method of the shards of a release in parallel.
+
+        Returns:
+            list: The result of every shard, in shard order.
+
+        Raises:
+            RuntimeError: If a shard failed.
+        """
+        pools = self.connections()
+        conns = []
+        for address, pool in zip(self.addresses, pools):
+            try:
+                conn = pool.get_nowait()
+            except queue.Empty:
+                conn = Client(address, authkey=self.authkey)
+            conns.append(conn)
+            conn.send((method, release, args))
+
+        results, errors = [], []
+        for address, pool, conn in zip(self.addresses, pools, conns):
+            try:
+                status, result = conn.recv()
+            except (EOFError, OSError) as e:
+                # A broken connection is dropped rather than returned to the pool
+                errors.append(f"{address}: {e!r}")
+                continue
+            pool.put(conn)
+            if status == "ok":
+                results.append(result)
+            else:
+                errors.append(f"{address}: {result}")
+        if errors:
+            raise RuntimeError("Shard call failed:\n" + "\n".join(errors))
+        return results
+
+    def algorithm(
+        self,
+        release,
+        queries,
+        dietary_restrictions,
+        vectorizer,
+        svd_model,
+        embedding_cache=None,
+        strategy="sum",
+        limits=None,
+        k=10,
+    ):
+        """
+        Like algorithm.algorithm, over the shards of a release.
+
+        Args:
+            release (str): The name of the release, see ShardServer.release.
+
+        Returns:
+            tuple: A list of (recipe_id, 0) tuples for the top k recipes, and a
+                dict from each of those recipe IDs to the score of each query.
+        """
+        if not queries:
+            return [], {}
+        query_svds = algorithm.embed_queries(
+            queries, vectorizer, svd_model, embedding_cache
+        )
+        if strategy == "borda":
+            rows, recipe_ids, member_scores, top = self.borda_top_k(
+                release, query_svds, dietary_restrictions, limits, k
+            )
+        else:
+            with timing.stage("shards"):
+                parts = self.scatter(
+                    "top",
+                    release,
+                    query_svds,
+                    dietary_restrictions,
+                    limits,
+                    strategy,
+                    k,
+                )
+            with timing.stage("merge"):
+                rows, recipe_ids, member_scores = merge(parts)
+                top = algorithm.top_k(aggregation.aggregate(strategy, member_scores), k)
+        with timing.stage("sim_scores"):
+            scores = member_scores[:, top].T.tolist()
+            top_ids = [recipe_ids[i] for i in top.tolist()]
+            return [(i, 0) for i in top_ids], dict(zip(top_ids, scores))
+
+    def borda_top_k(self, release, query_svds, dietary_restrictions, limits, k):
+        """
+        aggregation.threshold_top_k over the shards. The top rows of every
+        member are merged from the top rows of every shard, and the points of
+        the rows seen are the sums of the counts of every shard.
+
+        Returns:
+            tuple: The rows seen, their recipe IDs and member scores, in row
+                order, and the indices of the top k among them.
+        """
+        depth = 4 * k
+        while True:
+            with timing.stage("shards"):
+                parts = self.scatter(
+                    "member_tops",
+                    release,
+                    query_svds,
+                    dietary_restrictions,
+                    limits,
+                    depth,
+                )
+            rows, recipe_ids, member_scores = merge([part[:3] for part in parts])
+            sizes = [part[4] for part in parts]
+            # An unseen row scores at most the score at depth of its shard
+            shard_bounds = [part[3] for part in parts if part[3] is not None]
+            bounds = np.max(shard_bounds, axis=0) if shard_bounds else None
+            k_all = min(k, sum(sizes))
+            if k_all == 0:
+                return rows, recipe_ids, member_scores, np.empty(0, dtype=np.intp)
+
+            values = member_scores
+            if bounds is not None:
+                values = np.hstack([member_scores, bounds[:, None]])
+            with timing.stage("shards"):
+                counts = self.scatter(
+                    "count_at_most",
+                    release,
+                    query_svds,
+                    dietary_restrictions,
+                    limits,
+                    values,
+                )
+            points = np.sum(counts, axis=0) - 1
+            if bounds is not None:
+                points, threshold = points[:, :-1], points[:, -1].sum()
+            # Rows are in corpus order, so top_k breaks ties like threshold_top_k
+            group_scores = aggregation.aggregate("borda", points)
+            top = algorithm.top_k(group_scores, k_all)
+            # Strictly above, since an unseen row with the same points could come
+            # first in corpus order
+            if bounds is None or (
+                len(top) == k_all and group_scores[top[-1]] > threshold
+            ):
+                return rows, recipe_ids, member_scores, top
+            depth = 4 * depth
+            # Past an eighth of the largest shard, reading the rest costs less
+            # than another round
+            if 8 * depth > max(sizes):
+                depth = max(sizes)
+
+
+def merge(parts):
+    """
+    Concatenates the (rows, recipe_ids, member_scores) answers of the shards,
+    in row order.
+    """
+    rows = np.concatenate([part[0] for part in parts])
+    recipe_ids = [i for part in parts for i in part[1]]
+    member_scores = np.hstack([part[2] for part in parts])
+    order = np.argsort(rows, kind="stable")
+    return rows[order], [recipe_ids[i] for i in order.tolist()], member_scores[:, order]
+
+
+def start_local_shards(data_directory, num_shards):
+    """
+    Starts shard servers for an output directory on this host.
+
+    Returns:
+        tuple: The addresses of the shards, their authkey and their processes.
+    """
+    data_directory = os.path.abspath(data_directory)
+    authkey = os.urandom(16).hex()
+    env = dict(os.environ, SHARD_AUTHKEY=authkey)
+    processes, addresses = [], []
+    try:
+        for shard in range(num_shards):
+            process = subprocess.Popen(
+                [
+                    sys.executable,
+                    os.path.abspath(__file__),
+                    data_directory,
+                    "--shard",
+                    str(shard),
+                    "--shards",
+                    str(num_shards),
+                ],
+                env=env,
+                stdout=subprocess.PIPE,
+                text=True,
+            )
+            processes.append(process)
+        for process in processes:
+            # A shard prints its address once it listens, and nothing after, but
+            # the pipe is closed so that no later output can block it
+            with process.stdout:
+                line = process.stdout.readline()
+            if not line:
+                raise RuntimeError("A shard process exited on startup")
+            addresses.append(parse_address(line.split()[-1]))
+    except BaseException:
+        stop_local_shards(processes)
+        raise
+    return addresses, authkey, processes
+
+
+def stop_local_shards(processes):
+    for process in processes:
+        process.terminate()
+    for process in processes:
+        process.wait()
+
+
+def connect(data_directory):
+    """
+    Creates the coordinator of an output directory from the environment, or
+    returns None if search is not sharded. SHARDS starts that many local
+    shards, and SHARD_ADDRESSES lists the host:port of shards started elsewhere
+    with SHARD_AUTHKEY.
+
+    Args:
+        data_directory (str): The output directory of build_index.py.
+
+    Returns:
+        ShardedSearch: The coordinator.
+    """
+    if os.environ.get("SHARD_ADDRESSES"):
+        addresses = [
+            parse_address(address.strip())
+            for address in os.environ["SHARD_ADDRESSES"].split(",")
+        ]
+        return ShardedSearch(addresses, os.environ["SHARD_AUTHKEY"])
+    if int(os.environ.get("SHARDS", 0)):
+        return ShardedSearch(
+            *start_local_shards(data_directory, int(os.environ["SHARDS"]))
+        )
+    return None
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("data_directory", help="output directory of build_index.py")
+    parser.add_argument("--shard", type=int, required=True)
+    parser.add_argument("--shards", type=int, required=True)
+    parser.add_argument("--bind", default="127.0.0.1:0", help="host:port to listen on")
+    args = parser.parse_args(argv)
+    if not 0 <= args.shard < args.shards:
+        parser.error("--shard must be between 0 and --shards - 1")
+
+    authkey = os.environ["SHARD_AUTHKEY"].encode("utf-8")
+    server = ShardServer(args.data_directory, args.shard, args.shards)
+    with Listener(parse_address(args.bind), authkey=authkey) as listener:
+        host, port = listener.address
+        print(f"shard {args.shard} listening on {host}:{port}", flush=True)
+        server.serve(listener)
+
+
+if __name__ == "__main__":
+    main()
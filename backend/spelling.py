@@ -0,0 +1,85 @@
+from functools import lru_cache
+
+import numpy as np
+from fuzzywuzzy import fuzz, utils
+
+
+class SpellingCorrector(object):
+    """
+    Finds the closest vocabulary word to a misspelled token, giving the same
+    answer as process.extractOne(token, vocabulary, scorer=fuzz.ratio) with a
+    minimum score, without scoring the whole vocabulary.
+
+    fuzz.ratio is 2 * M / (len(a) + len(b)) where M is the length of the longest
+    matching subsequence, and M can never exceed the number of characters the
+    two strings have in common. The index keeps a count of every character of
+    every word, column by column, so that this upper bound is computed for the
+    whole vocabulary with a few vectorized operations. Only the words whose
+    bound reaches the threshold are scored with fuzz.ratio.
+    """
+
+    def __init__(self, vocabulary, threshold=80, cache_size=4096):
+        """
+        Args:
+            vocabulary (iterable): The words to correct to, e.g. the keys of the
+                inverted index. Ties are broken by the order of the vocabulary.
+            threshold (int): The minimum fuzz.ratio score of a correction.
+            cache_size (int): Number of recent corrections to keep.
+        """
+        self.choices = list(vocabulary)
+        self.vocabulary = set(self.choices)
+        self.words = [utils.full_process(word) for word in self.choices]
+        self.threshold = threshold
+        self.lengths = np.array([len(word) for word in self.words], dtype=np.int32)
+
+        counts = {}
+        for i, word in enumerate(self.words):
+            for char in word:
+                if char not in counts:
+                    counts[char] = np.zeros(len(self.words), dtype=np.uint8)
+                counts[char][i] += 1
+        self.char_counts = counts
+
+        self.correct = lru_cache(maxsize=cache_size)(self._correct)
+
+    def candidates(self, query):
+        """
+        Finds the vocabulary words whose score upper bound reaches the threshold.
+
+        Args:
+            query (str): The processed query token.
+
+        Returns:
+            np.ndarray: The indices of the candidate words, in vocabulary order.
+        """
+        common = np.zeros(len(self.words), dtype=np.int32)
+        for char in set(query):
+            if char in self.char_counts:
+                common += np.minimum(self.char_counts[char], query.count(char))
+        # round(100 * 2 * common / total) >= threshold, kept in integers
+        total = self.lengths + len(query)
+        return np.flatnonzero(400 * common >= (2 * self.threshold - 1) * total)
+
+    def _correct(self, token):
+        """
+        Corrects a token to its closest vocabulary word.
+
+        Args:
+            token (str): The token to correct.
+
+        Returns:
+            str: The token if it is in the vocabulary, else the best matching
+                vocabulary word, or None if no word scores at least the threshold.
+        """
+        if token in self.vocabulary:
+            return token
+        query = utils.full_process(token)
+        if not query:
+            return None
+
+        best, best_score = None, -1
+        for i in self.candidates(query).tolist():
+            score = fuzz.ratio(query, self.words[i])
+            if score > best_score:
+                best, best_score = self.choices[i], score
+        return best if best_score >= self.threshold else None
@@ -0,0 +1,66 @@
+"""
+Times the startup of the app, by import and by artifact load, for the log and
+for /ready. app.py imports this module first and the heavy dependencies through
+import_modules, so each of them is timed on its own.
+"""
+
+import contextlib
+import importlib
+import logging
+import time
+
+STARTED = time.perf_counter()
+
+logger = logging.getLogger(__name__)
+
+# (stage, seconds) tuples in the order the stages ran
+_stages = []
+_finished = None
+
+
+@contextlib.contextmanager
+def stage(name):
+    """
+    Times a stage of the startup. Stages after finish, e.g. the loads of a
+    release swapped in later, are not recorded.
+    """
+    start = time.perf_counter()
+    yield
+    if _finished is None:
+        _stages.append((name, time.perf_counter() - start))
+
+
+def import_modules(names):
+    """
+    Imports modules in order, timing each. A module is only charged for the
+    dependencies that the modules before it did not import.
+    """
+    for name in names:
+        with stage(f"import {name}"):
+            importlib.import_module(name)
+
+
+def finish():
+    """
+    Ends the startup and logs the time of each stage.
+    """
+    global _finished
+    if _finished is None:
+        _finished = time.perf_counter() - STARTED
+        logger.warning(
+            "Started in %.2fs: %s",
+            _finished,
+            ", ".join(f"{name} {seconds:.2f}s" for name, seconds in _stages),
+        )
+
+
+def report():
+    """
+    Returns:
+        dict: The seconds of each stage and the total, which is None until the
+            startup is finished.
+    """
+    return {
+        "stages": [{"name": name, "seconds": seconds} for name, seconds in _stages],
+        "total": _finished,
+    }
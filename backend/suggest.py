@@ -0,0 +1,125 @@
+import bisect
+
+import numpy as np
+
+# Number of suggestions stored for every precomputed prefix, the most a request
+# can ask for
+MAX_SUGGESTIONS = 50
+
+# Prefixes matching more than PRECOMPUTE_ABOVE entries have their suggestions
+# stored, at startup for those up to PRECOMPUTE_LENGTH long and on first use
+# for longer ones. There are at most a few per PRECOMPUTE_ABOVE entries and
+# character of length, and they are the prefixes whose ranking costs the most.
+PRECOMPUTE_LENGTH = 3
+PRECOMPUTE_ABOVE = 2048
+
+
+class PrefixIndex(object):
+    """
+    Completes a prefix to the vocabulary terms and recipe names that start with
+    it, most frequent first. Entries are kept in one sorted list, so the entries
+    matching a prefix are a contiguous range found with two binary searches,
+    and only that range is ranked.
+    """
+
+    def __init__(self, entries):
+        """
+        Args:
+            entries (iterable): (text, kind, count) tuples, where kind is e.g.
+                "term" or "name" and count ranks the entries matching a prefix.
+        """
+        entries = sorted(
+            (text.lower(), text, kind, count) for text, kind, count in entries
+        )
+        self.keys = [key for key, _, _, _ in entries]
+        self.texts = [text for _, text, _, _ in entries]
+        self.kinds = [kind for _, _, kind, _ in entries]
+        self.counts = np.fromiter(
+            (count for _, _, _, count in entries), dtype=np.int64, count=len(entries)
+        )
+        # Distinct sort keys: the count, then alphabetical order. With most
+        # names occurring once, ranking by count alone would tie on nearly the
+        # whole range.
+        self.ranks = self.counts * len(entries) + np.arange(len(entries))[::-1]
+
+        self.precomputed = {}
+        for length in range(1, PRECOMPUTE_LENGTH + 1):
+            for prefix in dict.fromkeys(key[:length] for key in self.keys):
+                start, end = self.range(prefix)
+                if end - start > PRECOMPUTE_ABOVE:
+                    self.precomputed[prefix] = self.rank(start, end, MAX_SUGGESTIONS)
+
+    def __len__(self):
+        return len(self.keys)
+
+    def range(self, prefix):
+        """
+        Finds the range of entries that start with a lowercase prefix.
+        """
+        start = bisect.bisect_left(self.keys, prefix)
+        end = bisect.bisect_left(self.keys, prefix + "\U0010ffff", start)
+        return start, end
+
+    def rank(self, start, end, limit):
+        """
+        Ranks a range of entries by count. Ties are broken alphabetically.
+        """
+        ranks = self.ranks[start:end]
+        if limit < len(ranks):
+            top = np.argpartition(-ranks, limit - 1)[:limit]
+        else:
+            top = np.arange(len(ranks))
+        top = start + top[np.argsort(-ranks[top])]
+        return [
+            {"text": self.texts[i], "kind": self.kinds[i], "count": int(self.counts[i])}
+            for i in top.tolist()
+        ]
+
+    def suggest(self, prefix, limit=10):
+        """
+        Completes a prefix.
+
+        Args:
+            prefix (str): The start of a term or recipe name, in any case.
+            limit (int): Maximum number of suggestions, at most MAX_SUGGESTIONS.
+
+        Returns:
+            list: Dicts with the text, kind and count of each suggestion.
+        """
+        prefix = prefix.strip().lower()
+        if not prefix:
+            return []
+        if prefix in self.precomputed:
+            return self.precomputed[prefix][:limit]
+        start, end = self.range(prefix)
+        if end - start > PRECOMPUTE_ABOVE:
+            self.precomputed[prefix] = self.rank(start, end, MAX_SUGGESTIONS)
+            return self.precomputed[prefix][:limit]
+        return self.rank(start, end, limit)
+
+
+def build_prefix_index(inverted_index, names):
+    """
+    Builds a PrefixIndex over the vocabulary of the inverted index, ranked by
+    document frequency, and recipe names, ranked by the number of recipes with
+    that name.
+
+    Args:
+        inverted_index (dict): Term to the IDs of the recipes that contain it.
+        names (iterable): The name of every recipe.
+
+    Returns:
+        PrefixIndex: The index.
+    """
+    # Names that only differ in case or spacing are one entry, shown as first
+    # seen
+    name_counts = {}
+    for name in names:
+        name = " ".join(name.split())
+        if name:
+            text, count = name_counts.get(name.lower(), (name, 0))
+            name_counts[name.lower()] = (text, count + 1)
+    return PrefixIndex(
+        [(term, "term", len(postings)) for term, postings in inverted_index.items()]
+        + [(text, "name", count) for text, count in name_counts.values()]
+    )
@@ -0,0 +1,36 @@
+import os
+import sys
+
+import pytest
+
+# The modules of the backend are imported flat, as when it runs from its folder
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+@pytest.fixture(scope="session")
+def data_directory(tmp_path_factory):
+    """
+    A release built by build_index.py from a small synthetic corpus.
+    """
+    import build_index
+    from benchmarks import corpus
+
+    directory = tmp_path_factory.mktemp("data")
+    csv_path = str(directory / "recipes.csv")
+    corpus.write_csv(csv_path, 400, seed=0)
+    build_index.main(
+        [csv_path, "--out", str(directory), "--components", "20", "--no-cache"]
+    )
+    return str(directory)
+
+
+@pytest.fixture(scope="session")
+def app(data_directory):
+    import app
+
+    return app.create_app(data_directory)
+
+
+@pytest.fixture
+def client(app):
+    return app.test_client()
@@ -0,0 +1,123 @@
+import numpy as np
+import pytest
+
+import aggregation
+import algorithm
+import quantize
+import restrictions
+from engine import SearchEngine
+
+
+def brute_force_top_k(member_scores, k, strategy, mask=None):
+    """
+    Aggregates every recipe and sorts them all, breaking ties by corpus order.
+    """
+    candidates = np.arange(member_scores.shape[1])
+    if mask is not None:
+        candidates = np.flatnonzero(mask)
+    scores = member_scores[:, candidates]
+    if strategy == "borda":
+        # Points are n - 1 minus the number of candidates scored higher
+        higher = (scores[:, None, :] > scores[:, :, None]).sum(axis=2)
+        scores = len(candidates) - 1 - higher
+    group_scores = aggregation.aggregate(strategy, scores)
+    order = sorted(range(len(candidates)), key=lambda i: (-group_scores[i], i))
+    return candidates[order[:k]]
+
+
+def random_scores(rng, num_members, num_recipes, ties):
+    scores = rng.uniform(-0.2, 1, (num_members, num_recipes))
+    if ties:
+        # Few distinct values, so that most scores and group scores are tied
+        scores = np.round(scores * 4) / 4
+    return scores.astype(np.float32)
+
+
+@pytest.mark.parametrize("strategy", aggregation.STRATEGIES)
+@pytest.mark.parametrize("ties", [False, True])
+def test_threshold_top_k_matches_brute_force(strategy, ties):
+    rng = np.random.default_rng(0)
+    for trial in range(60):
+        num_members = rng.integers(1, 5)
+        num_recipes = rng.integers(1, 400)
+        member_scores = random_scores(rng, num_members, num_recipes, ties)
+        k = int(rng.choice([1, 3, 10, 50, 500]))
+        depth = int(rng.choice([1, 2, 4 * k]))
+        assert np.array_equal(
+            aggregation.threshold_top_k(member_scores, k, strategy, depth=depth),
+            brute_force_top_k(member_scores, k, strategy),
+        )
+
+
+@pytest.mark.parametrize("strategy", aggregation.STRATEGIES)
+@pytest.mark.parametrize("ties", [False, True])
+def test_threshold_top_k_with_mask(strategy, ties):
+    rng = np.random.default_rng(1)
+    for trial in range(60):
+        member_scores = random_scores(rng, rng.integers(1, 5), 300, ties)
+        mask = rng.random(300) < rng.choice([0.0, 0.02, 0.3, 1.0])
+        k = int(rng.choice([1, 10, 50]))
+        expected = brute_force_top_k(member_scores, k, strategy, mask)
+        assert np.array_equal(
+            aggregation.threshold_top_k(member_scores, k, strategy, mask), expected
+        )
+        assert np.array_equal(
+            algorithm.common_recipes(member_scores, k, mask, strategy), expected
+        )
+
+
+def test_depths():
+    assert aggregation.depths(10, 100_000) == [40, 160, 640, 2560, 10240, 100_000]
+    assert aggregation.depths(10, 30) == [30]
+    assert aggregation.depths(10, 100, depth=5) == [5, 100]
+
+
+def test_members_in_agreement():
+    rng = np.random.default_rng(2)
+    member_scores = np.tile(rng.random(100_000), (3, 1))
+    for strategy in aggregation.STRATEGIES:
+        assert np.array_equal(
+            aggregation.threshold_top_k(member_scores, 10, strategy),
+            np.argsort(-member_scores[0])[:10],
+        )
+
+
+def test_member_points():
+    scores = np.array([0.5, 0.1, 0.5, 0.9])
+    points = aggregation.member_points(np.sort(scores), scores)
+    assert points.tolist() == [2, 0, 2, 3]
+
+
+def test_unknown_strategy():
+    with pytest.raises(ValueError):
+        aggregation.threshold_top_k(np.zeros((1, 3)), 1, "median")
+
+
+@pytest.mark.parametrize("strategy", aggregation.STRATEGIES)
+def test_candidate_search_matches_exact_search(data_directory, strategy):
+    # The int8 candidates are found with the summed query embedding, which
+    # would miss e.g. the least miserable recipes, so only sum may use them
+    engine = SearchEngine(data_directory)
+    quantized = quantize.quantize_int8(engine.svd)
+    quantized.rerank = 2
+    for queries in [["chicken pasta", "chocolate cake"], ["rice beans", "lemon"]]:
+        exact, candidates = [
+            algorithm.algorithm(
+                queries,
+                dict.fromkeys(restrictions.RESTRICTIONS, False),
+                engine.id_to_recipe,
+                engine.vectorizer,
+                engine.svd_model,
+                engine.svd,
+                engine.recipe_ids,
+                engine.restriction_index,
+                quantized=scan,
+                strategy=strategy,
+            )
+            for scan in (None, quantized)
+        ]
+        if strategy == "sum":
+            # Approximate, but the top result of these groups is found
+            assert candidates[0][0] == exact[0][0]
+        else:
+            assert candidates == exact
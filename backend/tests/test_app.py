@@ -0,0 +1,110 @@
+import json
+
+
+def test_recipes(client):
+    response = client.get("/recipes?title0=chicken&title1=pasta")
+    assert response.status_code == 200
+    assert len(response.get_json()) == 10
+
+
+def test_ndjson_matches_json(client):
+    url = "/recipes?title0=chicken&title1=pasta&fields=name,similarity_scores"
+    response = client.get(url + "&format=ndjson")
+    assert response.mimetype == "application/x-ndjson"
+    lines = response.get_data(as_text=True).splitlines()
+    assert [json.loads(line) for line in lines] == client.get(url).get_json()
+
+
+def test_ndjson_looks_up_each_recipe_as_it_is_sent(app, client, monkeypatch):
+    recipes = app.extensions["search"].recipes
+    get_many = recipes.get_many
+    lookups = []
+
+    def spy(ids, fields):
+        lookups.append(ids)
+        return get_many(ids, fields)
+
+    monkeypatch.setattr(recipes, "get_many", spy)
+    response = client.get("/recipes?title0=soup&format=ndjson", buffered=False)
+    chunks = response.response
+    next(chunks)
+    assert len(lookups) == 1
+    assert sum(1 for chunk in chunks if chunk.strip()) == 9
+    assert len(lookups) == 10
+    response.close()
+
+
+def test_batch_matches_recipes(client):
+    single = client.get("/recipes?title0=chicken&vegan=true").get_json()
+    batch = client.post(
+        "/recipes/batch", json={"groups": [{"title0": "chicken", "vegan": True}]}
+    ).get_json()
+    assert batch == [single]
+
+
+def test_batch_rejects_non_string_titles(client):
+    response = client.post(
+        "/recipes/batch", json={"groups": [{"title0": "soup"}, {"title0": 5}]}
+    )
+    assert response.status_code == 400
+    assert "groups[1]: title0 must be a string" in response.get_data(as_text=True)
+
+
+def test_batch_rejects_non_scalar_parameters(client):
+    for value in ([True], {"a": 1}):
+        response = client.post(
+            "/recipes/batch", json={"groups": [{"title0": "soup", "vegan": value}]}
+        )
+        assert response.status_code == 400
+        assert "groups[0]: vegan" in response.get_data(as_text=True)
+
+
+def test_batch_rejects_bad_limits(client):
+    for name, value, message in [
+        ("max_time", "soon", "a whole number of minutes"),
+        ("max_time", True, "a whole number of minutes"),
+        ("max_time", 10.7, "a whole number of minutes"),
+        ("max_time", float("inf"), "a whole number of minutes"),
+        ("max_cook_time", float("nan"), "a whole number of minutes"),
+        ("min_rating", float("inf"), "a number"),
+        ("min_rating", "nan", "a number"),
+    ]:
+        response = client.post(
+            "/recipes/batch", json={"groups": [{"title0": "soup", name: value}]}
+        )
+        assert response.status_code == 400, (name, value)
+        assert f"groups[0]: {name} must be {message}" in response.get_data(as_text=True)
+
+
+def test_batch_rejects_infinity_in_the_json_text(client):
+    # Python's JSON parser reads Infinity and 1e400 as float("inf")
+    for value in ("Infinity", "1e400"):
+        response = client.post(
+            "/recipes/batch",
+            data=f'{{"groups": [{{"title0": "soup", "max_time": {value}}}]}}',
+            content_type="application/json",
+        )
+        assert response.status_code == 400
+
+
+def test_whole_float_minutes_are_accepted(client):
+    groups = [{"title0": "soup", "max_time": 30.0}, {"title0": "soup", "max_time": 30}]
+    first, second = client.post("/recipes/batch", json={"groups": groups}).get_json()
+    assert first == second
+
+
+def test_flags_are_only_true_or_the_string_true(client):
+    vegan = client.post(
+        "/recipes/batch", json={"groups": [{"title0": "chicken", "vegan": True}]}
+    ).get_json()
+    for value in (1, "1", "yes"):
+        results = client.post(
+            "/recipes/batch", json={"groups": [{"title0": "chicken", "vegan": value}]}
+        ).get_json()
+        assert results != vegan
+        assert (
+            results
+            == client.post(
+                "/recipes/batch", json={"groups": [{"title0": "chicken"}]}
+            ).get_json()
+        )
@@ -0,0 +1,25 @@
+import os
+
+import build_index
+
+
+def write_file(text):
+    def write(directory):
+        os.makedirs(directory)
+        with open(os.path.join(directory, "release.txt"), "w") as f:
+            f.write(text)
+
+    return write
+
+
+def test_publish_keeps_releases_of_the_same_name(tmp_path):
+    out = str(tmp_path)
+    first = build_index.publish(out, "20240101-000000-abcdef12", write_file("1"))
+    second = build_index.publish(out, "20240101-000000-abcdef12", write_file("2"))
+    assert os.path.basename(second) == "20240101-000000-abcdef12-2"
+    assert sorted(os.listdir(os.path.join(out, "releases"))) == [
+        os.path.basename(first),
+        os.path.basename(second),
+    ]
+    with open(os.path.join(out, "current", "release.txt")) as f:
+        assert f.read() == "2"
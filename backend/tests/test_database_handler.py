@@ -0,0 +1,119 @@
+import pytest
+import sqlalchemy as db
+
+from helpers.MySQLDatabaseHandler import MySQLDatabaseHandler
+
+RECIPES = {
+    "38": {
+        "name": "Lentil Soup",
+        "ingredients": ["lentils", "onion"],
+        "dietary_restrictions": {"vegan": True},
+        "Url": "https://www.food.com/recipe/38",
+        "aggregated_rating": 4.5,
+        "review_count": 3,
+    },
+    "39": {"name": "Chicken Pie", "ingredients": ["chicken"], "review_count": 0},
+}
+
+
+@pytest.fixture
+def handler(tmp_path, monkeypatch):
+    monkeypatch.setenv("DB_POOL_SIZE", "2")
+    monkeypatch.setenv("DB_MAX_OVERFLOW", "0")
+    monkeypatch.setenv("DB_POOL_TIMEOUT", "0.1")
+    handler = MySQLDatabaseHandler(
+        None, None, None, None, url=f"sqlite:///{tmp_path / 'recipes.db'}"
+    )
+    yield handler
+    handler.engine.dispose()
+
+
+def checked_out(handler):
+    return handler.engine.pool.checkedout()
+
+
+def test_connections_return_to_the_pool(handler):
+    with handler.lease_connection() as conn:
+        assert checked_out(handler) == 1
+        conn.execute(db.text("select 1"))
+    assert checked_out(handler) == 0
+
+    handler.query_executor("create table t (x integer)")
+    handler.query_executor("insert into t values (:x)", {"x": 1})
+    assert handler.query_selector("select x from t") == [(1,)]
+    assert checked_out(handler) == 0
+
+
+def test_connections_return_to_the_pool_on_exceptions(handler):
+    with pytest.raises(RuntimeError):
+        with handler.lease_connection():
+            raise RuntimeError("boom")
+    assert checked_out(handler) == 0
+
+    with pytest.raises(db.exc.OperationalError):
+        handler.query_selector("select * from missing")
+    assert checked_out(handler) == 0
+
+
+def test_transactions_roll_back_on_exceptions(handler):
+    handler.query_executor("create table t (x integer)")
+    with pytest.raises(db.exc.OperationalError):
+        handler.query_executor(["insert into t values (1)", "insert into missing"])
+    assert handler.query_selector("select x from t") == []
+    assert checked_out(handler) == 0
+
+
+def test_checkout_times_out_when_the_pool_is_exhausted(handler):
+    with handler.lease_connection(), handler.lease_connection():
+        with pytest.raises(db.exc.TimeoutError):
+            with handler.lease_connection():
+                pass
+    assert checked_out(handler) == 0
+
+
+def test_stream_selector_yields_rows_lazily(handler):
+    evaluated = []
+
+    @db.event.listens_for(handler.engine, "connect")
+    def register(dbapi_connection, connection_record):
+        # Counts the rows SQLite has produced
+        dbapi_connection.create_function("seen", 1, lambda x: evaluated.append(x) or x)
+
+    handler.query_executor("create table t (x integer)")
+    metadata = db.MetaData()
+    table = db.Table("t", metadata, autoload_with=handler.engine)
+    assert handler.bulk_insert(table, ({"x": x} for x in range(10000)), 1000) == 10000
+
+    rows = handler.stream_selector("select seen(x) from t", batch_size=100)
+    assert checked_out(handler) == 0
+    assert next(rows) == (0,)
+    assert checked_out(handler) == 1
+    assert len(evaluated) < 10000
+    assert [row[0] for row in rows] == list(range(1, 10000))
+    assert checked_out(handler) == 0
+
+    # Closing the generator early returns the connection
+    rows = handler.stream_selector("select seen(x) from t", batch_size=100)
+    next(rows)
+    rows.close()
+    assert checked_out(handler) == 0
+
+
+def test_load_upsert_and_select_recipes(handler):
+    assert handler.load_recipes(RECIPES) == 2
+    found = handler.select_recipes(["38", 39, 40], ["name", "ingredients", "Url"])
+    assert found == {
+        38: {
+            "name": "Lentil Soup",
+            "ingredients": ["lentils", "onion"],
+            "Url": "https://www.food.com/recipe/38",
+        },
+        39: {"name": "Chicken Pie", "ingredients": ["chicken"], "Url": None},
+    }
+    assert handler.upsert_recipes({"39": {"name": "Chicken Pot Pie"}, "40": {}}) == 2
+    assert handler.select_recipes([39, 40], ["name"]) == {
+        39: {"name": "Chicken Pot Pie"},
+        40: {"name": None},
+    }
+    assert handler.select_recipes([38])[38]["dietary_restrictions"] == {"vegan": True}
+    assert checked_out(handler) == 0
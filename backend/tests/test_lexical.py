@@ -0,0 +1,71 @@
+import numpy as np
+import pytest
+
+import algorithm
+import quantize
+import restrictions
+from engine import SearchEngine
+
+GROUPS = [["chicken pasta"], ["rice beans", "garlic soup"], ["tahini", "lemon"]]
+NO_RESTRICTIONS = dict.fromkeys(restrictions.RESTRICTIONS, False)
+
+
+@pytest.fixture
+def fused_engine(data_directory, monkeypatch):
+    monkeypatch.setenv("LEXICAL_WEIGHT", "0.5")
+    return SearchEngine(data_directory)
+
+
+def search(engine, queries, quantized=None, k=10):
+    return algorithm.algorithm(
+        queries,
+        NO_RESTRICTIONS,
+        engine.id_to_recipe,
+        engine.vectorizer,
+        engine.svd_model,
+        engine.svd,
+        engine.recipe_ids,
+        engine.restriction_index,
+        quantized=quantized,
+        lexical=engine.lexical,
+        k=k,
+    )
+
+
+def test_fused_candidates_score_only_their_union(fused_engine, monkeypatch):
+    quantized = quantize.quantize_int8(fused_engine.svd)
+    quantized.rerank = 2
+    scored = []
+    score_queries = algorithm.score_queries
+
+    def spy(query_svds, svd):
+        scored.append(len(svd))
+        return score_queries(query_svds, svd)
+
+    monkeypatch.setattr(algorithm, "score_queries", spy)
+    for queries in GROUPS:
+        scored.clear()
+        search(fused_engine, queries, quantized)
+        # The int8 candidates and at most k lexical matches
+        assert scored and max(scored) <= 2 * 10 + 10 < len(fused_engine.svd)
+
+
+def test_fused_candidates_match_exhaustive_when_they_cover_the_corpus(fused_engine):
+    quantized = quantize.quantize_int8(fused_engine.svd)
+    quantized.rerank = len(fused_engine.svd)
+    for queries in GROUPS:
+        exhaustive = search(fused_engine, queries)
+        candidates = search(fused_engine, queries, quantized)
+        assert [i for i, _ in candidates[0]] == [i for i, _ in exhaustive[0]]
+        for recipe_id, scores in exhaustive[1].items():
+            assert np.allclose(candidates[1][recipe_id], scores, atol=1e-6)
+
+
+def test_exhaustive_fusion_is_limited_to_small_corpora(data_directory, monkeypatch):
+    monkeypatch.setenv("LEXICAL_WEIGHT", "0.5")
+    monkeypatch.setenv("LEXICAL_EXHAUSTIVE_MAX_ROWS", "100")
+    with pytest.raises(ValueError, match="QUANTIZED_RERANK"):
+        SearchEngine(data_directory)
+    # Ranking by the lexical score alone never scans the SVD matrix
+    monkeypatch.setenv("LEXICAL_WEIGHT", "1")
+    assert SearchEngine(data_directory).lexical.weight == 1
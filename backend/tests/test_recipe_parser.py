@@ -0,0 +1,155 @@
+import random
+
+import recipe_parser
+from recipe_parser import (
+    DAIRY_FREE_TERMS,
+    GLUTEN_FREE_TERMS,
+    NUT_FREE_TERMS,
+    VEGAN_TERMS,
+    VEGETARIAN_TERMS,
+    dietary_restrictions_check,
+    dietary_restrictions_check_batch,
+)
+
+ALL_TERMS = (
+    VEGETARIAN_TERMS
+    | VEGAN_TERMS
+    | GLUTEN_FREE_TERMS
+    | DAIRY_FREE_TERMS
+    | NUT_FREE_TERMS
+)
+SINGLE_WORD_TERMS = sorted(
+    term for term in ALL_TERMS if term.isascii() and term.isalpha()
+)
+# Words that are in no term list
+FILLER = ["salt", "water", "onion", "garlic", "pepper", "sugar", "baked", "quick"]
+
+
+def baseline_check(recipe):
+    """
+    The classifier before it was compiled: a set lookup of every token.
+    """
+    tokens = set(
+        recipe_parser.tokenize(recipe["Name"])
+        + recipe_parser.tokenize(recipe["RecipeIngredientParts"][1:])
+        + recipe_parser.tokenize(recipe["Keywords"][1:])
+        + recipe_parser.tokenize(recipe["RecipeCategory"])
+    )
+    vegetarian = not tokens & VEGETARIAN_TERMS
+    dairy_free = not tokens & DAIRY_FREE_TERMS
+    return {
+        "vegan": vegetarian and dairy_free and not tokens & VEGAN_TERMS,
+        "vegetarian": vegetarian,
+        "gluten_free": not tokens & GLUTEN_FREE_TERMS,
+        "dairy_free": dairy_free,
+        "nut_free": not tokens & NUT_FREE_TERMS,
+    }
+
+
+def make_recipe(name="", ingredients=(), keywords=(), category="Dessert"):
+    return {
+        "Name": name,
+        "RecipeIngredientParts": "c(" + ", ".join(f'"{i}"' for i in ingredients) + ")",
+        "Keywords": "c(" + ", ".join(f'"{k}"' for k in keywords) + ")",
+        "RecipeCategory": category,
+        "Images": "character(0)",
+        "RecipeInstructions": 'c("Mix.")',
+    }
+
+
+def test_filler_is_in_no_term_list():
+    assert not set(FILLER) & ALL_TERMS
+    assert dietary_restrictions_check(make_recipe("quick", FILLER)) == dict.fromkeys(
+        recipe_parser.DietaryClassifier.RESTRICTIONS, True
+    )
+
+
+def test_every_single_word_term_matches_baseline():
+    for term in SINGLE_WORD_TERMS:
+        for recipe in (
+            make_recipe(ingredients=["salt", term]),
+            make_recipe(name=f"Baked {term.title()}"),
+            make_recipe(keywords=[term.title()]),
+            make_recipe(category=term.title()),
+        ):
+            assert dietary_restrictions_check(recipe) == baseline_check(recipe), term
+
+
+def test_random_single_word_recipes_match_baseline():
+    rng = random.Random(0)
+    words = SINGLE_WORD_TERMS + FILLER * 20
+    recipes = [
+        make_recipe(
+            " ".join(rng.sample(FILLER, 2)),
+            rng.sample(words, rng.randint(1, 8)),
+            rng.sample(words, rng.randint(0, 3)),
+            rng.choice(FILLER).title(),
+        )
+        for _ in range(2000)
+    ]
+    expected = [baseline_check(recipe) for recipe in recipes]
+    assert [dietary_restrictions_check(recipe) for recipe in recipes] == expected
+    assert dietary_restrictions_check_batch(recipes) == expected
+    parsed = recipe_parser.parse_recipe_batch(recipes)
+    assert dietary_restrictions_check_batch(recipes, parsed) == expected
+
+
+def broken(recipe):
+    flags = dietary_restrictions_check(recipe)
+    return {name for name, satisfied in flags.items() if not satisfied}
+
+
+def test_multi_word_phrases():
+    assert broken(make_recipe(ingredients=["sour cream"])) == {"vegan", "dairy_free"}
+    assert broken(make_recipe(ingredients=["corned beef"])) == {"vegan", "vegetarian"}
+    assert broken(make_recipe(ingredients=["peanut butter"])) == {
+        "vegan",
+        "dairy_free",
+        "nut_free",
+    }
+    assert broken(make_recipe(ingredients=["fish sauce"])) == {"vegan", "vegetarian"}
+    # The baseline never matched phrases, only their words
+    assert broken(make_recipe(ingredients=["fish oil"])) >= {"vegan", "vegetarian"}
+
+
+def test_phrases_only_match_within_one_ingredient():
+    # "sour" ends one ingredient and "cream" starts the next
+    recipe = make_recipe(ingredients=["lemon sour", "cream"])
+    assert broken(recipe) == broken(make_recipe(ingredients=["cream"]))
+    assert "vital wheat gluten" in GLUTEN_FREE_TERMS
+    assert broken(make_recipe(ingredients=["vital", "wheat", "gluten"])) == broken(
+        make_recipe(ingredients=["wheat"])
+    )
+
+
+def test_overlapping_terms_keep_every_restriction():
+    # A phrase breaks what its words break: "evaporated milk" contains "milk"
+    assert broken(make_recipe(ingredients=["evaporated milk"])) == broken(
+        make_recipe(ingredients=["milk"])
+    )
+    # Overlapping phrases in one ingredient both count
+    assert broken(make_recipe(ingredients=["cod liver oil and sour cream"])) == {
+        "vegan",
+        "vegetarian",
+        "dairy_free",
+    }
+
+
+def test_accents_are_stripped():
+    assert broken(make_recipe(ingredients=["pâté"])) == broken(
+        make_recipe(ingredients=["pate"])
+    )
+
+
+def test_negations():
+    assert broken(make_recipe(ingredients=["gluten-free flour"])) == set()
+    assert broken(make_recipe(keywords=["Lactose Free"])) == set()
+    assert broken(make_recipe(ingredients=["peanut free chocolate"])) == set()
+    # Only the negated restriction is lifted
+    assert broken(make_recipe(ingredients=["dairy-free cheese"])) == {"vegan"}
+    # and only within its own ingredient
+    assert broken(make_recipe(ingredients=["gluten-free oats", "flour"])) == {
+        "gluten_free"
+    }
+    # "free" alone negates nothing
+    assert broken(make_recipe(ingredients=["free range eggs"])) == {"vegan"}
@@ -0,0 +1,95 @@
+import random
+
+import numpy as np
+import pytest
+
+import aggregation
+import algorithm
+import app as app_module
+import restrictions
+import shards
+from engine import SearchEngine
+
+
+@pytest.fixture(scope="module")
+def sharded_app(data_directory):
+    with pytest.MonkeyPatch.context() as monkeypatch:
+        monkeypatch.setenv("SHARDS", "3")
+        sharded_app = app_module.create_app(data_directory)
+    yield sharded_app
+    sharded_app.extensions["search"].close()
+
+
+def groups(engine, num_groups, seed=0):
+    rng = random.Random(seed)
+    vocab = sorted(engine.speller.choices)
+    for _ in range(num_groups):
+        yield [
+            " ".join(rng.sample(vocab, rng.randint(1, 3)))
+            for _ in range(rng.randint(1, 4))
+        ]
+
+
+FILTERS = [
+    {},
+    {"vegan": "true"},
+    {"gluten_free": "true", "max_time": "60"},
+    {"min_rating": "4", "max_cook_time": "30"},
+]
+
+
+def test_recipes_match_the_unsharded_engine(app, sharded_app):
+    client, sharded_client = app.test_client(), sharded_app.test_client()
+    for i, queries in enumerate(groups(app.extensions["search"], 50)):
+        for strategy in aggregation.STRATEGIES:
+            params = {f"title{j}": query for j, query in enumerate(queries)}
+            params.update(FILTERS[i % len(FILTERS)], aggregation=strategy, limit=20)
+            expected = client.get("/recipes", query_string=params).get_json()
+            results = sharded_client.get("/recipes", query_string=params).get_json()
+            assert [r["Url"] for r in results] == [r["Url"] for r in expected]
+            # BLAS may round the scores of a row slice differently
+            for result, detail in zip(results, expected):
+                assert np.allclose(
+                    result["similarity_scores"], detail["similarity_scores"], atol=1e-6
+                )
+
+
+def test_local_shards(data_directory):
+    engine = SearchEngine(data_directory)
+    search = shards.ShardedSearch(*shards.start_local_shards(data_directory, 2))
+    processes = list(search.processes)
+    try:
+        dietary_restrictions = dict.fromkeys(restrictions.RESTRICTIONS, False)
+        for queries in groups(engine, 20, seed=1):
+            for strategy in aggregation.STRATEGIES:
+                expected, _ = algorithm.algorithm(
+                    queries,
+                    dietary_restrictions,
+                    engine.id_to_recipe,
+                    engine.vectorizer,
+                    engine.svd_model,
+                    engine.svd,
+                    engine.recipe_ids,
+                    engine.restriction_index,
+                    strategy=strategy,
+                    filter_columns=engine.filter_columns,
+                    k=25,
+                )
+                results, _ = search.algorithm(
+                    engine.release,
+                    queries,
+                    dietary_restrictions,
+                    engine.vectorizer,
+                    engine.svd_model,
+                    strategy=strategy,
+                    k=25,
+                )
+                assert results == expected
+
+        with pytest.raises(RuntimeError, match="No release"):
+            search.scatter("top", "missing", None, {}, None, "sum", 10)
+    finally:
+        search.close()
+    assert all(process.poll() is not None for process in processes)
+    # Closing again does nothing
+    search.close()
@@ -0,0 +1,158 @@
+import bisect
+import contextlib
+import os
+import threading
+import time
+
+# Timing is off unless STAGE_TIMING is set, in which case stage() costs a
+# function call and a no-op context manager
+ENABLED = os.environ.get("STAGE_TIMING", "0") not in ("", "0", "false")
+
+# Upper bounds, in seconds, of the histogram buckets
+BUCKETS = (
+    0.0001,
+    0.00025,
+    0.0005,
+    0.001,
+    0.0025,
+    0.005,
+    0.01,
+    0.025,
+    0.05,
+    0.1,
+    0.25,
+    0.5,
+    1.0,
+    2.5,
+)
+
+_NOOP = contextlib.nullcontext()
+_local = threading.local()
+
+
+class Histogram(object):
+    """
+    A Prometheus-style histogram of durations for one stage.
+    """
+
+    def __init__(self):
+        self.counts = [0] * (len(BUCKETS) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, seconds):
+        self.counts[bisect.bisect_left(BUCKETS, seconds)] += 1
+        self.sum += seconds
+        self.count += 1
+
+
+_histograms = {}
+_lock = threading.Lock()
+
+
+class _Stage(object):
+    __slots__ = ("name", "start")
+
+    def __init__(self, name):
+        self.name = name
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+
+    def __exit__(self, *exc):
+        records = getattr(_local, "records", None)
+        if records is not None:
+            records.append((self.name, time.perf_counter() - self.start))
+
+
+def stage(name):
+    """
+    Times a stage of the current request.
+
+        with timing.stage("score"):
+            ...
+
+    Args:
+        name (str): The stage name. A stage entered several times in one request
+            is reported once with its total duration.
+
+    Returns:
+        A context manager, which does nothing when timing is off or outside of
+        a request.
+    """
+    if not ENABLED:
+        return _NOOP
+    return _Stage(name)
+
+
+def start_request(endpoint):
+    """
+    Starts the timing of a request.
+
+    Args:
+        endpoint (str): The route of the request, e.g. /recipes, which labels
+            its histograms so that probes and scrapes do not mix with searches.
+    """
+    if ENABLED:
+        _local.records = []
+        _local.start = time.perf_counter()
+        _local.endpoint = endpoint
+
+
+def finish_request():
+    """
+    Ends the timing of the current request and adds its stages, and a "total"
+    stage, to the histograms of its endpoint.
+
+    Returns:
+        list: (stage, seconds) tuples in the order the stages first ran, or an
+            empty list when timing is off.
+    """
+    records = getattr(_local, "records", None)
+    if records is None:
+        return []
+    _local.records = None
+
+    durations = {}
+    for name, seconds in records:
+        durations[name] = durations.get(name, 0) + seconds
+    durations["total"] = time.perf_counter() - _local.start
+
+    with _lock:
+        for name, seconds in durations.items():
+            key = (_local.endpoint, name)
+            if key not in _histograms:
+                _histograms[key] = Histogram()
+            _histograms[key].observe(seconds)
+    return list(durations.items())
+
+
+def server_timing(durations):
+    """
+    Formats stage durations as a Server-Timing header value.
+    """
+    return ", ".join(f"{name};dur={seconds * 1000:.3f}" for name, seconds in durations)
+
+
+def render_prometheus():
+    """
+    Renders the stage histograms in the Prometheus text exposition format,
+    labelled by endpoint and stage.
+    """
+    lines = [
+        "# HELP platedate_stage_seconds Duration of each stage of a request.",
+        "# TYPE platedate_stage_seconds histogram",
+    ]
+    with _lock:
+        for (endpoint, name), histogram in sorted(_histograms.items()):
+            labels = f'endpoint="{endpoint}",stage="{name}"'
+            cumulative = 0
+            for bound, count in zip(BUCKETS + ("+Inf",), histogram.counts):
+                cumulative += count
+                lines.append(
+                    f'platedate_stage_seconds_bucket{{{labels},le="{bound}"}} '
+                    f"{cumulative}"
+                )
+            lines.append(f"platedate_stage_seconds_sum{{{labels}}} {histogram.sum}")
+            lines.append(f"platedate_stage_seconds_count{{{labels}}} {histogram.count}")
+    return "\n".join(lines) + "\n"
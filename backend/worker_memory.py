@@ -0,0 +1,60 @@
+"""
+Reports the memory of a gunicorn master and its workers from /proc (Linux):
+
+    python worker_memory.py $(cat /tmp/gunicorn.pid)
+
+RSS counts every resident page, including pages shared with the master, so the
+RSS of the workers adds up to much more than the machine uses. PSS splits each
+shared page evenly between the processes that map it, and private memory is
+what a worker would free on exit, i.e. what each extra worker costs.
+"""
+
+import sys
+
+FIELDS = (
+    "Rss",
+    "Pss",
+    "Shared_Clean",
+    "Shared_Dirty",
+    "Private_Clean",
+    "Private_Dirty",
+)
+
+
+def memory(pid):
+    """
+    Args:
+        pid (int): A process id.
+
+    Returns:
+        dict: The fields of /proc/<pid>/smaps_rollup, in kilobytes.
+    """
+    usage = {}
+    with open(f"/proc/{pid}/smaps_rollup") as f:
+        for line in f:
+            name, _, value = line.partition(":")
+            if name in FIELDS:
+                usage[name] = int(value.split()[0])
+    return usage
+
+
+def children(pid):
+    with open(f"/proc/{pid}/task/{pid}/children") as f:
+        return [int(child) for child in f.read().split()]
+
+
+if __name__ == "__main__":
+    master = int(sys.argv[1])
+    print(f"{'pid':>8} {'rss':>10} {'pss':>10} {'shared':>10} {'private':>10}  (MB)")
+    total_pss = 0
+    for i, pid in enumerate([master] + children(master)):
+        usage = memory(pid)
+        shared = usage["Shared_Clean"] + usage["Shared_Dirty"]
+        private = usage["Private_Clean"] + usage["Private_Dirty"]
+        total_pss += usage["Pss"]
+        print(
+            f"{pid:>8} {usage['Rss'] / 1024:10.1f} {usage['Pss'] / 1024:10.1f} "
+            f"{shared / 1024:10.1f} {private / 1024:10.1f}"
+            + ("  master" if i == 0 else "")
+        )
+    print(f"total pss {total_pss / 1024:.1f} MB")